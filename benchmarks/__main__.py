@@ -0,0 +1,26 @@
+"""
+Usage: python -m benchmarks [--pages 1000 --pages 10000 ...]
+"""
+from pathlib import Path
+
+import click
+
+from .run import main
+
+
+@click.command()
+@click.option('-p', '--pages', 'scales', type=int, multiple=True, default=[1000, 10000, 100000], show_default=True,
+              help='number of pages to generate, may be passed multiple times')
+@click.option('-w', '--workers', type=int, default=1, show_default=True, help='number of worker processes')
+@click.option('-k', '--keep', type=click.Path(file_okay=False), help='directory to generate sites in and keep')
+@click.option('--seed', type=int, default=123, show_default=True, help='random seed for generated content')
+@click.option('-v', '--verbose', is_flag=True)
+def cli(scales, workers, keep, seed, verbose):
+    """
+    Benchmark harrier builds of synthetic sites at different scales.
+    """
+    main(sorted(scales), workers, keep and Path(keep), seed, verbose)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,178 @@
+"""
+Generate synthetic sites for benchmarking harrier.
+"""
+import csv
+import json
+import random
+from pathlib import Path
+
+WORDS = (
+    'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et dolore '
+    'magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo '
+    'consequat duis aute irure in reprehenderit voluptate velit esse cillum fugiat nulla pariatur'
+).split()
+SECTIONS = 'docs', 'blog', 'guides', 'reference', 'news'
+CODE_LANGS = 'python', 'js', 'bash', 'notalanguage'
+CODE = {
+    'python': 'def foo(x):\n    return {"x": x * 2}\n',
+    'js': 'const foo = x => ({x: x * 2})\n',
+    'bash': 'for f in *.md; do\n  echo "$f"\ndone\n',
+    'notalanguage': 'whatever <b>not highlighted</b>\n',
+}
+
+CONFIG = """\
+default_template: main.jinja
+webpack:
+  run: false
+defaults:
+{defaults}
+"""
+
+TEMPLATES = {
+    'base.jinja': (
+        '<!doctype html>\n'
+        '<html>\n'
+        '<head>\n'
+        '  <title>{{ page.title }}</title>\n'
+        '  <style>{{ inline_css("theme/main.css") }}</style>\n'
+        '</head>\n'
+        '<body>\n'
+        '  {% include "partials/nav.jinja" %}\n'
+        '  {% block main %}{% endblock %}\n'
+        '  {% include "partials/footer.jinja" %}\n'
+        '</body>\n'
+        '</html>\n'
+    ),
+    'main.jinja': (
+        '{% extends "base.jinja" %}\n'
+        '{% block main %}\n'
+        '  <main class="{{ page.section }}">\n'
+        '    <h1>{{ page.title|shout }}</h1>\n'
+        '    {{ content }}\n'
+        '  </main>\n'
+        '{% endblock %}\n'
+    ),
+    'partials/nav.jinja': (
+        '<nav>\n'
+        '  {% for name in config.sections %}\n'
+        '    <a href="{{ url(name) }}">{{ name|title }}</a>\n'
+        '  {% endfor %}\n'
+        '</nav>\n'
+    ),
+    'partials/footer.jinja': (
+        '<footer>\n'
+        '  {% for author in data.authors[:5] %}{{ author.name }} {% endfor %}\n'
+        '  built {{ config.build_time }}\n'
+        '</footer>\n'
+    ),
+}
+
+SASS = """\
+$primary: #123456;
+
+body {
+  color: $primary;
+  main {
+    padding: 10px + 10px;
+    .hi {
+      background: lighten($primary, 60%);
+    }
+  }
+}
+"""
+
+EXTENSIONS = """\
+from harrier.extensions import modify, template
+
+
+@modify.pages('/blog/*')
+def add_blog_flag(page, config):
+    page['is_blog'] = True
+    return page
+
+
+@template.filter
+def shout(s):
+    return s.upper()
+"""
+
+
+def words(rand: random.Random, n):
+    return ' '.join(rand.choice(WORDS) for _ in range(n))
+
+
+def page_content(rand: random.Random, i: int, section: str):
+    paragraphs = []
+    for p in range(rand.randint(2, 8)):
+        paragraphs.append(words(rand, rand.randint(20, 80)))
+        if p % 3 == 1:
+            lang = rand.choice(CODE_LANGS)
+            paragraphs.append(f'```{lang}\n{CODE[lang]}```')
+    frontmatter = (
+        '---\n'
+        f'title: {words(rand, 3).title()} {i}\n'
+        f'tags: [{rand.choice(WORDS)}, {rand.choice(WORDS)}]\n'
+        f'weight: {rand.randint(1, 100)}\n'
+        '---\n'
+    )
+    return frontmatter + f'# {words(rand, 4)}\n\n' + '\n\n'.join(paragraphs) + '\n'
+
+
+def generate_site(path: Path, pages: int, *, seed: int=123, data_size: int=100):
+    """
+    Generate a synthetic site with the given number of pages: pages with front matter, markdown and fenced code,
+    "defaults" globs, data files in csv, json and yaml, a sass theme and an extensions.py.
+    """
+    rand = random.Random(seed)
+    path = Path(path)
+    pages_dir = path / 'pages'
+    for i in range(pages):
+        section = SECTIONS[i % len(SECTIONS)]
+        # spread pages over sub-directories so no directory is enormous
+        p = pages_dir / section / f'{i // 1000:03d}' / f'page-{i}.md'
+        p.parent.mkdir(parents=True, exist_ok=True)
+        p.write_text(page_content(rand, i, section))
+    for section in SECTIONS:
+        (pages_dir / section / 'index.html').write_text(
+            '---\n'
+            f'title: {section.title()}\n'
+            '---\n'
+            '<ul>\n'
+            f'{{% for p in pages|glob("/{section}/*/*.md") %}}'
+            '{% if loop.index <= 50 %}<li><a href="{{ p.uri }}">{{ p.title }}</a></li>{% endif %}'
+            '{% endfor %}\n'
+            '</ul>\n'
+        )
+
+    defaults = '\n'.join(
+        f'  /{section}/*:\n    section: {section}\n    description: "{{{{ title }}}} in {section}"'
+        for section in SECTIONS
+    )
+    (path / 'harrier.yml').write_text(CONFIG.format(defaults=defaults) + (
+        'sections:\n' + ''.join(f'  - {section}\n' for section in SECTIONS)
+    ))
+
+    data_dir = path / 'data'
+    data_dir.mkdir(parents=True, exist_ok=True)
+    with (data_dir / 'authors.csv').open('w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['name', 'email', 'bio'])
+        for i in range(data_size):
+            writer.writerow([f'author {i}', f'author{i}@example.com', words(rand, 10)])
+    (data_dir / 'products.json').write_text(json.dumps([
+        {'id': i, 'name': words(rand, 2), 'price': rand.randint(1, 1000)} for i in range(data_size)
+    ]))
+    (data_dir / 'settings.yml').write_text(''.join(f'key_{i}: {words(rand, 3)}\n' for i in range(data_size)))
+
+    templates_dir = path / 'theme' / 'templates'
+    for name, content in TEMPLATES.items():
+        (templates_dir / name).parent.mkdir(parents=True, exist_ok=True)
+        (templates_dir / name).write_text(content)
+    (path / 'theme' / 'sass').mkdir(parents=True, exist_ok=True)
+    (path / 'theme' / 'sass' / 'main.scss').write_text(SASS)
+    assets_dir = path / 'theme' / 'assets' / 'images'
+    assets_dir.mkdir(parents=True, exist_ok=True)
+    for i in range(10):
+        (assets_dir / f'image-{i}.svg').write_text(f'<svg xmlns="http://www.w3.org/2000/svg" width="{i}"/>\n')
+    (path / 'extensions.py').write_text(EXTENSIONS)
+    return path
@@ -0,0 +1,169 @@
+"""
+Time harrier builds of synthetic sites at different scales.
+"""
+import gc
+import logging
+import math
+import resource
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from time import perf_counter
+
+from harrier.assets import AssetManifest, copy_assets, run_grablib
+from harrier.build import build_pages
+from harrier.config import Mode, get_config
+from harrier.data import load_data
+from harrier.extensions import apply_modifiers, apply_page_generator
+from harrier.main import build
+from harrier.render import render_pages
+
+from .generate import generate_site
+
+STAGES = 'build_pages', 'load_data', 'copy_assets', 'sass', 'path_lookup', 'render_pages'
+# "build" is a complete build with an empty cache directory, "build_warm" a second build in the same process
+BUILDS = 'build', 'build_warm'
+
+
+def cold_config(path: Path, run_dir: Path) -> Path:
+    """
+    Write a copy of the site's config using a new cache directory so nothing is reused from earlier runs.
+    """
+    run_dir.mkdir(parents=True)
+    config_file = run_dir / 'harrier.yml'
+    config_file.write_text(
+        f'{(path / "harrier.yml").read_text()}\nsource_dir: {path}\ncache_dir: {run_dir / "cache"}\n'
+    )
+    return config_file
+
+
+def time_stages(config_file: Path, workers: int):
+    """
+    Run each stage of a build one after the other and time them.
+    """
+    times = {}
+
+    def timed(name, f, *args, **kwargs):
+        start = perf_counter()
+        r = f(*args, **kwargs)
+        times[name] = perf_counter() - start
+        return r
+
+    config = get_config(config_file)
+    config.mode = Mode.production
+    config.workers = workers
+    config = apply_modifiers(config, config.extensions.config_modifiers)
+    shutil.rmtree(config.dist_dir, ignore_errors=True)
+    config.dist_dir.mkdir(parents=True)
+
+    som = dict(config=config)
+    som['pages'] = timed('build_pages', build_pages, config)
+    som['data'] = timed('load_data', load_data, config)
+    assets = AssetManifest()
+    assets.update('copy_assets', timed('copy_assets', copy_assets, config))
+    assets.update('sass', timed('sass', run_grablib, config, assets))
+    apply_page_generator(som, config)
+    som['path_lookup'] = timed('path_lookup', assets.path_lookup, config, som['pages'])
+    som = apply_modifiers(som, config.extensions.som_modifiers)
+    timed('render_pages', render_pages, config, som, workers=workers)
+    return times
+
+
+def time_builds(config_file: Path, workers: int):
+    """
+    Time a complete build then a second build which reuses module level caches and the cache directory.
+    """
+    times = {}
+    for name in BUILDS:
+        gc.collect()
+        start = perf_counter()
+        build(config_file, mode=Mode.production, workers=workers)
+        times[name] = perf_counter() - start
+    return times
+
+
+def _run_measurement(f, config_file: Path, workers: int):
+    times = f(config_file, workers)
+    # ru_maxrss is in KB on linux, children covers worker processes and build steps run in subprocesses
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return times, self_rss, children_rss
+
+
+def _run_scale(path: Path, run_dir: Path, workers: int):
+    """
+    Run the staged build and the complete builds each in a fresh process with their own cache directory so
+    neither benefits from caches populated by the other.
+    """
+    times, self_rss, children_rss = {}, 0, 0
+    for name, f in (('stages', time_stages), ('builds', time_builds)):
+        config_file = cold_config(path, run_dir / name)
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            t, s, c = executor.submit(_run_measurement, f, config_file, workers).result()
+        times.update(t)
+        self_rss, children_rss = max(self_rss, s), max(children_rss, c)
+    return times, self_rss, children_rss
+
+
+def run_benchmarks(scales, *, workers: int=1, keep: Path=None, seed: int=123):
+    """
+    Generate a site for each scale and time it, each measurement is run in a fresh process so caches are cold and
+    peak memory usage is measured independently.
+    """
+    results = []
+    root = Path(keep or tempfile.mkdtemp(prefix='harrier-benchmark-'))
+    try:
+        for pages in scales:
+            path = root / f'site-{pages}'
+            if not (path / 'harrier.yml').exists():
+                start = perf_counter()
+                generate_site(path, pages, seed=seed)
+                print(f'generated {pages} pages in {perf_counter() - start:0.2f}s')
+            run_dir = Path(tempfile.mkdtemp(prefix=f'harrier-benchmark-run-{pages}-'))
+            try:
+                times, self_rss, children_rss = _run_scale(path, run_dir, workers)
+            finally:
+                shutil.rmtree(run_dir)
+            results.append((pages, times, self_rss, children_rss))
+            print_results(results[-1:])
+    finally:
+        if not keep:
+            shutil.rmtree(root)
+    return results
+
+
+def print_results(results):
+    stages = STAGES + BUILDS
+    print(f'{"pages":>8} ' + ' '.join(f'{s:>17}' for s in stages) + f' {"peak MB":>9} {"workers MB":>10}')
+    for pages, times, self_rss, children_rss in results:
+        stage_times = ' '.join(f'{times[s]:>16.3f}s' for s in stages)
+        print(f'{pages:>8} {stage_times} {self_rss:>9.1f} {children_rss:>10.1f}')
+
+
+def print_scaling(results):
+    """
+    Print the scaling exponent of each stage between consecutive scales: ~1 means linear, >1 worse than linear.
+    """
+    if len(results) < 2:
+        return
+    stages = STAGES + BUILDS
+    print('\nscaling exponents (time ∝ pages^k):')
+    print(f'{"pages":>17} ' + ' '.join(f'{s:>17}' for s in stages))
+    for (n1, t1, *_), (n2, t2, *_) in zip(results, results[1:]):
+        exponents = []
+        for s in stages:
+            if t1[s] > 0 and t2[s] > 0:
+                exponents.append(f'{math.log(t2[s] / t1[s]) / math.log(n2 / n1):>17.2f}')
+            else:
+                exponents.append(f'{"-":>17}')
+        print(f'{f"{n1}→{n2}":>17} ' + ' '.join(exponents))
+
+
+def main(scales, workers, keep, seed, verbose):
+    logging.basicConfig(level=logging.DEBUG if verbose else logging.WARNING)
+    results = run_benchmarks(scales, workers=workers, keep=keep, seed=seed)
+    print('\nresults:')
+    print_results(results)
+    print_scaling(results)
+    return results
@@ -1,25 +1,116 @@
 import asyncio
+import hashlib
 import json
 import logging
 import os
-import re
 import shutil
 import subprocess
+from pathlib import Path
 from time import time
+from typing import Dict, Iterable, List, Optional, Tuple
 
-from grablib.build import SassGenerator, insert_hash
-from grablib.common import GrablibError
-from grablib.download import Downloader
-from pygments.formatters.html import HtmlFormatter
-
-from .common import HarrierProblem, clean_uri, log_complete, norm_path_ref
+from .common import HarrierProblem, clean_uri, is_within, log_complete, norm_path_ref, path_match_set
 from .config import Config, Mode
 from .extensions import ExtensionError
+from .trace import traced
 
 logger = logging.getLogger('harrier.assets')
+# written to the cache directory, lists the files built by each asset step
+ASSET_MANIFEST = 'asset-manifest-{}.json'
+# unhashed path -> (path, last modified), both relative to dist_dir
+AssetFiles = Dict[str, Tuple[str, str]]
+
+
+class AssetManifest:
+    """
+    Files built by copy_assets, sass and webpack, keyed by step. This is the source for path_lookup so dist_dir
+    doesn't need to be scanned and hashes don't need to be guessed from file names.
+    """
+    __slots__ = 'steps',
+
+    def __init__(self, steps: Dict[str, AssetFiles]=None):
+        self.steps = steps or {}
+
+    def update(self, step: str, files: Optional[AssetFiles]):
+        """
+        Replace the files recorded for step, other steps are unaffected.
+        """
+        self.steps[step] = files or {}
+
+    def files(self) -> AssetFiles:
+        d = {}
+        for files in self.steps.values():
+            d.update(files)
+        return d
+
+    @traced
+    def path_lookup(self, config: Config, pages=None):
+        d = {name: (clean_uri(path, config), False, last_mod) for name, (path, last_mod) in self.files().items()}
+        last_mod = f'{config.build_time:%s}'
+        if pages:
+            for p in pages.values():
+                if p.get('output', True):
+                    uri = p['uri']
+                    d[uri.strip('/')] = uri, True, last_mod
+        return d
+
+    @staticmethod
+    def get_path(config: Config) -> Path:
+        """
+        Path of the manifest in the cache directory, shard and sync builds have their own dist_dir and manifest.
+        """
+        dist_hash = hashlib.md5(str(config.dist_dir).encode()).hexdigest()[:10]
+        return config.get_cache_dir() / ASSET_MANIFEST.format(dist_hash)
+
+    @classmethod
+    def load(cls, config: Config) -> 'AssetManifest':
+        p = cls.get_path(config)
+        try:
+            data = json.loads(p.read_text())
+            steps = {step: _load_files(files) for step, files in data.items()}
+        except FileNotFoundError:
+            return cls()
+        except (AttributeError, TypeError, ValueError) as e:
+            logger.warning('error loading asset manifest "%s", ignoring it: %s', p, e)
+            return cls()
+        return cls(steps)
+
+    def save(self, config: Config):
+        """
+        Write the manifest to the cache directory, or remove a stale one if no assets were built.
+        """
+        p = self.get_path(config)
+        if self.files():
+            p.parent.mkdir(parents=True, exist_ok=True)
+            p.write_text(json.dumps(self.steps, indent=2, sort_keys=True))
+        elif p.exists():
+            p.unlink()
+
+
+def _load_files(files: dict) -> AssetFiles:
+    d = {}
+    for name, (path, last_mod) in files.items():
+        if not isinstance(name, str) or not isinstance(path, str) or not isinstance(last_mod, str):
+            raise ValueError(f'invalid entry for "{name}"')
+        d[name] = path, last_mod
+    return d
+
+
+def _asset_file(path: Path, config: Config):
+    return str(path.relative_to(config.dist_dir)), f'{path.stat().st_mtime:0.0f}'
+
 
+@traced
+def run_grablib(config: Config, assets: Optional[AssetManifest]=None) -> AssetFiles:
+    """
+    Download files and build sass, returns the css files built. assets is used to resolve paths in sass, by default
+    the asset manifest saved by the last build.
+    """
+    # grablib imports libsass, requests and aiohttp so it's only imported when required
+    from grablib.build import SassGenerator
+    from grablib.common import GrablibError
+    from grablib.download import Downloader
 
-def run_grablib(config: Config):
     start = time()
     download_root = config.theme_dir / 'libs'
     log_msg = False
@@ -31,11 +122,14 @@ def run_grablib(config: Config):
             aliases=config.download_aliases,
             lock=config.theme_dir / '.grablib.lock',
         )
-        download()
+        try:
+            download()
+        except GrablibError as e:
+            raise HarrierProblem('error downloading files') from e
         log_msg = True
 
     sass_dir = config.theme_dir / 'sass'
-    count = 0
+    files = {}
     if sass_dir.is_dir():
         output_dir = config.dist_dir / config.dist_dir_sass
         output_dir.relative_to(config.dist_dir)
@@ -44,13 +138,27 @@ def run_grablib(config: Config):
         out_dir_src = output_dir / '.src'
         out_dir_src.is_dir() and shutil.rmtree(out_dir_src)
 
-        path_lookup = get_path_lookup(config)
+        if assets is None:
+            assets = AssetManifest.load(config)
+        path_lookup = assets.path_lookup(config)
         custom_functions = {
             'resolve_path': lambda path: f"'{resolve_path(path, path_lookup, config)}'",
             'smart_url': lambda path: f"url('{resolve_path(path, path_lookup, config)}')",
         }
 
-        sass_gen = SassGenerator(
+        generated = []
+
+        class RecordingSassGenerator(SassGenerator):
+            def _log_file_creation(self, rel_path, css_path, css):
+                # called with the final css, the hash is inserted afterwards, harrier never uses debug with apply_hash
+                path = insert_hash(css_path, css.encode()) if self._apply_hash else css_path
+                generated.append((css_path, path))
+                if self._debug:
+                    map_path = css_path.with_name(css_path.name + '.map')
+                    generated.append((map_path, map_path))
+                return super()._log_file_creation(rel_path, css_path, css)
+
+        sass_gen = RecordingSassGenerator(
             input_dir=sass_dir,
             output_dir=output_dir,
             download_root=download_root,
@@ -64,10 +172,12 @@ def run_grablib(config: Config):
         except GrablibError as e:
             raise HarrierProblem('error generating sass') from e
         log_msg = True
-        count = sass_gen._files_generated
+        files = {
+            str(name.relative_to(config.dist_dir)): _asset_file(path, config) for name, path in generated
+        }
 
-    log_msg and log_complete(start, 'sass built', count)
-    return count
+    log_msg and log_complete(start, 'sass built', len(files))
+    return files
 
 
 PYGMENTS_PREFIX = 'pygments/'
@@ -76,53 +186,75 @@ PYGMENTS_PREFIX = 'pygments/'
 def pygments_importer(path: str):
     if not path.startswith(PYGMENTS_PREFIX):
         return
+    from pygments.formatters.html import HtmlFormatter
+
     style_name = path[len(PYGMENTS_PREFIX):]
     formatter = HtmlFormatter(style=style_name)
     return [(f'pygments/{style_name}.css', formatter.get_style_defs('.hi'))]
 
 
-def copy_assets(config: Config):
+def insert_hash(path: Path, content: bytes, hash_length=7):
+    """
+    Insert a hash of content into the path after the first dot, same as grablib's insert_hash which would
+    import libsass.
+    """
+    hash_ = hashlib.md5(content).hexdigest()[:hash_length]
+    if '.' in path.name:
+        new_name = path.name.replace('.', f'.{hash_}.', 1)
+    else:
+        new_name = f'{path.name}.{hash_}'
+    return path.with_name(new_name)
+
+
+@traced
+def copy_assets(config: Config) -> AssetFiles:
     start = time()
     in_dir = config.theme_dir / 'assets'
     if not in_dir.is_dir():
-        return
+        return {}
     out_dir = config.dist_dir / config.dist_dir_assets
     out_dir.relative_to(config.dist_dir)
-    copied = 0
+    no_hash = path_match_set(tuple(config.no_hash))
+    config.extensions.load()
+    copy_modifiers = config.extensions.copy_modifiers
+    copy_matches = path_match_set(tuple(path_match for path_match, _ in copy_modifiers))
+    files = {}
     for in_path in in_dir.glob('**/*'):
         if not in_path.is_file():
             continue
-        out_path = out_dir / in_path.relative_to(in_dir)
+        out_path = name = out_dir / in_path.relative_to(in_dir)
         path_ref = norm_path_ref(in_path, in_dir)
-        if config.mode == Mode.production and not any(path_match(path_ref) for path_match in config.no_hash):
+        if config.mode == Mode.production and not no_hash(path_ref):
             out_path = insert_hash(out_path, in_path.read_bytes())
         out_path.parent.mkdir(parents=True, exist_ok=True)
 
-        config.extensions.load()
         applied_extension = False
-        for path_match, f in config.extensions.copy_modifiers:
-            if path_match(path_ref):
-                try:
-                    applied_extension = f(in_path, out_path, config=config)
-                except Exception as e:
-                    logger.exception('%s error running copy extension %s', in_path, f.__name__)
-                    raise ExtensionError(str(e)) from e
-                if applied_extension:
-                    break
+        for i in copy_matches.match(path_ref):
+            f = copy_modifiers[i][1]
+            try:
+                applied_extension = f(in_path, out_path, config=config)
+            except Exception as e:
+                logger.exception('%s error running copy extension %s', in_path, f.__name__)
+                raise ExtensionError(str(e)) from e
+            if applied_extension:
+                break
 
         if not applied_extension:
             shutil.copy(in_path, out_path)
-        copied += 1
+        files[str(name.relative_to(config.dist_dir))] = _asset_file(out_path, config)
+    copied = len(files)
     logger.debug('copied %d theme assets from "%s" to "%s"',
                  copied, in_dir.relative_to(config.source_dir), out_dir.relative_to(config.dist_dir))
 
     copied and log_complete(start, 'theme assets copied', copied)
-    return copied
+    return files
 
 
 def assets_grablib(config: Config):
-    copy_assets(config)
-    run_grablib(config)
+    assets = AssetManifest()
+    assets.update('copy_assets', copy_assets(config))
+    assets.update('sass', run_grablib(config, assets))
+    return assets
 
 
 def webpack_configuration(config: Config, watch: bool):
@@ -153,11 +285,12 @@ def webpack_configuration(config: Config, watch: bool):
     return [str(a) for a in args if a], env
 
 
-def run_webpack(config: Config):
+@traced
+def run_webpack(config: Config) -> AssetFiles:
     start = time()
     args, env = webpack_configuration(config, False)
     if not args:
-        return
+        return {}
 
     cmd = ' '.join(args)
     kwargs = dict(check=True, cwd=config.source_dir, env=env)
@@ -173,17 +306,68 @@ def run_webpack(config: Config):
                        cmd, e.returncode, e.output, e.stderr)
         raise HarrierProblem('error running webpack') from e
     else:
-        count = 1
+        stats = None
         if capture_output:
             try:
-                output = json.loads(p.stdout[p.stdout.find('{'):])
+                stats = json.loads(p.stdout[p.stdout.find('{'):])
             except ValueError:
                 # happens when the webpack config script writes to standout including a "{"
                 pass
-            else:
-                count = len(output['assets'])
-        log_complete(start, 'webpack built', count)
-        return count
+        files = webpack_files(config, stats)
+        log_complete(start, 'webpack built', len(files))
+        return files
+
+
+def webpack_files(config: Config, stats: Optional[dict]=None) -> AssetFiles:
+    """
+    Find the files built by webpack using its stats output, without stats all files in the output directory are used.
+    """
+    out_dir = config.webpack.output_path
+    if not is_within(out_dir, config.dist_dir):
+        # files outside dist_dir can't be referenced by pages
+        return {}
+    if stats:
+        assets = [(a['name'], _asset_hashes(a, stats)) for a in stats['assets']]
+    elif out_dir.is_dir():
+        assets = [(str(p.relative_to(out_dir)), ()) for p in out_dir.glob('**/*') if p.is_file()]
+    else:
+        return {}
+
+    files = {}
+    for name, hashes in assets:
+        path = out_dir / name
+        if path.is_file():
+            files[str((out_dir / _strip_hash(name, hashes)).relative_to(config.dist_dir))] = _asset_file(path, config)
+    return files
+
+
+def _asset_hashes(asset: dict, stats: dict) -> List[str]:
+    """
+    Hashes webpack might have put in an asset's name: the compilation hash and, from webpack 5, the asset's
+    contenthash, chunkhash and fullhash which are each either a string or a list.
+    """
+    hashes = [stats['hash']] if stats.get('hash') else []
+    for v in (asset.get('info') or {}).values():
+        if isinstance(v, str):
+            hashes.append(v)
+        elif isinstance(v, list):
+            hashes.extend(h for h in v if isinstance(h, str))
+    return hashes
+
+
+def _strip_hash(name: str, hashes: Iterable[str]=()):
+    """
+    Remove hashes from a webpack file name: parts which are a prefix of a known hash, e.g. from stats, or which look
+    like a hash, 7 to 20 hex characters, so [contenthash] and [chunkhash] names are handled with or without stats.
+    """
+    hashes = [h for h in hashes if h]
+    return '.'.join(
+        p for p in name.split('.')
+        if not ((len(p) >= 4 and any(h.startswith(p) for h in hashes)) or (7 <= len(p) <= 20 and set(p) <= HEX_CHARS))
+    )
+
+
+HEX_CHARS = set('0123456789abcdef')
 
 
 async def start_webpack_watch(config: Config):
@@ -195,23 +379,6 @@ async def start_webpack_watch(config: Config):
         return await asyncio.create_subprocess_exec(*args, cwd=config.source_dir, env=env)
 
 
-def get_path_lookup(config: Config, pages=None):
-    d = {}
-    for p in config.dist_dir.glob('**/*'):
-        if p.is_file():
-            rel_path = str(p.relative_to(config.dist_dir))
-            path_name = re.sub('\.[a-f0-9]{7,20}\.', '.', rel_path)
-            path_name = re.sub('\.[a-f0-9]{7,20}$', '', path_name)
-            d[path_name] = clean_uri(rel_path, config), False, f'{p.stat().st_mtime:0.0f}'
-    last_mod = f'{config.build_time:%s}'
-    if pages:
-        for p in pages.values():
-            if p.get('output', True):
-                uri = p['uri']
-                d[uri.strip('/')] = uri, True, last_mod
-    return d
-
-
 def resolve_path(path, path_lookup, config):
     p = path_lookup.get(path.strip('/'))
     if p:
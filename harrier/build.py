@@ -1,16 +1,22 @@
+import io
 import logging
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
 from time import time
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 
 from pydantic import BaseModel, validator
+from pydantic.datetime_parse import parse_datetime
 
-from .common import URI_NOT_ALLOWED, HarrierProblem, clean_uri, log_complete, norm_path_ref, slugify
+from .common import (URI_NOT_ALLOWED, HarrierProblem, PathMatch, PathMatchSet, clean_uri, log_complete, norm_path_ref,
+                     path_match_set, slugify, split_chunks)
 from .config import Config
 from .extensions import ExtensionError
-from .frontmatter import parse_front_matter, parse_yaml
+from .frontmatter import parse_front_matter, parse_yaml, read_front_matter
+from .trace import span, traced
 
 # extensions where we want to do anything except just copy the file to the output dir
 OUTPUT_HTML = {'.html', '.md', '.yml', '.yaml'}
@@ -18,6 +24,7 @@ YAML_FILE = {'.yml', '.yaml'}
 MAYBE_RENDER = {'.xml', '.txt'}
 DATE_REGEX = re.compile(r'(\d{4})-(\d{2})-(\d{2})-?(.*)')
 URI_IS_TEMPLATE = re.compile('[{}]')
+PLACEHOLDER_REGEX = re.compile(r'{{ ?(\w+).?}}')
 
 logger = logging.getLogger('harrier.build')
 
@@ -26,58 +33,203 @@ class PlaceHolderError(HarrierProblem):
     pass
 
 
-def build_pages(config: Config):
+@traced
+def build_pages(config: Config, manifest=None):
     start = time()
-    pages, files = BuildPages(config).run()
+    pages, files = BuildPages(config, manifest).run()
     log_complete(start, 'pages built', files)
     return pages
 
 
-def content_templates(pages, config):
-    tmp_dir = config.get_tmp_dir()
-    for page in pages:
-        if not page['pass_through']:
-            content_template = tmp_dir / 'content' / page['infile'].relative_to(config.pages_dir)
-            if not content_template.parent.exists():
-                content_template.parent.mkdir(parents=True)
-            content_template.write_text(page['content'])
-            page['content_template'] = str(content_template.relative_to(tmp_dir))
+def page_content(page: dict) -> str:
+    """
+    Get a page's content, reading it from the source file if it's loaded lazily.
+    """
+    if 'content' in page:
+        return page['content']
+    with page['infile'].open('rb') as f:
+        f.seek(page['content_offset'])
+        # text mode translates newlines the same way as reading content eagerly
+        return io.TextIOWrapper(f, encoding='utf8').read()
 
 
 class BuildPages:
-    __slots__ = 'config', 'tmp_dir', 'files', 'template_files'
+    __slots__ = 'config', 'manifest', 'page_defaults', 'files', 'template_files'
 
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, manifest=None):
         self.config = config
+        self.manifest = manifest
+        # prepared here rather than cached between builds so changes to config.defaults are always used
+        self.page_defaults = PageDefaults(config.defaults)
         self.files = 0
         self.template_files = 0
 
     def run(self):
-        paths = sorted(self.config.pages_dir.glob('**/*'), key=lambda p_: (len(p_.parents), str(p_)))
+        # list of page data in the same order as files, filled in from the manifest or by parsing files
+        page_data = []
+        to_parse = []
+        for p, stat in walk_pages(self.config):
+            v = self.manifest and self.manifest.get_page_data(p, stat)
+            if not v:
+                to_parse.append((len(page_data), p, stat))
+            page_data.append(v)
+
+        if self.config.workers > 1 and len(to_parse) > 1:
+            parsed = self._parse_parallel([(p, stat) for _, p, stat in to_parse])
+        else:
+            parsed = [_get_page_data(p, stat, self.config, self.page_defaults) for _, p, stat in to_parse]
+
+        for (i, p, stat), v in zip(to_parse, parsed):
+            page_data[i] = v
+            if v and self.manifest:
+                self.manifest.set_page_data(p, v, stat)
+
         pages = {}
-        for p in paths:
-            if p.is_file():
-                try:
-                    v = get_page_data(p, config=self.config)
-                except(ExtensionError, PlaceHolderError):
-                    # these are logged directly
-                    raise
-                except Exception:
-                    logger.exception('%s: error building SOM for page', p)
-                    raise
-                if v:
-                    self.files += 1
-                    if not v['pass_through']:
-                        self.template_files += 1
-                    path_ref = v.pop('path_ref')
-                    pages[path_ref] = v
+        for v in page_data:
+            if v:
+                self.files += 1
+                if not v['pass_through']:
+                    self.template_files += 1
+                path_ref = v.pop('path_ref')
+                pages[path_ref] = v
         logger.debug('Built site object model with %d files, %d files to render', self.files, self.template_files)
         return pages, self.files
 
+    def _parse_parallel(self, paths):
+        global PAGES_CONFIG, PAGES_DEFAULTS
+        chunks = split_chunks(paths, self.config.workers)
+        logger.debug('parsing %d files in %d chunks with %d workers', len(paths), len(chunks), self.config.workers)
+        PAGES_CONFIG, PAGES_DEFAULTS = self.config, self.page_defaults
+        try:
+            with ProcessPoolExecutor(max_workers=self.config.workers) as executor:
+                return [v for chunk_data in executor.map(_parse_chunk, chunks) for v in chunk_data]
+        finally:
+            PAGES_CONFIG = PAGES_DEFAULTS = None
+
+
+# PAGES_CONFIG and PAGES_DEFAULTS are set before the fork so worker processes can use them with extensions already
+# loaded and defaults already prepared
+PAGES_CONFIG: Config = None
+PAGES_DEFAULTS: 'PageDefaults' = None
+
+
+def _parse_chunk(paths):
+    assert PAGES_CONFIG, 'PAGES_CONFIG global not set'
+    with span('parse chunk', pages=len(paths)):
+        return [_get_page_data(p, stat, PAGES_CONFIG, PAGES_DEFAULTS) for p, stat in paths]
+
+
+def _get_page_data(p, stat: os.stat_result, config: Config, page_defaults: 'PageDefaults'):
+    try:
+        with span('get_page_data', 'page', path=p):
+            return get_page_data(p, config=config, file_stat=stat, page_defaults=page_defaults)
+    except(ExtensionError, PlaceHolderError):
+        # these are logged directly
+        raise
+    except Exception:
+        logger.exception('%s: error building SOM for page', p)
+        raise
+
+
+class PageDefaults:
+    """
+    config.defaults prepared for applying to pages: globs are combined in a PathMatchSet and the keys of each
+    defaults entry which hold placeholders or containers are found once rather than for every page.
+    """
+    __slots__ = 'matches', 'entries'
+
+    def __init__(self, defaults: Dict[PathMatch, dict]):
+        self.matches = PathMatchSet(defaults)
+        self.entries = [
+            (
+                d,
+                frozenset(k for k, v in d.items() if _has_placeholder(v)),
+                # dicts and lists are copied so pages don't share them with config
+                frozenset(k for k, v in d.items() if isinstance(v, (dict, list))),
+            )
+            for d in defaults.values()
+        ]
+
+    def apply(self, data: dict, path_ref: str):
+        """
+        Update data with each matching defaults entry in turn then replace placeholders, only keys which
+        might hold placeholders are updated. Raises KeyError if a placeholder key is missing.
+        """
+        # keys whose values still contain placeholders
+        pending = {k for k, v in data.items() if isinstance(v, str) and '{{' in v}
+        for i in self.matches.match(path_ref):
+            defaults, placeholder_keys, container_keys = self.entries[i]
+            data.update(defaults)
+            pending = (pending - defaults.keys()) | placeholder_keys
+            to_update = pending | container_keys
+            if to_update:
+                # all new values are found before data is updated, so placeholders get values from before this entry
+                replace = _placeholder_replace(data)
+                data.update({k: _apply_placeholders(data[k], replace) for k in data if k in to_update})
+                pending = {k for k in pending if _has_placeholder(data[k])}
+
+
+def _placeholder_replace(data: dict):
+    def replace(m):
+        return data[m.group(1)]
+    return replace
+
 
-def get_page_data(p, *, config: Config, file_content: str=None, **extra_data):  # noqa: C901 (ignore complexity)
+def _apply_placeholders(v, replace):
+    if isinstance(v, str) and '{{' in v:
+        return PLACEHOLDER_REGEX.sub(replace, v)
+    elif isinstance(v, dict):
+        return {k: _apply_placeholders(v_, replace) for k, v_ in v.items()}
+    elif isinstance(v, list):
+        return [_apply_placeholders(v_, replace) for v_ in v]
+    else:
+        return v
+
+
+def _has_placeholder(v):
+    if isinstance(v, str):
+        return '{{' in v
+    elif isinstance(v, dict):
+        return any(_has_placeholder(v_) for v_ in v.values())
+    elif isinstance(v, list):
+        return any(_has_placeholder(v_) for v_ in v)
+    else:
+        return False
+
+
+def walk_pages(config: Config) -> List[Tuple[Path, os.stat_result]]:
+    """
+    Find files in pages_dir with their stat results, directories which are ignored entirely aren't walked.
+
+    Files are sorted by depth then path so pages in parent directories come first.
+    """
+    ignore = path_match_set(tuple(config.ignore))
+    files = []
+    # relative paths of directories still to scan
+    dirs = ['']
+    while dirs:
+        rel_dir = dirs.pop()
+        with os.scandir(config.pages_dir / rel_dir) as it:
+            for entry in it:
+                rel_path = os.path.join(rel_dir, entry.name)
+                path_ref = '/' + os.path.normcase(rel_path)
+                # symlinked directories aren't followed, as with glob('**/*'), they could loop back up the tree
+                if entry.is_dir(follow_symlinks=False):
+                    if not ignore.match_dir(path_ref):
+                        dirs.append(rel_path)
+                elif entry.is_file() and not ignore(path_ref):
+                    files.append((rel_path.count(os.sep), rel_path, entry.stat()))
+    files.sort(key=lambda f: f[:2])
+    return [(config.pages_dir / rel_path, stat) for _, rel_path, stat in files]
+
+
+def get_page_data(p, *, config: Config, file_content: str=None, file_stat: os.stat_result=None,  # noqa: C901
+                  page_defaults: PageDefaults=None, **extra_data):
+    """
+    Build page data from a file, page_defaults should be prepared once per build when getting data for many pages.
+    """
     path_ref = norm_path_ref(p, config.pages_dir)
-    if any(path_match(path_ref) for path_match in config.ignore):
+    if path_match_set(tuple(config.ignore))(path_ref):
         return
 
     html_output = p.suffix in OUTPUT_HTML
@@ -93,7 +245,7 @@ def get_page_data(p, *, config: Config, file_content: str=None, **extra_data):
         # file will not actually exist
         created = datetime.now()
     else:
-        created = p.stat().st_mtime
+        created = (file_stat or p.stat()).st_mtime
 
     data = {
         'path_ref': path_ref,
@@ -104,42 +256,30 @@ def get_page_data(p, *, config: Config, file_content: str=None, **extra_data):
         'created': created,
     }
 
-    regex = re.compile(r'{{ ?(\w+).?}}')
-
-    def _replace(m):
-        return data[m.group(1)]
-
-    def _apply_placeholders(d):
-        if isinstance(d, str) and '{{' in d:
-            return regex.sub(_replace, d)
-        elif isinstance(d, dict):
-            return {k: _apply_placeholders(v) for k, v in d.items()}
-        elif isinstance(d, list):
-            return [_apply_placeholders(v) for v in d]
-        else:
-            return d
-
-    for path_match, defaults in config.defaults.items():
-        if path_match(path_ref):
-            data.update(defaults)
-            try:
-                data = _apply_placeholders(data)
-            except KeyError as e:
-                logger.exception('%s key error applying placeholders: "%s"', p, e)
-                raise PlaceHolderError(f'Placeholder key error "{e}"') from e
+    try:
+        (page_defaults or PageDefaults(config.defaults)).apply(data, path_ref)
+    except KeyError as e:
+        logger.exception('%s key error applying placeholders: "%s"', p, e)
+        raise PlaceHolderError(f'Placeholder key error "{e}"') from e
 
     pass_through = data.get('pass_through')
     if not pass_through and (html_output or maybe_render):
-        s = file_content if file_content is not None else p.read_text()
-        if p.suffix in YAML_FILE:
-            fm_data, content = parse_yaml(s)
+        if config.lazy_content and file_content is None and p.suffix not in YAML_FILE:
+            fm_data, content_offset = read_front_matter(p)
+            if html_output or fm_data:
+                data['content_offset'] = content_offset
+                fm_data and data.update(fm_data)
         else:
-            fm_data, content = parse_front_matter(s)
-        if html_output or fm_data:
-            data['content'] = content
-            fm_data and data.update(fm_data)
-
-    if 'content' not in data:
+            s = file_content if file_content is not None else p.read_text()
+            if p.suffix in YAML_FILE:
+                fm_data, content = parse_yaml(s)
+            else:
+                fm_data, content = parse_front_matter(s)
+            if html_output or fm_data:
+                data['content'] = content
+                fm_data and data.update(fm_data)
+
+    if 'content' not in data and 'content_offset' not in data:
         pass_through = True
 
     data.update(extra_data)
@@ -158,23 +298,58 @@ def get_page_data(p, *, config: Config, file_content: str=None, **extra_data):
             raise KeyError(f'missing format variable "{e.args[0]}" for "{uri}"')
 
     data['uri'] = clean_uri(uri, config)
-    for path_match, f in config.extensions.page_modifiers:
-        if path_match(path_ref):
-            try:
-                data = f(data, config=config)
-            except Exception as e:
-                logger.exception('%s error running page extension %s', p, f.__name__)
-                raise ExtensionError(str(e)) from e
-            if not isinstance(data, dict):
-                logger.error('%s extension "%s" did not return a dict', p, f.__name__)
-                raise ExtensionError(f'extension "{f.__name__}" did not return a dict')
-
-    fd = FileData(**data)
-    final_data = fd.dict(exclude={'template'} if pass_through else set())
+    page_modifiers = config.extensions.page_modifiers
+    for i in path_match_set(tuple(path_match for path_match, _ in page_modifiers)).match(path_ref):
+        f = page_modifiers[i][1]
+        try:
+            data = f(data, config=config)
+        except Exception as e:
+            logger.exception('%s error running page extension %s', p, f.__name__)
+            raise ExtensionError(str(e)) from e
+        if not isinstance(data, dict):
+            logger.error('%s extension "%s" did not return a dict', p, f.__name__)
+            raise ExtensionError(f'extension "{f.__name__}" did not return a dict')
+
+    final_data = validate_page_data(data)
+    if pass_through:
+        final_data.pop('template')
     final_data['pass_through'] = bool(pass_through)
     return final_data
 
 
+def validate_page_data(data: dict) -> dict:
+    """
+    Validate page data against FileData. When the typed fields already have the right types data is checked and
+    updated in place, otherwise FileData is used so coercion and errors are unchanged.
+    """
+    try:
+        infile, title, slug, created, uri = data['infile'], data['title'], data['slug'], data['created'], data['uri']
+    except KeyError:
+        return FileData(**data).dict()
+    template = data.get('template')
+    if (
+        isinstance(infile, Path) and type(title) is str and type(slug) is str and type(uri) is str
+        and (isinstance(created, datetime) or (isinstance(created, (int, float)) and not isinstance(created, bool)))
+        and (template is None or type(template) is str)
+        and not uri_error(uri)
+    ):
+        if not isinstance(created, datetime):
+            data['created'] = parse_datetime(created)
+        data['template'] = template
+        return data
+    else:
+        return FileData(**data).dict()
+
+
+def uri_error(uri: str) -> Optional[str]:
+    if not uri.startswith('/'):
+        return f'uri must start with a slash: "{uri}'
+    invalid = URI_NOT_ALLOWED.findall(uri)
+    if invalid:
+        invalid = ', '.join(f'"{inv}"' for inv in invalid)
+        return f'uri contains invalid characters: {invalid}'
+
+
 class FileData(BaseModel):
     infile: Path
     title: str
@@ -185,12 +360,9 @@ class FileData(BaseModel):
 
     @validator('uri')
     def validate_uri(cls, v):
-        if not v.startswith('/'):
-            raise ValueError(f'uri must start with a slash: "{v}')
-        invalid = URI_NOT_ALLOWED.findall(v)
-        if invalid:
-            invalid = ', '.join(f'"{inv}"' for inv in invalid)
-            raise ValueError(f'uri contains invalid characters: {invalid}')
+        error = uri_error(v)
+        if error:
+            raise ValueError(error)
         return v
 
     class Config:
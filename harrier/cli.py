@@ -3,17 +3,32 @@ import sys
 import traceback
 
 import click
-from grablib.common import GrablibError
 from pydantic import ValidationError
 
 from . import main
 from .common import HarrierProblem, setup_logging
 from .config import Mode
+from .shard import parse_shard
 from .version import VERSION
 
 steps_help = 'Build steps to run, multiple values allowed, default: all.'
 dev_help = 'Whether to build in development or production mode, default: production.'
 verbose_help = 'Enable verbose output.'
+trace_help = 'Write a chrome trace event file showing how long each step and page took to build.'
+report_help = 'Show the given number of slowest pages and templates after rendering.'
+workers_help = 'Number of processes used to build and render pages, 0 to use one per CPU, default: from config or 1.'
+incremental_help = (
+    'Only parse and render pages which have changed since the last incremental build, output from the previous '
+    'build is kept.'
+)
+sync_help = (
+    'Build in a staging directory then only write files to dist which have changed and remove files which '
+    'weren\'t built, unchanged files keep their mtime.'
+)
+shard_help = (
+    'Only render a share of pages, e.g. "3/8", into a separate directory, combine shards with "harrier merge". '
+    'Theme assets, sass and webpack output are taken from shard 1.'
+)
 logger = logging.getLogger('harrier')
 
 
@@ -26,12 +41,25 @@ def cli():
     pass
 
 
+def _parse_shard(ctx, param, value):
+    try:
+        return value and parse_shard(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
 @cli.command()
 @click.argument('path', type=click.Path(exists=True), required=False, default='.')
 @click.option('--steps', '-s', multiple=True, type=click.Choice(main.ALL_STEPS), help=steps_help)
 @click.option('-d/-p', '--dev/--prod', 'dev_mode', default=None, help=dev_help)
+@click.option('-i', '--incremental', is_flag=True, help=incremental_help)
+@click.option('-w', '--workers', type=click.IntRange(min=0), help=workers_help)
+@click.option('--trace', type=click.Path(dir_okay=False), help=trace_help)
+@click.option('--report', type=int, default=0, help=report_help)
+@click.option('--sync', is_flag=True, help=sync_help)
+@click.option('--shard', callback=_parse_shard, help=shard_help)
 @click.option('-v/-q', '--verbose/--quiet', 'verbose', default=None, help=verbose_help)
-def build(path, dev_mode, steps, verbose):
+def build(path, dev_mode, steps, incremental, workers, trace, report, sync, shard, verbose):
     """
     build the site
     """
@@ -41,8 +69,46 @@ def build(path, dev_mode, steps, verbose):
         mode = Mode.development if dev_mode else Mode.production
 
     try:
-        main.build(path, set(steps), mode)
-    except (HarrierProblem, ValidationError, GrablibError) as e:
+        main.build(path, set(steps), mode, incremental, workers, trace, report, sync, shard)
+    except (HarrierProblem, ValidationError) as e:
+        msg = 'Error: {}'
+        if not verbose:
+            msg += '\n\nUse "--verbose" for more details'
+        logger.debug(traceback.format_exc())
+        logger.error(msg.format(e))
+        sys.exit(2)
+
+
+@cli.command()
+@click.argument('path', type=click.Path(exists=True), required=False, default='.')
+@click.option('-v/-q', '--verbose/--quiet', 'verbose', default=None, help=verbose_help)
+def merge(path, verbose):
+    """
+    Combine the output of sharded builds into the dist directory.
+    """
+    setup_logging(verbose)
+    try:
+        main.merge(path)
+    except (HarrierProblem, ValidationError) as e:
+        msg = 'Error: {}'
+        if not verbose:
+            msg += '\n\nUse "--verbose" for more details'
+        logger.debug(traceback.format_exc())
+        logger.error(msg.format(e))
+        sys.exit(2)
+
+
+@cli.command('compile-theme')
+@click.argument('path', type=click.Path(exists=True), required=False, default='.')
+@click.option('-v/-q', '--verbose/--quiet', 'verbose', default=None, help=verbose_help)
+def compile_theme(path, verbose):
+    """
+    Compile theme templates to python modules in the cache directory, builds use them until a template changes.
+    """
+    setup_logging(verbose)
+    try:
+        main.compile_theme(path)
+    except (HarrierProblem, ValidationError) as e:
         msg = 'Error: {}'
         if not verbose:
             msg += '\n\nUse "--verbose" for more details'
@@ -54,15 +120,16 @@ def build(path, dev_mode, steps, verbose):
 @cli.command()
 @click.argument('path', type=click.Path(exists=True), required=False, default='.')
 @click.option('-p', '--port', default=8000, type=int, help='port to use for dev server.')
+@click.option('--trace', type=click.Path(dir_okay=False), help=trace_help)
 @click.option('-v/-q', '--verbose/--quiet', 'verbose', default=None, help=verbose_help)
-def dev(path, port, verbose):
+def dev(path, port, trace, verbose):
     """
     Serve the site while watching for file changes and rebuilding upon changes.
     """
     setup_logging(verbose, dev=True)
     try:
-        main.dev(path, port)
-    except (HarrierProblem, ValidationError, GrablibError) as e:
+        main.dev(path, port, trace)
+    except (HarrierProblem, ValidationError) as e:
         msg = 'Error: {}'
         if not verbose:
             msg += '\n\nUse "--verbose" for more details'
@@ -1,9 +1,12 @@
 import logging.config
 import re
 from fnmatch import translate
+from functools import lru_cache
+from math import ceil
 from os.path import normcase
 from pathlib import Path
 from time import time
+from typing import Iterable, List, Tuple
 
 import click
 from pydantic.validators import str_validator
@@ -22,6 +25,19 @@ def log_complete(start, description, items):
     completed_logger.info('%6s %20s %0.3fs', items, description, time() - start)
 
 
+# number of chunks per worker when splitting work between processes, more chunks give better load balancing
+# at the cost of more overhead
+CHUNKS_PER_WORKER = 4
+
+
+def split_chunks(items: list, workers: int):
+    """
+    Split items into contiguous chunks so neighbouring files are processed by the same worker.
+    """
+    chunk_size = ceil(len(items) / (workers * CHUNKS_PER_WORKER)) or 1
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+
 class PathMatch:
     __slots__ = 'raw', '_regex'
 
@@ -32,6 +48,13 @@ class PathMatch:
     def __call__(self, path: str):
         return self._regex.match(path)
 
+    def match_dir(self, path: str):
+        """
+        Whether every path within the directory matches, this is only certain if the pattern ends with "*" and
+        matches the directory path with a trailing slash.
+        """
+        return self.raw.endswith('*') and self(path + '/')
+
     def __hash__(self):
         return hash(self.raw)
 
@@ -48,10 +71,73 @@ class PathMatch:
         return cls(value)
 
 
+GLOB_SPECIAL = re.compile(r'[*?\[]')
+
+
+class PathMatchSet:
+    """
+    Match a path against many PathMatch globs at once, globs are indexed by the literal text before their first
+    wildcard so only globs which might match are tested. Globs without wildcards are compared directly.
+    """
+    __slots__ = 'matches', '_literals', '_prefixes', '_prefix_lengths'
+
+    def __init__(self, matches: Iterable[PathMatch]):
+        self.matches = list(matches)
+        self._literals = {}
+        self._prefixes = {}
+        for i, m in enumerate(self.matches):
+            glob = normcase(m.raw)
+            wildcard = GLOB_SPECIAL.search(glob)
+            if wildcard:
+                self._prefixes.setdefault(glob[:wildcard.start()], []).append(i)
+            else:
+                self._literals.setdefault(glob, []).append(i)
+        self._prefix_lengths = sorted({len(prefix) for prefix in self._prefixes})
+
+    def match(self, path: str) -> List[int]:
+        """
+        Indexes of all globs which match path, in order.
+        """
+        indexes = list(self._literals.get(path, ()))
+        for n in self._prefix_lengths:
+            if n > len(path):
+                break
+            indexes.extend(i for i in self._prefixes.get(path[:n], ()) if self.matches[i](path))
+        if len(indexes) > 1:
+            indexes.sort()
+        return indexes
+
+    def __call__(self, path: str) -> bool:
+        return bool(self.match(path))
+
+    def match_dir(self, path: str) -> bool:
+        """
+        Whether any glob matches every path within the directory, see PathMatch.match_dir.
+        """
+        return any(self.matches[i].raw.endswith('*') for i in self.match(path + '/'))
+
+
+@lru_cache(maxsize=64)
+def path_match_set(matches: Tuple[PathMatch, ...]) -> PathMatchSet:
+    """
+    Get a PathMatchSet for the globs, cached since the same globs from config are used for every page.
+    """
+    return PathMatchSet(matches)
+
+
 def norm_path_ref(p: Path, rel: Path):
     return '/' + normcase(str(p.relative_to(rel)))
 
 
+def is_within(location: Path, directory: Path):
+    try:
+        location.relative_to(directory)
+    except ValueError:
+        return False
+    else:
+        return True
+
+
 def slugify(title):
     name = title.replace(' ', '-').lower()
     name = URI_NOT_ALLOWED.sub('', name)
@@ -68,10 +154,13 @@ def clean_uri(uri, config):
     return '/' + uri
 
 
-class ColourHandler(logging.Handler):  # pragma: no cover
+class ClickHandler(logging.Handler):  # pragma: no cover
+    """
+    Same as grablib's ClickHandler which can't be used without importing all of grablib.
+    """
     formats = {
         logging.DEBUG: {'fg': 'white', 'dim': True},
-        logging.INFO: {'fg': 'white', 'dim': True},
+        logging.INFO: {'fg': 'green'},
         logging.WARN: {'fg': 'yellow'},
     }
 
@@ -83,6 +172,14 @@ class ColourHandler(logging.Handler):  # pragma: no cover
         click.secho(log_entry, **self.get_log_format(record))
 
 
+class ColourHandler(ClickHandler):  # pragma: no cover
+    formats = {
+        logging.DEBUG: {'fg': 'white', 'dim': True},
+        logging.INFO: {'fg': 'white', 'dim': True},
+        logging.WARN: {'fg': 'yellow'},
+    }
+
+
 def log_config(verbose: bool, dev) -> dict:
     if verbose is True:
         log_level = 'DEBUG'
@@ -91,7 +188,7 @@ def log_config(verbose: bool, dev) -> dict:
     else:
         assert verbose is None
         log_level = 'INFO'
-    return {
+    config = {
         'version': 1,
         'disable_existing_loggers': True,
         'formatters': {
@@ -106,12 +203,12 @@ def log_config(verbose: bool, dev) -> dict:
         'handlers': {
             'default': {
                 'level': log_level,
-                'class': 'grablib.common.ClickHandler',
+                'class': 'harrier.common.ClickHandler',
                 'formatter': 'default'
             },
             'build': {
                 'level': 'DEBUG' if verbose else ('WARNING' if dev else 'INFO'),
-                'class': 'grablib.common.ClickHandler',
+                'class': 'harrier.common.ClickHandler',
                 'formatter': 'default'
             },
             'grablib': {
@@ -119,11 +216,6 @@ def log_config(verbose: bool, dev) -> dict:
                 'class': 'harrier.common.ColourHandler',
                 'formatter': 'default'
             },
-            'server_logging': {
-                'level': log_level,
-                'class': 'aiohttp_devtools.runserver.log_handlers.AuxiliaryHandler',
-                'formatter': 'server'
-            },
         },
         'loggers': {
             'harrier': {
@@ -144,12 +236,20 @@ def log_config(verbose: bool, dev) -> dict:
                 'handlers': ['grablib'],
                 'level': log_level,
             },
-            'adev.server.aux': {
-                'handlers': ['server_logging'],
-                'level': log_level,
-            },
         },
     }
+    if dev:
+        # aiohttp_devtools is only imported by dictConfig when running the dev server
+        config['handlers']['server_logging'] = {
+            'level': log_level,
+            'class': 'aiohttp_devtools.runserver.log_handlers.AuxiliaryHandler',
+            'formatter': 'server'
+        }
+        config['loggers']['adev.server.aux'] = {
+            'handlers': ['server_logging'],
+            'level': log_level,
+        }
+    return config
 
 
 def setup_logging(verbose, dev=False):
@@ -1,5 +1,6 @@
 import hashlib
 import logging
+import os
 import tempfile
 from datetime import datetime
 from enum import Enum
@@ -48,7 +49,7 @@ class Config(BaseModel):
     dist_dir: Path = 'dist'
     dist_dir_sass: Path = 'theme'
     dist_dir_assets: Path = '.'
-    tmp_dir: Path = None
+    cache_dir: Path = None
 
     download: Dict[str, Any] = {}
     download_aliases: Dict[str, str] = {}
@@ -62,6 +63,12 @@ class Config(BaseModel):
 
     webpack: WebpackConfig = WebpackConfig()
     build_time: datetime = None
+    # number of processes used to build the site object model and render pages, 0 to use one per cpu
+    workers: int = 1
+    # only read front matter when building the site object model, page content is read from disk when rendering
+    lazy_content: bool = False
+    # keep rendered markdown in cache_dir so unchanged markdown isn't rendered again by later builds
+    markdown_cache: bool = False
 
     @validator('source_dir')
     def resolve_source_dir(cls, v):
@@ -142,16 +149,25 @@ class Config(BaseModel):
         webpack.output_path = values['dist_dir'] / webpack.output_path
         return webpack
 
+    @validator('workers')
+    def validate_workers(cls, v):
+        if v < 0:
+            raise ValueError('workers may not be negative')
+        return v or os.cpu_count()
+
     @validator('build_time', pre=True, always=True)
     def set_build_time(cls, v):
         return datetime.utcnow()
 
-    def get_tmp_dir(self) -> Path:
-        if self.tmp_dir:
-            return self.tmp_dir
+    def get_cache_dir(self) -> Path:
+        """
+        Directory for files persisted between builds.
+        """
+        if self.cache_dir:
+            return self.cache_dir
         else:
             path_hash = hashlib.md5(b'%s' % self.source_dir).hexdigest()
-            return Path(tempfile.gettempdir()) / f'harrier-{path_hash}'
+            return Path(tempfile.gettempdir()) / f'harrier-cache-{path_hash}'
 
     class Config:
         extra = Extra.allow
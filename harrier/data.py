@@ -9,6 +9,7 @@ from ruamel.yaml import YAMLError
 
 from .common import HarrierProblem, log_complete, yaml
 from .config import Config
+from .trace import traced
 
 logger = logging.getLogger('harrier.data')
 csv_dialect = csv.excel
@@ -19,6 +20,7 @@ def simplify(key):
     return re.sub('\W', '', re.sub('[\- ]', '_', key))
 
 
+@traced
 def load_data(config: Config):
     start = time()
     d = config.data_dir
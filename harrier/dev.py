@@ -13,13 +13,15 @@ from aiohttp_devtools.runserver import serve_static
 from pydantic import BaseModel
 from watchgod import Change, DefaultWatcher, awatch
 
-from .assets import copy_assets, get_path_lookup, run_grablib, start_webpack_watch
-from .build import build_pages, content_templates, get_page_data
-from .common import HarrierProblem, log_complete
+from .assets import AssetManifest, copy_assets, run_grablib, start_webpack_watch, webpack_files
+from .build import PageDefaults, build_pages, get_page_data
+from .common import HarrierProblem, is_within, log_complete
 from .config import Config, get_config
 from .data import load_data
 from .extensions import apply_modifiers, apply_page_generator
 from .render import get_outfile, render_pages
+from .templates import TemplateGraph
+from .trace import span
 
 HOST = '0.0.0.0'
 logger = logging.getLogger('harrier.dev')
@@ -50,9 +52,13 @@ class Server:
 
 # CONFIG will be set before the fork so it can be used by the child process
 CONFIG: Config = None
-# SOM and BUILD_CACHE will only be set after the fork in the child process created by ProcessPoolExecutor
+# SOM, BUILD_CACHE and TEMPLATE_GRAPH will only be set after the fork in the child process created by
+# ProcessPoolExecutor
 SOM = None
+# files built by asset steps, only updated in the child process
+ASSETS = AssetManifest()
 BUILD_CACHE = {}
+TEMPLATE_GRAPH: TemplateGraph = None
 FIRST_BUILD = '__FB__'
 
 
@@ -62,16 +68,24 @@ class UpdateArgs(BaseModel):
     assets: bool = False
     sass: bool = False
     templates: bool = False
+    template_changes: set = set()
     data: bool = False
     extensions: bool = False
     update_config: bool = False
 
     def build_required(self):
-        return any([self.pages, self.assets, self.sass, self.templates, self.data, self.extensions, self.update_config])
+        return any([self.pages, self.assets, self.sass, self.templates, self.template_changes, self.data,
+                    self.extensions, self.update_config])
 
 
-def update_site(args: UpdateArgs):  # noqa: C901 (ignore complexity)
-    global CONFIG, SOM
+def update_site(args: UpdateArgs):
+    # the span is written to disk when update_site finishes
+    with span('update_site'):
+        return _update_site(args)
+
+
+def _update_site(args: UpdateArgs):  # noqa: C901 (ignore complexity)
+    global CONFIG, SOM, TEMPLATE_GRAPH
     assert CONFIG, 'CONFIG global not set'
     start_time = time()
     full_build = SOM is None
@@ -85,6 +99,7 @@ def update_site(args: UpdateArgs):  # noqa: C901 (ignore complexity)
             args.assets and 'assets changed',
             args.sass and 'sass changed',
             args.templates and 'templates changed',
+            args.template_changes and f'{len(args.template_changes)} templates changed',
             args.data and 'data changed',
             args.extensions and 'extensions changed',
             args.update_config and 'config changed',
@@ -105,14 +120,15 @@ def update_site(args: UpdateArgs):  # noqa: C901 (ignore complexity)
             config = CONFIG
         config.build_time = datetime.utcnow()
         if args.assets:
-            copy_assets(config)
+            ASSETS.update('copy_assets', copy_assets(config))
             args.templates = True  # force re-render as pages might have changed
             args.sass = True  # in case paths changed as used by resolve_url in sass
         if args.sass:
-            run_grablib(config)
+            ASSETS.update('sass', run_grablib(config, ASSETS))
             args.templates = True  # force re-render as pages might have changed
 
         if full_build:
+            TEMPLATE_GRAPH = None
             pages = build_pages(config)
             SOM = dict(
                 pages=pages,
@@ -121,7 +137,6 @@ def update_site(args: UpdateArgs):  # noqa: C901 (ignore complexity)
             )
             apply_page_generator(SOM, config)
             SOM = apply_modifiers(SOM, config.extensions.som_modifiers)
-            content_templates(SOM['pages'].values(), config)
         else:
             SOM['config'] = config
             if args.data:
@@ -133,18 +148,16 @@ def update_site(args: UpdateArgs):  # noqa: C901 (ignore complexity)
             to_update = set()
             if args.pages:
                 start = time()
-                tmp_dir = config.get_tmp_dir()
+                page_defaults = PageDefaults(config.defaults)
                 for change, path in args.pages:
                     rel_path = '/' + str(path.relative_to(config.pages_dir))
                     if change == Change.deleted:
                         page = SOM['pages'][rel_path]
                         outfile = get_outfile(page, config)
                         outfile.unlink()
-                        if 'content_template' in page:
-                            (tmp_dir / page['content_template']).unlink()
                         SOM['pages'].pop(rel_path)
                     else:
-                        v = get_page_data(path, config=config)
+                        v = get_page_data(path, config=config, page_defaults=page_defaults)
                         if v:
                             v.pop('path_ref')
                             SOM['pages'][rel_path] = v
@@ -155,12 +168,24 @@ def update_site(args: UpdateArgs):  # noqa: C901 (ignore complexity)
             extra_pages = apply_page_generator(SOM, config)
             to_update = to_update | extra_pages
             SOM = apply_modifiers(SOM, config.extensions.som_modifiers)
-            content_templates([SOM['pages'][k] for k in SOM['pages'] if k in to_update], config)
 
-        SOM['path_lookup'] = get_path_lookup(config, SOM['pages'])
+        if config.webpack.run:
+            # webpack is running in watch mode so its output could have changed at any time
+            ASSETS.update('webpack', webpack_files(config))
+        SOM['path_lookup'] = ASSETS.path_lookup(config, SOM['pages'])
+        global BUILD_CACHE
         if args.templates:
-            global BUILD_CACHE
             BUILD_CACHE = render_pages(config, SOM, build_cache=BUILD_CACHE)
+        elif args.template_changes:
+            if TEMPLATE_GRAPH is None:
+                TEMPLATE_GRAPH = TemplateGraph(config)
+            else:
+                TEMPLATE_GRAPH.refresh()
+            templates_dir = config.theme_dir / 'templates'
+            changed = {p.relative_to(templates_dir).as_posix() for p in args.template_changes}
+            to_render = TEMPLATE_GRAPH.affected_pages(SOM['pages'], changed)
+            logger.debug('%d pages use the changed templates', len(to_render))
+            BUILD_CACHE = render_pages(config, SOM, build_cache=BUILD_CACHE, only=to_render)
     except HarrierProblem as e:
         logger.debug('error during build %s %s %s', traceback.format_exc(), e.__class__.__name__, e)
         logger.warning('%sbuild failed in %0.3fs', log_prefix, time() - start_time)
@@ -170,15 +195,6 @@ def update_site(args: UpdateArgs):  # noqa: C901 (ignore complexity)
         return 0
 
 
-def is_within(location: Path, directory: Path):
-    try:
-        location.relative_to(directory)
-    except ValueError:
-        return False
-    else:
-        return True
-
-
 class HarrierWatcher(DefaultWatcher):
     def __init__(self, root_path):
         self._used_paths = str(CONFIG.pages_dir), str(CONFIG.theme_dir), str(CONFIG.data_dir)
@@ -210,7 +226,7 @@ async def adev(config: Config, port: int):
         try:
             async for changes in awatch(config.source_dir, stop_event=stop_event, watcher_cls=HarrierWatcher):
                 logger.debug('file changes: %s', changes)
-                args = UpdateArgs(config_path=config_path, pages=set())
+                args = UpdateArgs(config_path=config_path, pages=set(), template_changes=set())
                 for change, raw_path in changes:
                     path = Path(raw_path)
                     if is_within(path, config.pages_dir):
@@ -220,7 +236,7 @@ async def adev(config: Config, port: int):
                     elif is_within(path, config.theme_dir / 'sass'):
                         args.sass = True
                     elif is_within(path, config.theme_dir / 'templates'):
-                        args.templates = True
+                        args.template_changes.add(path)
                     elif is_within(path, config.data_dir):
                         args.data = True
                     elif path == config.extensions.path:
@@ -10,6 +10,7 @@ from jinja2 import (contextfilter, contextfunction, environmentfilter, environme
 from pydantic import BaseModel, ValidationError
 
 from .common import HarrierProblem, PathMatch
+from .trace import traced
 
 __all__ = (
     'modify',
@@ -137,10 +138,12 @@ def run_ext(ext, som):
         raise ExtensionError(str(e)) from e
 
 
+@traced
 def apply_page_generator(som, config):
-    from .build import get_page_data
+    from .build import PageDefaults, get_page_data
     path_refs = set()
     if config.extensions.generate_pages:
+        page_defaults = PageDefaults(config.defaults)
         for ext in config.extensions.generate_pages:
             for d in run_ext(ext, som):
                 try:
@@ -149,7 +152,8 @@ def apply_page_generator(som, config):
                     logger.error('invalid response from extensions %s:\n%s', ext.__name__, e.errors())
                     raise ExtensionError(f'{ext.__name__} response error') from e
                 m.path = config.pages_dir / m.path
-                final_data = get_page_data(m.path, config=config, file_content=m.content, **m.data)
+                final_data = get_page_data(m.path, config=config, file_content=m.content, page_defaults=page_defaults,
+                                           **m.data)
                 path_ref = final_data.pop('path_ref')
                 som['pages'][path_ref] = final_data
                 path_refs.add(path_ref)
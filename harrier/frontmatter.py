@@ -1,5 +1,6 @@
 import logging
 import re
+from pathlib import Path
 
 from ruamel.yaml import YAMLError
 
@@ -7,6 +8,7 @@ from .common import HarrierProblem, yaml
 
 logger = logging.getLogger('harrier.frontmatter')
 FRONT_MATTER_START_REGEX = re.compile(r'---[ \t]*(.*?)\n---[ \t]*\n', re.S)
+FRONT_MATTER_END_REGEX = re.compile(rb'---[ \t]*\r?\n')
 FRONT_MATTER_DIVIDER_REGEX = re.compile(r'\n?^--- ?([.\w_-]+) ?---[ \t]*\n', re.S | re.M)
 FRONT_MATTER_DIVIDER_EXTRA_REGEX = re.compile(r'(.*?)\n---[ \t]*\n', re.S | re.M)
 
@@ -36,6 +38,28 @@ def parse_front_matter(s, regex=FRONT_MATTER_START_REGEX):
     return data, content
 
 
+def read_front_matter(p: Path):
+    """
+    Parse front matter without reading the rest of the file, returns the front matter and the offset in bytes at
+    which content starts.
+    """
+    with p.open('rb') as f:
+        header = [f.readline()]
+        if not header[0].startswith(b'---'):
+            return None, 0
+        for line in f:
+            header.append(line)
+            if FRONT_MATTER_END_REGEX.fullmatch(line):
+                break
+        else:
+            return None, 0
+    header = b''.join(header)
+    data, _ = parse_front_matter(header.decode().replace('\r\n', '\n'))
+    if data is None:
+        return None, 0
+    return data, len(header)
+
+
 def _parse_section_content(s):
     data, content = parse_front_matter(s, FRONT_MATTER_DIVIDER_EXTRA_REGEX)
     data = data or {}
@@ -1,21 +1,26 @@
 import asyncio
 import logging
+import os
 import shutil
-from concurrent.futures import ProcessPoolExecutor
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from enum import Enum
 from pathlib import Path
 from typing import Optional, Set, Union
 
-import devtools
-
-from .assets import assets_grablib, get_path_lookup, run_webpack
-from .build import build_pages, content_templates
-from .common import completed_logger
-from .config import Mode, get_config
+from .assets import AssetManifest, copy_assets, run_grablib, run_webpack
+from .build import build_pages
+from .common import HarrierProblem, completed_logger, is_within
+from .config import Config, Mode, get_config
 from .data import load_data
-from .dev import adev
 from .extensions import apply_modifiers, apply_page_generator
-from .render import render_pages
+from .manifest import BuildManifest
+from .render import compile_theme as _compile_theme
+from .render import log_slowest, render_pages, theme_loader
+from .shard import Shard, in_shard, merge_shards, shard_dist_dir, write_shard_files
+from .templates import TemplateGraph
+from .trace import finish_trace, span, start_trace
+from .writer import sync_dirs
 
 logger = logging.getLogger('harrier.main')
 StrPath = Union[str, Path]
@@ -34,67 +39,250 @@ class BuildSteps(str, Enum):
 ALL_STEPS = [m.value for m in BuildSteps.__members__.values()]
 
 
-def build(path: StrPath, steps: Set[BuildSteps]=None, mode: Optional[Mode]=None):
+def build(path: StrPath, steps: Set[BuildSteps]=None, mode: Optional[Mode]=None, incremental: bool=False,
+          workers: Optional[int]=None, trace: Optional[StrPath]=None, report: int=0, sync: bool=False,
+          shard: Optional[Shard]=None):
+    trace and start_trace()
+    try:
+        with span('build'):
+            return _build(path, steps, mode, incremental, workers, report, sync, shard)
+    finally:
+        trace and finish_trace(trace)
+
+
+def _build(path: StrPath, steps: Optional[Set[BuildSteps]], mode: Optional[Mode], incremental: bool,
+           workers: Optional[int], report: int, sync: bool, shard: Optional[Shard]):
     completed_logger.info('building site...')
     config = get_config(path)
     if mode:
         config.mode = mode
-    logger.debug('Config: %s', devtools.pformat(config.dict()))
+    if workers is not None:
+        # config is already validated so workers has to be checked here
+        if workers < 0:
+            raise HarrierProblem('workers may not be negative')
+        config.workers = workers or os.cpu_count()
+    _log_config(config)
 
     steps = steps or ALL_STEPS
     if BuildSteps.extensions in steps:
         config = apply_modifiers(config, config.extensions.config_modifiers)
 
-    clean = BuildSteps.clean in steps
+    if shard:
+        # each shard builds into its own directory, "harrier merge" combines them
+        _set_dist_dir(config, shard_dist_dir(config.dist_dir, shard))
+    dist_dir = config.dist_dir
+    if sync:
+        # build into a staging directory, then only files which have changed are written to dist_dir
+        _set_dist_dir(config, config.get_cache_dir() / SYNC_STAGING_DIR)
+
+    manifest = BuildManifest(config) if incremental else None
+
+    # with a valid manifest, output files from the previous build are kept and only updated where required
+    clean = BuildSteps.clean in steps and not (manifest and manifest.valid)
     _empty_dir(config.dist_dir, clean)
-    _empty_dir(config.get_tmp_dir(), clean)
 
-    pages = None
-    data_future = None
+    site = SiteBuild(config, steps, manifest, report, shard)
+    if clean:
+        # assets from the previous build have been deleted
+        site.assets = AssetManifest()
     with ProcessPoolExecutor() as executor:
-        futures = [
-            BuildSteps.sass in steps and executor.submit(assets_grablib, config),
-            BuildSteps.webpack in steps and executor.submit(run_webpack, config),
-        ]
-
-        if BuildSteps.data in steps:
-            data_future = executor.submit(load_data, config)
-
-        if BuildSteps.pages in steps:
-            pages = build_pages(config)
-        # this will raise errors if any of the above went wrong
-        [f.result() for f in futures if f]
-
-    som = dict(
-        pages=pages,
-        data=data_future and data_future.result(),
-        config=config,
+        site.run(executor)
+    site.assets.save(config)
+    if shard and site.som['pages'] is not None:
+        write_shard_files(config, shard, (site.som['pages'][k] for k in site.pages_to_render()))
+    if sync:
+        with span('sync'):
+            sync_dirs(config.dist_dir, dist_dir)
+    return site.som
+
+
+SYNC_STAGING_DIR = 'staging'
+# steps which write assets to dist_dir which pages might reference via "url()" etc.
+ASSET_STEPS = {'copy_assets', 'sass', 'webpack'}
+Step = namedtuple('Step', ['name', 'func', 'requires', 'subprocess', 'args'])
+
+
+class SiteBuild:
+    """
+    Build steps expressed as a DAG: each step starts as soon as all the steps it requires have finished. Steps with
+    "subprocess" set are run in the executor with config and "args" as arguments, other steps run in this process.
+    """
+    __slots__ = (
+        'config', 'build_steps', 'manifest', 'report', 'shard', 'som', 'assets', 'results', 'early_pages', 'timings',
+        'theme',
     )
 
-    if BuildSteps.extensions in steps:
-        apply_page_generator(som, config)
+    def __init__(self, config: Config, build_steps: Set[BuildSteps], manifest: Optional[BuildManifest],
+                 report: int=0, shard: Optional[Shard]=None):
+        self.config = config
+        self.build_steps = build_steps
+        self.manifest = manifest
+        self.report = report
+        # if set, only pages in this shard are rendered and only the asset shard builds assets
+        self.shard = shard
+        # page render timings collected over all render steps if report is set
+        self.timings = [] if report else None
+        self.som = dict(pages=None, data=None, config=config)
+        # files from the previous build are kept for asset steps which aren't run
+        self.assets = AssetManifest.load(config)
+        self.results = {}
+        self.early_pages = set()
+        self.theme = None
 
-    som['path_lookup'] = get_path_lookup(config, pages)
+    def get_steps(self):
+        steps, extensions = self.build_steps, BuildSteps.extensions in self.build_steps
+        sass = BuildSteps.sass in steps
+        # som modifiers might use path_lookup so they have to wait for all assets to be built
+        som_requires = {'pages', 'data'}
+        if extensions and self.config.extensions.som_modifiers:
+            som_requires |= ASSET_STEPS
+        if self.manifest:
+            # deciding which pages are stale requires all assets so there's no early rendering
+            render_steps = [Step('render', self.render_incremental, {'som', *ASSET_STEPS}, False, ())]
+        else:
+            render_steps = [
+                Step('render_early', self.render_early, {'som'}, False, ()),
+                Step('render', self.render, {'render_early', *ASSET_STEPS}, False, ()),
+            ]
+        return [s for s in [
+            (BuildSteps.copy_assets in steps or sass) and Step('copy_assets', copy_assets, set(), True, ()),
+            # assets is pickled when the step starts so sass sees the files copied by copy_assets
+            sass and Step('sass', run_grablib, {'copy_assets'}, True, (self.assets,)),
+            BuildSteps.webpack in steps and Step('webpack', run_webpack, set(), True, ()),
+            BuildSteps.data in steps and Step('data', load_data, set(), True, ()),
+            BuildSteps.pages in steps and Step('pages', self.build_pages, set(), False, ()),
+            Step('som', self.build_som, som_requires, False, ()),
+            *(BuildSteps.pages in steps and render_steps or []),
+        ] if s]
 
-    if BuildSteps.extensions in steps:
-        som = apply_modifiers(som, config.extensions.som_modifiers)
+    def run(self, executor: ProcessPoolExecutor):
+        pending = self.get_steps()
+        names = {s.name for s in pending}
+        done, running = set(), {}
+        while pending or running:
+            ready = [s for s in pending if s.requires & names <= done]
+            for s in ready:
+                if s.subprocess:
+                    logger.debug('starting step "%s" in subprocess', s.name)
+                    running[executor.submit(s.func, self.config, *s.args)] = s
+            local = next((s for s in ready if not s.subprocess), None)
+            pending = [s for s in pending if s not in ready or (s is not local and not s.subprocess)]
+            if local:
+                logger.debug('starting step "%s"', local.name)
+                with span(f'step {local.name}'):
+                    local.func()
+                done.add(local.name)
+            else:
+                assert running, 'no steps running or ready to run'
+                wait(running, return_when=FIRST_COMPLETED)
+
+            for f in [f for f in running if f.done()]:
+                s = running.pop(f)
+                # this will raise errors if the step went wrong
+                self.results[s.name] = f.result()
+                if s.name in ASSET_STEPS:
+                    self.assets.update(s.name, self.results[s.name])
+                done.add(s.name)
+
+    def pages_to_render(self) -> Set[str]:
+        pages = self.som['pages']
+        if self.shard:
+            return {k for k in pages if in_shard(k, self.shard)}
+        return set(pages)
+
+    def build_pages(self):
+        self.som['pages'] = build_pages(self.config, self.manifest)
+
+    def build_som(self):
+        config = self.config
+        self.som['data'] = self.results.get('data')
+        extensions = BuildSteps.extensions in self.build_steps
+        if extensions:
+            apply_page_generator(self.som, config)
+
+        self.som['path_lookup'] = self.assets.path_lookup(config, self.som['pages'])
 
-    if som['pages'] is not None:
-        content_templates(som['pages'].values(), config)
-        render_pages(config, som)
-    return som
+        if extensions:
+            self.som = apply_modifiers(self.som, config.extensions.som_modifiers)
 
+    def get_theme(self):
+        # theme templates are fingerprinted once per build rather than for every render
+        if self.theme is None:
+            self.theme = theme_loader(self.config)
+        return self.theme
 
-def dev(path: StrPath, port: int):
+    def render_early(self):
+        """
+        Render pages which don't reference assets while assets are still being built.
+        """
+        graph = TemplateGraph(self.config)
+        pages = self.som['pages']
+        self.early_pages = {k for k in self.pages_to_render() if not graph.uses_assets(pages[k])}
+        if self.early_pages:
+            render_pages(self.config, self.som, only=self.early_pages, workers=self.config.workers,
+                         timings=self.timings, theme=self.get_theme())
+
+    def render(self):
+        pages = self.som['pages']
+        to_render = self.pages_to_render() - self.early_pages
+        if to_render:
+            self.som['path_lookup'] = self.assets.path_lookup(self.config, pages)
+            render_pages(self.config, self.som, only=to_render, workers=self.config.workers, timings=self.timings,
+                         theme=self.get_theme())
+        self.report and log_slowest(self.timings, self.report)
+
+    def render_incremental(self):
+        pages = self.som['pages']
+        self.som['path_lookup'] = self.assets.path_lookup(self.config, pages)
+        stale = self.manifest.stale_pages(self.som) & self.pages_to_render()
+        render_pages(self.config, self.som, build_cache=self.manifest.outputs, only=stale,
+                     workers=self.config.workers, timings=self.timings, theme=self.get_theme())
+        self.manifest.save()
+        self.report and log_slowest(self.timings, self.report)
+
+
+def merge(path: StrPath):
+    config = get_config(path)
+    config = apply_modifiers(config, config.extensions.config_modifiers)
+    return merge_shards(config)
+
+
+def compile_theme(path: StrPath):
+    config = get_config(path)
+    config = apply_modifiers(config, config.extensions.config_modifiers)
+    _compile_theme(config)
+
+
+def dev(path: StrPath, port: int, trace: Optional[StrPath]=None):
     config = get_config(path)
     config.mode = Mode.development
-    logger.debug('Config:\n%s', devtools.pformat(config.dict()))
+    _log_config(config)
 
     _empty_dir(config.dist_dir)
-    _empty_dir(config.get_tmp_dir())
 
+    # aiohttp and watchgod are only imported when they're needed
+    from .dev import adev
+
+    trace and start_trace()
     loop = asyncio.get_event_loop()
-    return loop.run_until_complete(adev(config, port))
+    try:
+        return loop.run_until_complete(adev(config, port))
+    finally:
+        trace and finish_trace(trace)
+
+
+def _set_dist_dir(config: Config, dist_dir: Path):
+    # webpack output outside dist_dir is left where it is
+    if config.webpack.run and is_within(config.webpack.output_path, config.dist_dir):
+        config.webpack.output_path = dist_dir / config.webpack.output_path.relative_to(config.dist_dir)
+    config.dist_dir = dist_dir
+
+
+def _log_config(config: Config):
+    if logger.isEnabledFor(logging.DEBUG):
+        from devtools import pformat
+
+        logger.debug('Config: %s', pformat(config.dict()))
 
 
 def _empty_dir(d: Path, clean: bool=True):
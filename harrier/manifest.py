@@ -0,0 +1,172 @@
+import hashlib
+import logging
+import os
+import pickle
+from pathlib import Path
+
+from .common import norm_path_ref
+from .config import Config
+from .render import get_outfile
+from .templates import TemplateGraph
+from .version import VERSION
+
+logger = logging.getLogger('harrier.manifest')
+MANIFEST_FILE = 'build-manifest.pickle'
+# keys which don't affect how other pages are rendered, "created" is excluded since it's generally the file's mtime
+SITE_EXCLUDE_KEYS = {'content', 'created'}
+
+
+def config_fingerprint(config: Config) -> str:
+    h = hashlib.md5(str(VERSION).encode())
+    h.update(repr(config.dict(exclude={'build_time', 'extensions', 'workers'})).encode())
+    if config.extensions.path.is_file():
+        h.update(config.extensions.path.read_bytes())
+    return h.hexdigest()
+
+
+def site_fingerprint(som: dict) -> str:
+    """
+    Hash of everything a page's template could reference apart from the page itself and templates: data, assets
+    and metadata of all pages.
+    """
+    h = hashlib.md5(repr(som['data']).encode())
+    h.update(repr([(k, v[0]) for k, v in som['path_lookup'].items() if not v[1]]).encode())
+    for path_ref, page in som['pages'].items():
+        h.update(repr((path_ref, {k: v for k, v in page.items() if k not in SITE_EXCLUDE_KEYS})).encode())
+    return h.hexdigest()
+
+
+def page_fingerprint(page: dict, file_hash: bytes=None) -> str:
+    """
+    Hash of the page's data, file_hash is used to account for content when it's not loaded in the page.
+    """
+    h = hashlib.md5(repr(page).encode())
+    file_hash and h.update(file_hash)
+    return h.hexdigest()
+
+
+class BuildManifest:
+    """
+    Record of the previous build, persisted in the cache directory between builds so unchanged pages are neither
+    parsed nor rendered again.
+
+    The manifest is discarded if the config, extensions or harrier version change.
+    """
+    __slots__ = 'config', 'path', 'fingerprint', 'valid', 'sources', 'pages', 'templates', 'outputs', 'site'
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.path = config.get_cache_dir() / MANIFEST_FILE
+        self.fingerprint = config_fingerprint(config)
+        self.valid = False
+        # path_ref: (mtime_ns, size, md5 of file, page data)
+        self.sources = {}
+        # path_ref: (page fingerprint, templates referenced by the page's content, outfile)
+        self.pages = {}
+        # template name: hash of template source
+        self.templates = {}
+        # used as "build_cache" by the renderer, infile: output hash or mtime for copied files
+        self.outputs = {}
+        self.site = None
+        self._load()
+
+    def _load(self):
+        if not self.path.exists():
+            logger.debug('no build manifest found at "%s", building from scratch', self.path)
+            return
+        try:
+            with self.path.open('rb') as f:
+                fingerprint, self.sources, self.pages, self.templates, self.outputs, self.site = pickle.load(f)
+        except Exception as e:
+            logger.warning('error loading build manifest "%s", building from scratch: %s', self.path, e)
+            return self._reset()
+
+        if fingerprint == self.fingerprint:
+            self.valid = True
+            logger.debug('loaded build manifest with %d pages', len(self.pages))
+        else:
+            logger.debug('config, extensions or version changed, building from scratch')
+            self._reset()
+
+    def _reset(self):
+        self.sources, self.pages, self.templates, self.outputs, self.site = {}, {}, {}, {}, None
+
+    def get_page_data(self, p: Path, stat: os.stat_result=None):
+        """
+        Get page data from the previous build if the file is unchanged, file contents is only hashed if the file's
+        mtime or size has changed.
+        """
+        path_ref = norm_path_ref(p, self.config.pages_dir)
+        source = self.sources.get(path_ref)
+        if not source:
+            return
+        mtime, size, file_hash, data = source
+        stat = stat or p.stat()
+        if (stat.st_mtime_ns, stat.st_size) != (mtime, size):
+            if stat.st_size != size or hashlib.md5(p.read_bytes()).digest() != file_hash:
+                return
+            self.sources[path_ref] = stat.st_mtime_ns, size, file_hash, data
+        return dict(data, path_ref=path_ref)
+
+    def set_page_data(self, p: Path, data: dict, stat: os.stat_result=None):
+        stat = stat or p.stat()
+        file_hash = hashlib.md5(p.read_bytes()).digest()
+        self.sources[data['path_ref']] = stat.st_mtime_ns, stat.st_size, file_hash, dict(data)
+
+    def stale_pages(self, som: dict) -> set:
+        """
+        Find pages which need rendering: pages which have changed, pages using templates which have changed,
+        pages whose output file has gone missing or all pages if anything they might all reference has changed.
+
+        Output files of pages which have been removed or moved are deleted.
+        """
+        site = site_fingerprint(som)
+        full_render = not self.valid or site != self.site
+        self.site = site
+
+        graph = TemplateGraph(self.config)
+        changed_templates = {n for n in graph.hashes.keys() | self.templates.keys()
+                             if graph.hashes.get(n) != self.templates.get(n)}
+        self.templates = graph.hashes
+
+        new_pages = {}
+        for path_ref, page in som['pages'].items():
+            outfile = page.get('output', True) and get_outfile(page, self.config)
+            source = 'content' not in page and self.sources.get(path_ref)
+            page_hash = page_fingerprint(page, source and source[2])
+            prev = self.pages.get(path_ref)
+            # content is only parsed for template references if it's changed
+            content_refs = prev[1] if prev and prev[0] == page_hash else graph.content_refs(page)
+            new_pages[path_ref] = page_hash, content_refs, outfile
+
+        new_outfiles = {outfile for *_, outfile in new_pages.values()}
+        removed = 0
+        for *_, outfile in self.pages.values():
+            if outfile and outfile not in new_outfiles and outfile.is_file():
+                outfile.unlink()
+                removed += 1
+
+        stale = set()
+        for path_ref, (page_hash, content_refs, outfile) in new_pages.items():
+            page = som['pages'][path_ref]
+            prev = self.pages.get(path_ref)
+            if outfile and (not outfile.exists() or not prev or prev[2] != outfile):
+                # make sure the renderer writes the file even if the output is unchanged
+                self.outputs.pop(page['infile'], None)
+                stale.add(path_ref)
+            elif full_render or not prev or prev[0] != page_hash:
+                stale.add(path_ref)
+            elif changed_templates and not changed_templates.isdisjoint(graph.page_deps(page, content_refs)):
+                stale.add(path_ref)
+
+        self.sources = {k: v for k, v in self.sources.items() if k in new_pages}
+        self.pages = new_pages
+        logger.debug('%d of %d pages need rendering, %d stale output files removed',
+                     len(stale), len(new_pages), removed)
+        return stale
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open('wb') as f:
+            pickle.dump((self.fingerprint, self.sources, self.pages, self.templates, self.outputs, self.site), f)
+        self.valid = True
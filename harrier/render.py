@@ -2,96 +2,182 @@ import datetime as datetime
 import hashlib
 import json
 import logging
+import os
 import re
 import shutil
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from html import escape
 from pathlib import Path
 from textwrap import dedent
-from time import time
+from time import perf_counter, time
 from types import GeneratorType
 
-from devtools import debug, pformat
-from jinja2 import Environment, FileSystemLoader, contextfilter, contextfunction, nodes
+import jinja2
+from jinja2 import (BaseLoader, ChoiceLoader, Environment, FileSystemBytecodeCache, FileSystemLoader, ModuleLoader,
+                    Template, TemplateNotFound, TemplateSyntaxError, contextfilter, contextfunction, nodes)
 from jinja2.ext import Extension
 from misaka import HtmlRenderer, Markdown, escape_html
-from PIL import Image
-from pygments import highlight
-from pygments.formatters import ClassNotFound
-from pygments.formatters.html import HtmlFormatter
-from pygments.lexers import get_lexer_by_name
 
 from .assets import resolve_path
-from .build import OUTPUT_HTML
-from .common import HarrierProblem, PathMatch, log_complete, slugify
+from .build import OUTPUT_HTML, page_content
+from .common import HarrierProblem, PathMatch, PathMatchSet, log_complete, slugify, split_chunks
 from .config import Config
 from .frontmatter import split_content
+from .trace import span, traced
+from .version import VERSION
+from .writer import OutputWriter
 
 logger = logging.getLogger('harrier.render')
 
 
-def render_pages(config: Config, som: dict, build_cache=None):
+@traced
+def render_pages(config: Config, som: dict, build_cache=None, only=None, workers=1, timings: list=None,
+                 theme: BaseLoader=None):
+    """
+    Render pages, if timings is a list the time taken to render each page is appended to it, see log_slowest.
+    theme is the loader for theme templates, by default from theme_loader, it's shared by all render workers.
+    """
     start = time()
-    cache, files = Renderer(config, som, build_cache).run()
+    # the theme is fingerprinted here rather than by each worker
+    theme = theme or theme_loader(config)
+    image_sizes = image_size_cache(config)
+    # image and css files might have changed since the last render
+    image_sizes.checked = {}
+    INLINE_CSS_CACHE.clear()
+    if workers > 1:
+        cache, files = render_parallel(config, som, build_cache, only, workers, timings, theme)
+    else:
+        cache, files = Renderer(config, som, build_cache, only, timings, theme).run()
+    image_sizes.save()
+    config.markdown_cache and prune_markdown_cache(config)
     log_complete(start, 'pages rendered', files)
     return cache
 
 
+def log_slowest(timings, n):
+    """
+    Log the n slowest pages and theme templates, content template time is attributed to the page as each page
+    has its own content template. Template times are for each template itself including layouts, includes and
+    imports but excluding the templates they reference, see TemplateTimer.
+    """
+    total = sum(content + md + layout for _, _, content, md, layout, _ in timings) or 1
+    pages = sorted(timings, key=lambda t: sum(t[2:5]), reverse=True)[:n]
+    lines = [f'slowest {len(pages)} pages:', '  total    content  markdown layout   page']
+    for page, _, content, md, layout, _ in pages:
+        lines.append(f'  {content + md + layout:0.3f}s   {content:0.3f}s   {md:0.3f}s   {layout:0.3f}s   {page}')
+
+    templates = {}
+    for *_, template_times in timings:
+        for template, template_time in template_times.items():
+            t, count = templates.get(template, (0, 0))
+            templates[template] = t + template_time, count + 1
+    templates = sorted(templates.items(), key=lambda t: t[1][0], reverse=True)[:n]
+    lines += [
+        f'slowest {len(templates)} templates (excluding templates they extend, include or import):',
+        '  total    share   pages   template',
+    ]
+    for template, (t, count) in templates:
+        lines.append(f'  {t:0.3f}s   {t / total:5.1%}   {count:5d}   {template}')
+    logger.info('\n'.join(lines))
+
+
+# RENDER_STATE is set before the fork so worker processes can use the som without it being pickled
+RENDER_STATE = None
+
+
+def render_parallel(config: Config, som: dict, build_cache, only, workers, timings=None, theme: BaseLoader=None):
+    global RENDER_STATE
+    path_refs = [k for k in som['pages'] if only is None or k in only]
+    chunks = split_chunks(path_refs, workers)
+    logger.debug('rendering %d pages in %d chunks with %d workers', len(path_refs), len(chunks), workers)
+
+    RENDER_STATE = config, som, build_cache, timings is not None, theme
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_render_chunk, chunks))
+    finally:
+        RENDER_STATE = None
+
+    files = 0
+    for cache_updates, chunk_files, chunk_timings, image_sizes in results:
+        files += chunk_files
+        for key, v in image_sizes:
+            IMAGE_SIZE_CACHE.add(key, v)
+        if build_cache is not None:
+            build_cache.update(cache_updates)
+        if timings is not None:
+            timings.extend(chunk_timings)
+    return build_cache, files
+
+
+def _render_chunk(path_refs):
+    """
+    Render a chunk of pages in a worker process, only counts, build cache updates, timings and new image sizes are
+    returned to the main process.
+    """
+    assert RENDER_STATE, 'RENDER_STATE global not set'
+    config, som, build_cache, report, theme = RENDER_STATE
+    timings = [] if report else None
+    with span('render chunk', pages=len(path_refs)):
+        cache, files = Renderer(config, som, build_cache, set(path_refs), timings, theme).run()
+    cache_updates = {}
+    if cache is not None:
+        for path_ref in path_refs:
+            infile = som['pages'][path_ref]['infile']
+            if infile in cache:
+                cache_updates[infile] = cache[infile]
+    # workers render several chunks, sizes are only returned with the chunk which found them
+    new_sizes, IMAGE_SIZE_CACHE.new = IMAGE_SIZE_CACHE.new, {}
+    return cache_updates, files, timings, list(new_sizes.items())
+
+
 class Renderer:
-    __slots__ = 'config', 'som', 'build_cache', 'md', 'env', 'checked_dirs', 'ctx', 'to_gen', 'to_copy'
+    __slots__ = (
+        'config', 'som', 'build_cache', 'only', 'timings', 'template_timer', 'md', 'env', 'checked_dirs', 'ctx',
+        'writer', 'generated', 'copied',
+    )
 
-    def __init__(self, config: Config, som: dict, build_cache: dict=None):
+    def __init__(self, config: Config, som: dict, build_cache: dict=None, only: set=None, timings: list=None,
+                 theme: BaseLoader=None):
         self.config = config
         self.som = som
         self.build_cache = build_cache
-
-        md_renderer = HarrierHtmlRenderer()
-        self.md = Markdown(md_renderer, extensions=MD_EXTENSIONS)
-
-        template_dirs = [str(self.config.get_tmp_dir()), str(self.config.theme_dir / 'templates')]
-        logger.debug('template directories: %s', ', '.join(template_dirs))
-
-        extensions = 'jinja2.ext.loopcontrols', MarkdownExtension
-        self.env = Environment(loader=FileSystemLoader(template_dirs), extensions=extensions)
-        self.env.filters.update(
-            glob=page_glob,
-            slugify=slugify,
-            format=format_filter,
-            tojson=json_filter,
-            debug=debug_filter,
-            markdown=self.md,
-            paginate=paginate_filter,
-        )
-        self.env.filters.update(self.config.extensions.template_filters)
-
-        self.env.globals.update(
-            url=resolve_url,
-            resolve_url=resolve_url,
-            inline_css=inline_css,
-            shape=shape,
-            width=width,
-            height=height,
-        )
-        self.env.globals.update(self.config.extensions.template_functions)
-        self.env.tests.update(self.config.extensions.template_tests)
+        # if set, only pages with these path_refs are rendered
+        self.only = only
+        # if set, (page, template, content time, markdown time, layout time, {theme template: time}) is appended
+        # for each page rendered
+        self.timings = timings
+        self.template_timer = None
+
+        self.md = MarkdownCache(Markdown(HarrierHtmlRenderer(), extensions=MD_EXTENSIONS), self.config)
+
+        theme = theme or theme_loader(self.config)
+        if timings is not None:
+            self.template_timer = TemplateTimer()
+            theme = TimedLoader(theme, self.template_timer)
+        loader = ChoiceLoader([ContentLoader(self.som['pages']), theme])
+        self.env = template_env(self.config, loader, self.md, TemplateCache(self.config))
         self.checked_dirs = set()
-        self.to_gen = []
-        self.to_copy = []
+        self.writer: OutputWriter = None
+        self.generated = 0
+        self.copied = 0
 
     def run(self):
-        for p in self.som['pages'].values():
-            self.render_file(p)
-
-        for outfile, content in self.to_gen:
-            outfile.write_bytes(content)
-        for infile, outfile in self.to_copy:
-            shutil.copy(infile, outfile)
-        gen, copy = len(self.to_gen), len(self.to_copy)
-
-        logger.debug('generated %d files, copied %d files', gen, copy)
-        return self.build_cache, gen + copy
-
-    def render_file(self, data):
+        # HIGHLIGHT_CACHE lives as long as the process so only counts from this render are logged
+        highlight_hits, highlight_misses = HIGHLIGHT_CACHE.hits, HIGHLIGHT_CACHE.misses
+        with OutputWriter() as self.writer:
+            for path_ref, p in self.som['pages'].items():
+                if self.only is None or path_ref in self.only:
+                    self.render_file(path_ref, p)
+
+        logger.debug('generated %d files, copied %d files, markdown cache: %d hits, %d misses, '
+                     'highlight cache: %d hits, %d misses', self.generated, self.copied, self.md.hits, self.md.misses,
+                     HIGHLIGHT_CACHE.hits - highlight_hits, HIGHLIGHT_CACHE.misses - highlight_misses)
+        return self.build_cache, self.generated + self.copied
+
+    def render_file(self, path_ref: str, data: dict):
         if not data.get('output', True):
             return
 
@@ -106,33 +192,45 @@ class Renderer:
 
         infile: Path = data['infile']
         if 'template' in data:
-            return self.render_template(data, infile, outfile)
+            return self.render_template(path_ref, data, infile, outfile)
         else:
             return self.copy_file(infile, outfile)
 
-    def render_template(self, data: dict, infile: Path, outfile: Path):
+    def render_template(self, path_ref: str, data: dict, infile: Path, outfile: Path):
         template_file = data['template']
+        if self.template_timer:
+            self.template_timer.times = {}
         try:
-            content_template = self.env.get_template(str(data['content_template']))
-            content = content_template.render(page=data, **self.som)
+            t0 = perf_counter()
+            with span('content template', 'page', page=infile):
+                content_template = self.env.get_template(path_ref)
+                content = content_template.render(page=data, **self.som)
 
-            content = split_content(content)
+                content = split_content(content)
 
+            t1 = perf_counter()
             if infile.suffix == '.md':
-                if isinstance(content, dict):
-                    content = {k: self._md_content(v) for k, v in content.items()}
-                elif isinstance(content, list):
-                    content = [self._md_content(v) for v in content]
-                else:
-                    # assumes content is a str
-                    content = self.md(content)
-
+                with span('markdown', 'page', page=infile):
+                    if isinstance(content, dict):
+                        content = {k: self._md_content(v) for k, v in content.items()}
+                    elif isinstance(content, list):
+                        content = [self._md_content(v) for v in content]
+                    else:
+                        # assumes content is a str
+                        content = self.md(content)
+
+            t2 = perf_counter()
             if template_file:
-                template = self.env.get_template(template_file)
-                rendered = template.render(content=content, page=data, **self.som)
+                with span('layout template', 'page', page=infile, template=template_file):
+                    template = self.env.get_template(template_file)
+                    rendered = template.render(content=content, page=data, **self.som)
             else:
                 rendered = content
             rendered = rendered.rstrip(' \t\r\n') + '\n'
+            if self.timings is not None:
+                self.timings.append(
+                    (path_ref, template_file, t1 - t0, t2 - t1, perf_counter() - t2, self.template_timer.times)
+                )
         except Exception as e:
             logger.exception('%s: error rendering page', infile)
             raise HarrierProblem(f'{e.__class__.__name__}: {e}') from e
@@ -145,7 +243,8 @@ class Renderer:
                     return
                 else:
                     self.build_cache[infile] = out_hash
-            self.to_gen.append((outfile, rendered_b))
+            self.writer.write(outfile, rendered_b)
+            self.generated += 1
 
     def _md_content(self, v):
         v['content'] = self.md(v['content'])
@@ -159,7 +258,303 @@ class Renderer:
                 return
             else:
                 self.build_cache[infile] = mtime
-        self.to_copy.append((infile, outfile))
+        self.writer.copy(infile, outfile)
+        self.copied += 1
+
+
+def template_env(config: Config, loader: BaseLoader, md, bytecode_cache=None) -> Environment:
+    env = Environment(loader=loader, extensions=JINJA_EXTENSIONS, bytecode_cache=bytecode_cache)
+    env.filters.update(
+        glob=page_glob,
+        slugify=slugify,
+        format=format_filter,
+        tojson=json_filter,
+        debug=debug_filter,
+        markdown=md,
+        paginate=paginate_filter,
+    )
+    env.filters.update(config.extensions.template_filters)
+
+    env.globals.update(
+        url=resolve_url,
+        resolve_url=resolve_url,
+        inline_css=inline_css,
+        shape=shape,
+        width=width,
+        height=height,
+    )
+    env.globals.update(config.extensions.template_functions)
+    env.tests.update(config.extensions.template_tests)
+    return env
+
+
+def compile_fingerprint(config: Config):
+    """
+    Hash of everything apart from template source which affects compiled templates.
+    """
+    h = hashlib.md5(f'{VERSION} {jinja2.__version__}'.encode())
+    if config.extensions.path.is_file():
+        h.update(config.extensions.path.read_bytes())
+    return h
+
+
+def theme_fingerprint(config: Config) -> str:
+    h = compile_fingerprint(config)
+    templates_dir = config.theme_dir / 'templates'
+    for p in sorted(templates_dir.glob('**/*')):
+        if p.is_file():
+            h.update(p.relative_to(templates_dir).as_posix().encode())
+            h.update(p.read_bytes())
+    return h.hexdigest()
+
+
+COMPILED_THEME_DIR = 'compiled-theme'
+FINGERPRINT_FILE = 'fingerprint'
+
+
+def theme_loader(config: Config) -> BaseLoader:
+    """
+    Load theme templates compiled by compile_theme if they're up to date, otherwise from the theme directory.
+    """
+    templates_dir = config.theme_dir / 'templates'
+    compiled_dir = config.get_cache_dir() / COMPILED_THEME_DIR
+    fingerprint_file = compiled_dir / FINGERPRINT_FILE
+    if fingerprint_file.exists():
+        if fingerprint_file.read_text() == theme_fingerprint(config):
+            logger.debug('loading compiled templates from "%s"', compiled_dir)
+            return ModuleLoader(str(compiled_dir))
+        logger.debug('theme changed since templates were compiled, ignoring compiled templates')
+    logger.debug('template directory: %s', templates_dir)
+    return FileSystemLoader(str(templates_dir))
+
+
+@traced
+def compile_theme(config: Config):
+    """
+    Compile theme templates to python modules, the renderer imports these instead of parsing templates until any
+    theme template changes.
+    """
+    start = time()
+    compiled_dir = config.get_cache_dir() / COMPILED_THEME_DIR
+    fingerprint = theme_fingerprint(config)
+    md = Markdown(HarrierHtmlRenderer(), extensions=MD_EXTENSIONS)
+    env = template_env(config, FileSystemLoader(str(config.theme_dir / 'templates')), md)
+    names = env.list_templates()
+
+    # compile to a new directory then rename so the renderer never sees partially compiled templates
+    new_dir = compiled_dir.with_name(f'{COMPILED_THEME_DIR}-{os.getpid()}')
+    shutil.rmtree(new_dir, ignore_errors=True)
+    try:
+        env.compile_templates(str(new_dir), zip=None, ignore_errors=False)
+    except TemplateSyntaxError as e:
+        shutil.rmtree(new_dir, ignore_errors=True)
+        logger.error('%s:%s error compiling template: %s', e.filename, e.lineno, e.message)
+        raise HarrierProblem(f'error compiling template "{e.name}"') from e
+    (new_dir / FINGERPRINT_FILE).write_text(fingerprint)
+    shutil.rmtree(compiled_dir, ignore_errors=True)
+    new_dir.rename(compiled_dir)
+    log_complete(start, 'templates compiled', len(names))
+
+
+class ContentLoader(BaseLoader):
+    """
+    Load page content templates from the site object model by path_ref, theme template names never start with a
+    slash so they can't clash.
+    """
+    def __init__(self, pages: dict):
+        self.pages = pages
+
+    def get_source(self, environment, template):
+        page = self.pages.get(template)
+        if page is None or ('content' not in page and 'content_offset' not in page):
+            raise TemplateNotFound(template)
+        # environments only live for one render so templates never need reloading
+        return page_content(page), str(page['infile']), lambda: True
+
+
+class TemplateTimer:
+    """
+    Time spent rendering each theme template excluding time spent in templates it extends, includes or imports,
+    blocks are charged to the template which defines them and macros to the template which calls them.
+    """
+    __slots__ = 'times', 'stack'
+
+    def __init__(self):
+        # template name: seconds, replaced for each page rendered
+        self.times = {}
+        # time spent in nested templates during each render step currently running
+        self.stack = []
+
+    def instrument(self, template: Template) -> Template:
+        name = template.name
+        template.root_render_func = self._wrap(name, template.root_render_func)
+        template.blocks = {k: self._wrap(name, f) for k, f in template.blocks.items()}
+        return template
+
+    def _wrap(self, name, render_func):
+        def timed_render_func(*args, **kwargs):
+            gen = render_func(*args, **kwargs)
+            while True:
+                self.stack.append(0)
+                start = perf_counter()
+                try:
+                    event = next(gen)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed = perf_counter() - start
+                    self.times[name] = self.times.get(name, 0) + elapsed - self.stack.pop()
+                    if self.stack:
+                        self.stack[-1] += elapsed
+                yield event
+        return timed_render_func
+
+
+class TimedLoader(BaseLoader):
+    """
+    Wrap a loader so every template it loads records its render time with a TemplateTimer.
+    """
+    def __init__(self, loader: BaseLoader, timer: TemplateTimer):
+        self.loader = loader
+        self.timer = timer
+
+    def get_source(self, environment, template):
+        return self.loader.get_source(environment, template)
+
+    def load(self, environment, name, globals=None):
+        return self.timer.instrument(self.loader.load(environment, name, globals))
+
+
+class TemplateCache(FileSystemBytecodeCache):
+    """
+    Compiled templates persisted in the cache directory between builds. Keys include the harrier and jinja versions
+    and extensions since they all affect compilation, jinja itself checks a hash of the template source.
+    """
+    def __init__(self, config: Config):
+        directory = config.get_cache_dir() / 'templates'
+        directory.mkdir(parents=True, exist_ok=True)
+        super().__init__(str(directory))
+        self.prefix = compile_fingerprint(config).hexdigest()
+
+    def get_cache_key(self, name, filename=None):
+        return super().get_cache_key(f'{self.prefix}:{name}', filename)
+
+    def dump_bytecode(self, bucket):
+        # write then rename so other processes never read a partially written file
+        path = self._get_cache_filename(bucket)
+        tmp_path = f'{path}.{os.getpid()}'
+        with open(tmp_path, 'wb') as f:
+            bucket.write_bytecode(f)
+        os.replace(tmp_path, path)
+
+
+# number of rendered markdown documents kept in memory by each process
+MD_CACHE_SIZE = 2048
+# rendered markdown by key, kept between renders so dev rebuilds can reuse it, most recently used last
+MD_CACHE = OrderedDict()
+# number of rendered markdown documents kept in the cache directory, see prune_markdown_cache
+MD_DISK_CACHE_SIZE = 100000
+MD_CACHE_DIR = 'markdown'
+
+
+@lru_cache(maxsize=None)
+def md_versions() -> str:
+    """
+    Versions of misaka and pygments since both affect the html generated from markdown, misaka has no __version__.
+    """
+    # pkg_resources and pygments are slow to import so they're only imported when required
+    import pkg_resources
+    import pygments
+
+    try:
+        misaka_version = pkg_resources.get_distribution('misaka').version
+    except pkg_resources.DistributionNotFound:  # pragma: no cover
+        misaka_version = 'unknown'
+    return f'misaka {misaka_version} pygments {pygments.__version__}'
+
+
+class MarkdownCache:
+    """
+    Render markdown with the output cached by a hash of the source and everything which affects rendering. Output
+    is kept in memory and, if config.markdown_cache is set, in the cache directory between builds.
+    """
+    __slots__ = 'md', 'prefix', 'directory', 'hits', 'misses'
+
+    def __init__(self, md: Markdown, config: Config):
+        self.md = md
+        prefix = f'{VERSION}:{HarrierHtmlRenderer.version}:{",".join(MD_EXTENSIONS)}:'
+        self.directory = None
+        if config.markdown_cache:
+            self.directory = config.get_cache_dir() / MD_CACHE_DIR
+            # only needed when output outlives the process since finding versions imports pygments
+            prefix += f'{md_versions()}:'
+        self.prefix = prefix.encode()
+        self.hits = self.misses = 0
+
+    def __call__(self, text: str) -> str:
+        key = hashlib.md5(self.prefix + text.encode()).hexdigest()
+        html = MD_CACHE.get(key)
+        if html is not None:
+            MD_CACHE.move_to_end(key)
+            self.hits += 1
+            return html
+
+        path = self.directory and self.directory / key[:2] / key[2:]
+        try:
+            html = path and path.read_text()
+            # the modification time records when markdown was last used so pruning removes the least recently used
+            path and os.utime(path)
+        except FileNotFoundError:
+            pass
+        if html is None:
+            self.misses += 1
+            html = self.md(text)
+            path and self._write(path, html)
+        else:
+            self.hits += 1
+
+        MD_CACHE[key] = html
+        if len(MD_CACHE) > MD_CACHE_SIZE:
+            MD_CACHE.popitem(last=False)
+        return html
+
+    @staticmethod
+    def _write(path: Path, html: str):
+        # write then rename so other processes never read a partially written file
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}')
+        tmp_path.write_text(html)
+        os.replace(tmp_path, path)
+
+
+def prune_markdown_cache(config: Config):
+    """
+    Remove the least recently used markdown from the cache directory when it holds more than MD_DISK_CACHE_SIZE
+    documents, otherwise every edit to a page would add a file for good.
+    """
+    directory = config.get_cache_dir() / MD_CACHE_DIR
+    if not directory.is_dir():
+        return
+    paths = []
+    for sub_dir in directory.iterdir():
+        if sub_dir.is_dir():
+            paths.extend(sub_dir.iterdir())
+    if len(paths) <= MD_DISK_CACHE_SIZE:
+        return
+
+    def last_used(p: Path):
+        try:
+            return p.stat().st_mtime
+        except FileNotFoundError:
+            return 0
+
+    paths.sort(key=last_used)
+    for p in paths[:len(paths) - MD_DISK_CACHE_SIZE]:
+        try:
+            p.unlink()
+        except FileNotFoundError:
+            pass
+    logger.debug('markdown cache pruned, removed %d files', len(paths) - MD_DISK_CACHE_SIZE)
 
 
 DL_REGEX = re.compile('<li>(.*?)::(.*?)</li>', re.S)
@@ -167,20 +562,78 @@ LI_REGEX = re.compile('<li>(.*?)</li>', re.S)
 MD_EXTENSIONS = 'fenced-code', 'strikethrough', 'no-intra-emphasis', 'tables'
 
 
-class HarrierHtmlRenderer(HtmlRenderer):
-    @staticmethod
-    def blockcode(text, lang):
+# number of highlighted code blocks kept in memory by each process
+HIGHLIGHT_CACHE_SIZE = 1024
+
+
+class HighlightCache:
+    """
+    Highlighted code blocks memoised by language and a hash of the code, pygments lexers and the formatter are
+    created once and reused. hits and misses count lookups of highlighted code.
+    """
+    __slots__ = 'lexers', 'formatter', 'output', 'hits', 'misses'
+
+    def __init__(self):
+        self.lexers = {}
+        self.formatter = None
+        self.output = OrderedDict()
+        self.hits = self.misses = 0
+
+    def __call__(self, text: str, lang: str) -> str:
+        key = lang, hashlib.md5(text.encode()).digest()
+        html = self.output.get(key)
+        if html is not None:
+            self.output.move_to_end(key)
+            self.hits += 1
+            return html
+
+        self.misses += 1
+        html = self._blockcode(text, lang)
+        self.output[key] = html
+        if len(self.output) > HIGHLIGHT_CACHE_SIZE:
+            self.output.popitem(last=False)
+        return html
+
+    def _blockcode(self, text: str, lang: str) -> str:
+        lexer = self._lexer(lang)
+        if lexer:
+            # pygments is only imported when a page contains a code block
+            from pygments import highlight
+            from pygments.formatters.html import HtmlFormatter
+
+            if self.formatter is None:
+                self.formatter = HtmlFormatter(cssclass='hi')
+            return highlight(text, lexer, self.formatter)
+
+        code = escape_html(text.strip())
+        return f'<pre><code>{code}</code></pre>\n'
+
+    def _lexer(self, lang: str):
+        try:
+            return self.lexers[lang]
+        except KeyError:
+            pass
+        from pygments.lexers import get_lexer_by_name
+        from pygments.util import ClassNotFound
+
         try:
             lexer = get_lexer_by_name(lang, stripall=True)
         except ClassNotFound:
             lexer = None
+        self.lexers[lang] = lexer
+        return lexer
 
-        if lexer:
-            formatter = HtmlFormatter(cssclass='hi')
-            return highlight(text, lexer, formatter)
 
-        code = escape_html(text.strip())
-        return f'<pre><code>{code}</code></pre>\n'
+HIGHLIGHT_CACHE = HighlightCache()
+
+
+class HarrierHtmlRenderer(HtmlRenderer):
+    # change when output changes to invalidate cached markdown
+    version = 1
+
+    @staticmethod
+    def blockcode(text, lang):
+        return HIGHLIGHT_CACHE(text, lang)
 
     @staticmethod
     def list(content, is_ordered, is_block):
@@ -213,25 +666,36 @@ def resolve_url(ctx, path):
     return resolve_path(path, ctx['path_lookup'], ctx['config'])
 
 
+SOURCE_MAP_REGEX = re.compile(r'/\*# sourceMappingURL=.*\*/')
+# processed css by path with the mtime it was read at, cleared at the start of each render
+INLINE_CSS_CACHE = {}
+
+
 @contextfunction
 def inline_css(ctx, path):
     path = resolve_path(path, ctx['path_lookup'], None)
     real_path = Path(path[1:])
     config: Config = ctx['config']
     p = config.dist_dir / real_path
+    mtime = p.stat().st_mtime_ns
+    cached = INLINE_CSS_CACHE.get(p)
+    if cached and cached[0] == mtime:
+        return cached[1]
     css = p.read_text()
     map_path = real_path.with_suffix('.css.map')
     if (config.dist_dir / map_path).exists():
-        css = re.sub(r'/\*# sourceMappingURL=.*\*/', f'/*# sourceMappingURL=/{map_path} */', css)
-    return css.strip('\r\n ')
+        css = SOURCE_MAP_REGEX.sub(f'/*# sourceMappingURL=/{map_path} */', css)
+    css = css.strip('\r\n ')
+    INLINE_CSS_CACHE[p] = mtime, css
+    return css
 
 
 def page_glob(pages, *globs, test='path'):
     assert test in ('uri', 'path'), 'the "test" argument should be either "uri" or "path"'
-    matches = globs and [PathMatch(glob) for glob in globs]
+    matches = PathMatchSet(PathMatch(glob) for glob in globs)
     for k, page in pages.items():
         glob_key = k if test == 'path' else page['uri']
-        if any(match(glob_key) for match in matches):
+        if matches(glob_key):
             yield page
 
 
@@ -239,22 +703,95 @@ def format_filter(s, *args, **kwargs):
     return s.format(*args, **kwargs)
 
 
-IMAGE_SIZE_CACHE = {}
 Shape = namedtuple('Shape', ['width', 'height'])
+IMAGE_SIZES_FILE = 'image-sizes.json'
+# number of image sizes kept, least recently used are discarded first
+IMAGE_SIZE_CACHE_SIZE = 10000
+
+
+class ImageSizeCache:
+    """
+    Image sizes keyed by (path, size, mtime) with least recently used entries discarded, persisted in the cache
+    directory between builds. Each image is only stat'd once per render, sizes found by render workers are returned
+    to the main process to be saved.
+    """
+    __slots__ = 'path', 'sizes', 'checked', 'new'
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.sizes = OrderedDict()
+        # sizes of images already checked in this render by path
+        self.checked = {}
+        # sizes added since the cache was last saved
+        self.new = {}
+
+    @classmethod
+    def load(cls, path: Path) -> 'ImageSizeCache':
+        cache = cls(path)
+        try:
+            data = json.loads(path.read_text())
+            sizes = [((p, size, mtime), Shape(w, h)) for p, size, mtime, w, h in data]
+        except FileNotFoundError:
+            pass
+        except (TypeError, ValueError) as e:
+            logger.warning('error loading image size cache "%s", ignoring it: %s', path, e)
+        else:
+            cache.sizes.update(sizes)
+        return cache
+
+    def get(self, path: Path) -> Shape:
+        v = self.checked.get(path)
+        if v:
+            return v
+        stat = path.stat()
+        key = str(path), stat.st_size, stat.st_mtime_ns
+        v = self.sizes.get(key)
+        if v:
+            self.sizes.move_to_end(key)
+        else:
+            from PIL import Image
+
+            with Image.open(path) as image:
+                v = Shape(*image.size)
+            self.add(key, v)
+        self.checked[path] = v
+        return v
+
+    def add(self, key, v: Shape):
+        self.sizes[key] = self.new[key] = v
+        self.sizes.move_to_end(key)
+        if len(self.sizes) > IMAGE_SIZE_CACHE_SIZE:
+            self.sizes.popitem(last=False)
+
+    def save(self):
+        if not self.new:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # write then rename so other processes never read a partially written file
+        tmp_path = self.path.with_name(f'{self.path.name}.{os.getpid()}')
+        tmp_path.write_text(json.dumps([[*key, *v] for key, v in self.sizes.items()]))
+        os.replace(tmp_path, self.path)
+        self.new = {}
+
+
+# IMAGE_SIZE_CACHE is loaded before the fork so render workers share it
+IMAGE_SIZE_CACHE: ImageSizeCache = None
+
+
+def image_size_cache(config: Config) -> ImageSizeCache:
+    global IMAGE_SIZE_CACHE
+    path = config.get_cache_dir() / IMAGE_SIZES_FILE
+    if IMAGE_SIZE_CACHE is None or IMAGE_SIZE_CACHE.path != path:
+        IMAGE_SIZE_CACHE = ImageSizeCache.load(path)
+    return IMAGE_SIZE_CACHE
 
 
 @contextfunction
 def shape(ctx, path):
-    global IMAGE_SIZE_CACHE
     config: Config = ctx['config']
     path = resolve_path(path, ctx['path_lookup'], None)
     path = config.dist_dir / Path(path[1:])
-    cache_key = f'{path}:{path.stat().st_mtime}'
-    v = IMAGE_SIZE_CACHE.get(cache_key)
-    if not v:
-        v = Shape(*Image.open(path).size)
-        IMAGE_SIZE_CACHE[cache_key] = v
-    return v
+    return (IMAGE_SIZE_CACHE or image_size_cache(config)).get(path)
 
 
 @contextfunction
@@ -309,6 +846,8 @@ STYLES = 'white-space:pre-wrap;background:#444;color:white;border-radius:5px;pad
 
 
 def debug_filter(c, html=True):
+    from devtools import debug, pformat
+
     output = f'{pformat(debug.format(c).arguments[0].value)} (type={c.__class__.__name__} length={lenient_len(c)})'
     if html:
         output = f'<pre style="{STYLES}">\n{escape(output, quote=False)}\n</pre>'
@@ -327,3 +866,6 @@ class MarkdownExtension(Extension):
         s = dedent(caller().strip('\r\n'))
         md = self.environment.filters['markdown']
         return md(s)
+
+
+JINJA_EXTENSIONS = 'jinja2.ext.loopcontrols', MarkdownExtension
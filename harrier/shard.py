@@ -0,0 +1,94 @@
+import hashlib
+import json
+import logging
+import re
+from pathlib import Path
+from typing import Dict, Iterable, Tuple
+
+from .common import HarrierProblem
+from .config import Config
+from .render import get_outfile
+from .writer import sync_files
+
+logger = logging.getLogger('harrier.shard')
+# list of files each shard contributes to the merged site, written to the shard's dist directory
+SHARD_FILES = '.shard-files.json'
+SHARD_DIR_REGEX = re.compile(r'-shard-(\d+)-of-(\d+)$')
+# the first shard builds theme assets, sass and webpack output
+ASSET_SHARD = 1
+Shard = Tuple[int, int]
+
+
+def parse_shard(s: str) -> Shard:
+    m = re.fullmatch(r'(\d+)/(\d+)', s)
+    if not m:
+        raise ValueError(f'shard should be in the form "index/count", not "{s}"')
+    index, count = map(int, m.groups())
+    if not 1 <= index <= count:
+        raise ValueError(f'shard index must be between 1 and {count}')
+    return index, count
+
+
+def shard_dist_dir(dist_dir: Path, shard: Shard) -> Path:
+    return dist_dir.with_name(f'{dist_dir.name}-shard-{shard[0]}-of-{shard[1]}')
+
+
+def in_shard(path_ref: str, shard: Shard) -> bool:
+    """
+    Deterministically assign pages to shards using a hash of path_ref, unlike hash() this is stable across processes.
+    """
+    h = int.from_bytes(hashlib.md5(path_ref.encode()).digest()[:8], 'big')
+    return h % shard[1] == shard[0] - 1
+
+
+def write_shard_files(config: Config, shard: Shard, pages: Iterable[dict]):
+    """
+    Record which files in dist_dir this shard contributes: its pages and, for the asset shard, everything else.
+    """
+    dist_dir = config.dist_dir
+    if shard[0] == ASSET_SHARD:
+        files = {str(p.relative_to(dist_dir)) for p in dist_dir.glob('**/*') if p.is_file()}
+        files.discard(SHARD_FILES)
+    else:
+        files = {
+            str(get_outfile(page, config).relative_to(dist_dir)) for page in pages if page.get('output', True)
+        }
+    (dist_dir / SHARD_FILES).write_text(json.dumps(sorted(files), indent=2))
+    logger.info('shard %d/%d: %d files', shard[0], shard[1], len(files))
+
+
+def merge_shards(config: Config):
+    """
+    Combine the output of all shards into dist_dir, fails if any shard is missing or two shards wrote the same file.
+    """
+    dist_dir = config.dist_dir
+    shards = {}
+    for d in dist_dir.parent.glob(f'{dist_dir.name}-shard-*-of-*'):
+        m = SHARD_DIR_REGEX.search(d.name)
+        if m and d.is_dir():
+            shards[tuple(map(int, m.groups()))] = d
+    if not shards:
+        raise HarrierProblem(f'no shard directories found for "{dist_dir}"')
+
+    counts = {count for _, count in shards}
+    if len(counts) != 1:
+        raise HarrierProblem(f'shard directories from builds with different shard counts: {sorted(counts)}')
+    count = counts.pop()
+    missing = set(range(1, count + 1)) - {index for index, _ in shards}
+    if missing:
+        raise HarrierProblem(f'shards missing: {", ".join(map(str, sorted(missing)))}')
+
+    files: Dict[Path, Path] = {}
+    owners: Dict[Path, Shard] = {}
+    for shard, d in sorted(shards.items()):
+        shard_files = d / SHARD_FILES
+        if not shard_files.is_file():
+            raise HarrierProblem(f'shard {shard[0]}/{shard[1]} is incomplete, "{shard_files}" does not exist')
+        for f in json.loads(shard_files.read_text()):
+            rel_path = Path(f)
+            if rel_path in owners:
+                other = owners[rel_path]
+                raise HarrierProblem(f'"{f}" written by both shard {other[0]}/{count} and shard {shard[0]}/{count}')
+            owners[rel_path] = shard
+            files[rel_path] = d / rel_path
+    return sync_files(files, dist_dir)
@@ -0,0 +1,141 @@
+import hashlib
+import logging
+import re
+from pathlib import Path
+from typing import Dict, FrozenSet, Set
+
+from jinja2 import Environment, TemplateSyntaxError, meta
+
+from .build import page_content
+from .config import Config
+from .render import JINJA_EXTENSIONS
+
+logger = logging.getLogger('harrier.templates')
+# used in place of a template name when a template is chosen dynamically and could therefore be any template
+ANY_TEMPLATE = '*'
+# template functions and variables which read assets from dist_dir
+ASSET_NAMES = 'url', 'resolve_url', 'inline_css', 'shape', 'width', 'height', 'path_lookup'
+
+
+class TemplateGraph:
+    """
+    Graph of "extends", "include" and "import" references between theme templates, used to find which pages
+    need re-rendering when templates change.
+    """
+    __slots__ = (
+        'templates_dir', 'env', 'refs', 'hashes', 'asset_templates', '_asset_regex', '_closures', '_content_refs'
+    )
+
+    def __init__(self, config: Config):
+        self.templates_dir: Path = config.theme_dir / 'templates'
+        self.env = Environment(extensions=JINJA_EXTENSIONS)
+        self.refs: Dict[str, FrozenSet[str]] = {}
+        self.hashes: Dict[str, str] = {}
+        # templates which might reference assets, extension functions, filters and tests are included since they
+        # might be context functions which read assets
+        self.asset_templates: Set[str] = set()
+        names = ASSET_NAMES
+        for ext_type in ('template_functions', 'template_filters', 'template_tests'):
+            names += tuple(getattr(config.extensions, ext_type, ()))
+        self._asset_regex = re.compile(r'\b(?:%s)\b' % '|'.join(re.escape(n) for n in names))
+        self._closures = {}
+        # infile: (content hash, refs) so page content is only parsed again if it changes
+        self._content_refs = {}
+        self.refresh()
+
+    def refresh(self):
+        """
+        (Re)parse all theme templates, this is cheap compared to rendering pages.
+        """
+        self.refs, self.hashes, self.asset_templates, self._closures = {}, {}, set(), {}
+        if not self.templates_dir.is_dir():
+            return
+        for p in sorted(self.templates_dir.glob('**/*')):
+            if p.is_file():
+                name = p.relative_to(self.templates_dir).as_posix()
+                source = p.read_bytes()
+                self.hashes[name] = hashlib.md5(source).hexdigest()
+                try:
+                    source = source.decode()
+                except UnicodeDecodeError:
+                    self.refs[name] = frozenset()
+                else:
+                    self.refs[name] = self.find_refs(source)
+                    if self._asset_regex.search(source):
+                        self.asset_templates.add(name)
+        logger.debug('template graph built from %d templates', len(self.refs))
+
+    def find_refs(self, source: str) -> FrozenSet[str]:
+        try:
+            ast = self.env.parse(source)
+        except TemplateSyntaxError:
+            # rendering will fail anyway, assume the template could reference anything
+            return frozenset([ANY_TEMPLATE])
+        return frozenset(ANY_TEMPLATE if ref is None else ref for ref in meta.find_referenced_templates(ast))
+
+    def closure(self, name: str) -> Set[str]:
+        """
+        Find the template and all templates it references directly or indirectly.
+        """
+        deps = self._closures.get(name)
+        if deps is None:
+            deps = set()
+            stack = [name]
+            while stack:
+                n = stack.pop()
+                if n in deps:
+                    continue
+                deps.add(n)
+                if n == ANY_TEMPLATE:
+                    deps.update(self.refs)
+                else:
+                    stack.extend(self.refs.get(n, ()))
+            self._closures[name] = deps
+        return deps
+
+    def content_refs(self, page: dict, content: str=None) -> FrozenSet[str]:
+        """
+        Templates referenced by a page's content, content may be passed if it's already been read.
+        """
+        if content is None:
+            content = self._content(page)
+        if not content or '{%' not in content:
+            return frozenset()
+        infile = page['infile']
+        content_hash = hashlib.md5(content.encode()).digest()
+        cached = self._content_refs.get(infile)
+        if cached and cached[0] == content_hash:
+            return cached[1]
+        refs = self.find_refs(content)
+        self._content_refs[infile] = content_hash, refs
+        return refs
+
+    def page_deps(self, page: dict, content_refs: FrozenSet[str]=None) -> Set[str]:
+        """
+        Find all templates used to render a page: its layout template and any templates its content references.
+        """
+        if content_refs is None:
+            content_refs = self.content_refs(page)
+        template = page.get('template')
+        deps = set(self.closure(template)) if template else set()
+        for ref in content_refs:
+            deps |= self.closure(ref)
+        return deps
+
+    def uses_assets(self, page: dict) -> bool:
+        """
+        Whether a page might reference assets either in its content or any template it uses.
+        """
+        # content is read once here, lazy content would otherwise be read from disk again by content_refs
+        content = self._content(page)
+        if content and '{' in content and self._asset_regex.search(content):
+            return True
+        return not self.asset_templates.isdisjoint(self.page_deps(page, self.content_refs(page, content)))
+
+    @staticmethod
+    def _content(page: dict) -> str:
+        if 'content' in page or 'content_offset' in page:
+            return page_content(page)
+
+    def affected_pages(self, pages: dict, changed: Set[str]) -> Set[str]:
+        return {path_ref for path_ref, page in pages.items() if not changed.isdisjoint(self.page_deps(page))}
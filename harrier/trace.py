@@ -0,0 +1,111 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+from time import time
+
+logger = logging.getLogger('harrier.trace')
+
+# TRACE_DIR is set before any forks so child processes also record events, each process writes its events to
+# its own file in TRACE_DIR which are merged by finish_trace
+TRACE_DIR: Path = None
+_local = threading.local()
+_write_lock = threading.Lock()
+
+
+def start_trace():
+    global TRACE_DIR
+    TRACE_DIR = Path(tempfile.mkdtemp(prefix='harrier-trace-'))
+
+
+@contextmanager
+def span(name, cat='build', **args):
+    """
+    Record a "complete" trace event covering the body of the with statement, events are written to disk when
+    the outermost span in a thread finishes.
+    """
+    if TRACE_DIR is None:
+        yield
+        return
+    state = _get_state()
+    state.depth += 1
+    start = time()
+    try:
+        yield
+    finally:
+        state.depth -= 1
+        state.events.append({
+            'name': name,
+            'cat': cat,
+            'ph': 'X',
+            'ts': int(start * 1e6),
+            'dur': int((time() - start) * 1e6),
+            'pid': state.pid,
+            'tid': threading.get_ident(),
+            'args': args,
+        })
+        if state.depth == 0:
+            _flush(state)
+
+
+def traced(f):
+    """
+    Decorator to record a span for every call of the function.
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        with span(f.__name__):
+            return f(*args, **kwargs)
+    return wrapper
+
+
+def _get_state():
+    """
+    Get span depth and unwritten events for this thread, these are reset after a fork so a child process doesn't
+    write its parent's events.
+    """
+    pid = os.getpid()
+    if getattr(_local, 'pid', None) != pid:
+        _local.pid, _local.depth, _local.events = pid, 0, []
+    return _local
+
+
+def _flush(state):
+    with _write_lock, (TRACE_DIR / f'{state.pid}.jsonl').open('a') as f:
+        for event in state.events:
+            f.write(json.dumps(event, default=str) + '\n')
+    state.events.clear()
+
+
+def finish_trace(path: Path):
+    """
+    Merge events from all processes and write them in chrome trace event format, the output can be viewed in
+    chrome://tracing or https://ui.perfetto.dev.
+    """
+    global TRACE_DIR
+    if TRACE_DIR is None:
+        return
+    state = _get_state()
+    state.events and _flush(state)
+    main_pid = os.getpid()
+    events = []
+    for p in TRACE_DIR.glob('*.jsonl'):
+        pid = int(p.stem)
+        events.append({
+            'name': 'process_name',
+            'ph': 'M',
+            'pid': pid,
+            'args': {'name': 'harrier' if pid == main_pid else f'harrier worker {pid}'},
+        })
+        with p.open() as f:
+            events.extend(json.loads(line) for line in f)
+    path = Path(path)
+    path.write_text(json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}))
+    shutil.rmtree(TRACE_DIR)
+    TRACE_DIR = None
+    logger.info('trace with %d events written to "%s"', len(events), path)
@@ -0,0 +1,116 @@
+import filecmp
+import logging
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import time
+from typing import Dict
+
+from .common import HarrierProblem, log_complete
+from .trace import span
+
+logger = logging.getLogger('harrier.writer')
+WRITER_THREADS = 4
+# maximum number of files waiting to be written before rendering blocks, this bounds the memory used by
+# rendered pages which haven't been written yet
+MAX_PENDING = 64
+
+
+class OutputWriter:
+    """
+    Write rendered pages and copy files on a pool of threads while rendering continues.
+
+    Use as a context manager, leaving the context waits for all writes to finish and raises the first error.
+    """
+    __slots__ = 'executor', 'slots', 'errors'
+
+    def __init__(self, threads: int=WRITER_THREADS, max_pending: int=MAX_PENDING):
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='harrier-writer')
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.errors = []
+
+    def write(self, outfile: Path, content: bytes):
+        self._submit(self._write, outfile, content)
+
+    def copy(self, infile: Path, outfile: Path):
+        self._submit(self._copy, outfile, infile)
+
+    def _submit(self, func, outfile: Path, *args):
+        # blocks if too many writes are pending
+        self.slots.acquire()
+        self._check()
+        self.executor.submit(self._run, func, outfile, *args)
+
+    def _run(self, func, outfile: Path, *args):
+        try:
+            func(outfile, *args)
+        except Exception as e:
+            self.errors.append((outfile, e))
+        finally:
+            self.slots.release()
+
+    @staticmethod
+    def _write(outfile: Path, content: bytes):
+        with span('write', 'page', outfile=outfile):
+            outfile.write_bytes(content)
+
+    @staticmethod
+    def _copy(outfile: Path, infile: Path):
+        with span('copy', 'page', outfile=outfile):
+            shutil.copy(infile, outfile)
+
+    def _check(self):
+        if self.errors:
+            outfile, e = self.errors[0]
+            logger.error('%s: error writing file: %s: %s', outfile, e.__class__.__name__, e)
+            raise HarrierProblem(f'error writing "{outfile}": {e.__class__.__name__}: {e}') from e
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.executor.shutdown(wait=True)
+        if exc_type is None:
+            self._check()
+
+
+def sync_dirs(src: Path, dst: Path):
+    """
+    Update dst to match src, see sync_files.
+    """
+    return sync_files({p.relative_to(src): p for p in src.glob('**/*') if p.is_file()}, dst)
+
+
+def sync_files(files: Dict[Path, Path], dst: Path):
+    """
+    Update dst so it contains exactly files, a dict of paths relative to dst to source files. Only files whose
+    content has changed are written so unchanged files keep their mtime and inode, other files in dst are deleted.
+    """
+    start = time()
+    added, changed, removed = 0, 0, 0
+    with OutputWriter() as writer:
+        for rel_path, p in files.items():
+            target = dst / rel_path
+            if target.is_file():
+                if filecmp.cmp(p, target, shallow=False):
+                    continue
+                changed += 1
+            else:
+                if target.is_dir():
+                    shutil.rmtree(target)
+                target.parent.mkdir(parents=True, exist_ok=True)
+                added += 1
+            writer.copy(p, target)
+
+    # reversed so directories' contents come before the directory itself
+    for p in sorted(dst.glob('**/*'), reverse=True):
+        if p.is_dir() and not p.is_symlink():
+            if not any(p.iterdir()):
+                p.rmdir()
+        elif p.relative_to(dst) not in files:
+            p.unlink()
+            removed += 1
+    log_complete(start, 'files synced', added + changed + removed)
+    logger.info('dist sync: %d added, %d changed, %d removed', added, changed, removed)
+    return added, changed, removed
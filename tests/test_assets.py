@@ -8,7 +8,8 @@ from pydantic import ValidationError
 from pytest_toolbox import gettree, mktree
 from pytest_toolbox.comparison import RegexStr
 
-from harrier.assets import assets_grablib, copy_assets, run_grablib, run_webpack, start_webpack_watch
+from harrier.assets import (_strip_hash, assets_grablib, copy_assets, run_grablib, run_webpack, start_webpack_watch,
+                            webpack_files)
 from harrier.common import HarrierProblem
 from harrier.config import Mode, get_config
 
@@ -24,8 +25,15 @@ args = ' '.join(sys.argv)
 print('foobar')
 if 'js/error.js' in args:
     sys.exit(2)
-elif 'js/nojson.js' not in args:
-    print(json.dumps(dict(assets=[1, 2, 3])))
+hash_ = '2f2e7c0a8d1b4e6f9a3c'
+out_dir = Path(sys.argv[sys.argv.index('--output-path') + 1])
+names = [sys.argv[sys.argv.index('--output-filename') + 1].replace('[hash]', hash_)]
+names += [names[0] + '.map', 'vendor.js']
+out_dir.mkdir(parents=True, exist_ok=True)
+for name in names:
+    (out_dir / name).write_text('x')
+if 'js/nojson.js' not in args:
+    print(json.dumps(dict(hash=hash_, assets=[dict(name=n) for n in names])))
 """
 
 
@@ -46,8 +54,12 @@ def test_run_webpack(tmpdir):
     webpack_path.chmod(0o777)
 
     config = get_config(str(tmpdir))
-    count = run_webpack(config)
-    assert count == 3
+    files = run_webpack(config)
+    assert files == {
+        'theme/main.js': ('theme/main.2f2e7c0a8d1b4e6f9a3c.js', RegexStr(r'\d+')),
+        'theme/main.js.map': ('theme/main.2f2e7c0a8d1b4e6f9a3c.js.map', RegexStr(r'\d+')),
+        'theme/vendor.js': ('theme/vendor.js', RegexStr(r'\d+')),
+    }
     args = json.loads(tmpdir.join('webpack_args.json').read_text('utf8'))
     assert [
         f'{tmpdir}/mock_webpack',
@@ -64,6 +76,47 @@ def test_run_webpack(tmpdir):
     assert webpack_env['NODE_ENV'] == 'production'
 
 
+@pytest.mark.parametrize('name,hashes,result', [
+    ('main.3f2a9c1d7e.js', ['aaaabbbbccccdddd'], 'main.js'),
+    ('main.3f2a9c1d7e.js', [], 'main.js'),
+    ('main.aaaa.js', ['aaaabbbbccccdddd'], 'main.js'),
+    ('main.aaaa.js', [], 'main.aaaa.js'),
+    ('main.2f2e7c0a8d1b4e6f9a3c.js.map', [], 'main.js.map'),
+    ('vendor.js', ['aaaabbbbccccdddd'], 'vendor.js'),
+    ('jquery.min.js', [], 'jquery.min.js'),
+])
+def test_strip_hash(name, hashes, result):
+    assert _strip_hash(name, hashes) == result
+
+
+def test_webpack_files_contenthash(tmpdir):
+    mktree(tmpdir, {
+        'pages/foobar.md': '# hello',
+        'dist/theme': {
+            'main.3f2a9c1d7e.js': 'x',
+            'runtime.c0ffee12.js': 'x',
+            'vendor.js': 'x',
+        },
+    })
+    config = get_config(str(tmpdir))
+    stats = {
+        'hash': 'aaaabbbbccccdddd',
+        'assets': [
+            {'name': 'main.3f2a9c1d7e.js', 'info': {'contenthash': '3f2a9c1d7e'}},
+            {'name': 'runtime.c0ffee12.js', 'info': {'chunkhash': ['c0ffee12']}},
+            {'name': 'vendor.js'},
+        ],
+    }
+    expected = {
+        'theme/main.js': ('theme/main.3f2a9c1d7e.js', RegexStr(r'\d+')),
+        'theme/runtime.js': ('theme/runtime.c0ffee12.js', RegexStr(r'\d+')),
+        'theme/vendor.js': ('theme/vendor.js', RegexStr(r'\d+')),
+    }
+    assert webpack_files(config, stats) == expected
+    # without stats, e.g. in dev mode, the same names are found
+    assert webpack_files(config) == expected
+
+
 def test_run_webpack_error(tmpdir):
     webpack_path = tmpdir.join('mock_webpack')
     mktree(tmpdir, {
@@ -121,8 +174,9 @@ def test_run_webpack_json_error(tmpdir):
     webpack_path.chmod(0o777)
 
     config = get_config(str(tmpdir))
-    count = run_webpack(config)
-    assert count == 1
+    files = run_webpack(config)
+    # no stats so the output directory is used
+    assert set(files) == {'theme/main.js', 'theme/main.js.map', 'theme/vendor.js'}
 
 
 def test_run_webpack_no_capture(tmpdir, caplog):
@@ -143,9 +197,9 @@ def test_run_webpack_no_capture(tmpdir, caplog):
 
     caplog.set_level(logging.DEBUG)
     config = get_config(str(tmpdir))
-    count = run_webpack(config)
-    # 1 because capture_output is false so no json is loaded
-    assert count == 1
+    files = run_webpack(config)
+    # capture_output is false so no json is loaded and the output directory is used
+    assert files['theme/main.js'][0] == 'theme/main.2f2e7c0a8d1b4e6f9a3c.js'
 
 
 async def test_start_webpack_watch(tmpdir, loop):
@@ -1,15 +1,20 @@
-from datetime import datetime
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from pathlib import Path
+from time import sleep
 
 import pytest
 from pydantic import ValidationError
 from pytest_toolbox import gettree, mktree
-from pytest_toolbox.comparison import CloseToNow
+from pytest_toolbox.comparison import CloseToNow, RegexStr
 
-from harrier.build import FileData, build_pages, content_templates
-from harrier.common import HarrierProblem
-from harrier.config import Config, Mode
-from harrier.main import build
+from harrier.assets import AssetManifest
+from harrier.build import FileData, PageDefaults, PlaceHolderError, build_pages, validate_page_data, walk_pages
+from harrier.common import HarrierProblem, PathMatch, PathMatchSet, norm_path_ref
+from harrier.config import Config, Mode, get_config
+from harrier.main import BuildSteps, SiteBuild, build
 from harrier.render import render_pages
 
 
@@ -29,7 +34,12 @@ def test_full_build(tmpdir):
             'assets/foobar.png': '*',
         },
     })
-    build(tmpdir, mode=Mode.production)
+    config = build(tmpdir, mode=Mode.production)['config']
+    assert json.loads(AssetManifest.get_path(config).read_text()) == {
+        'copy_assets': {'foobar.png': ['foobar.3389dae.png', RegexStr(r'\d+')]},
+        'sass': {'theme/main.css': ['theme/main.a1ac3a7.css', RegexStr(r'\d+')]},
+        'webpack': {},
+    }
     assert gettree(tmpdir.join('dist')) == {
         'foobar': {
             'index.html': (
@@ -51,6 +61,57 @@ def test_full_build(tmpdir):
     }
 
 
+def test_build_pages_asset_manifest(tmpdir):
+    mktree(tmpdir, {
+        'pages/foobar.html': '{{ url("foobar.png") }}',
+        'theme/assets/foobar.png': '*',
+    })
+    build(tmpdir, mode=Mode.production)
+    tmpdir.join('pages/foobar.html').write('{{ url("foobar.png") }} again')
+    # assets aren't copied, they're found from the manifest written by the last build
+    build(tmpdir, steps={BuildSteps.pages}, mode=Mode.production)
+    assert tmpdir.join('dist/foobar/index.html').read() == '/foobar.3389dae.png again\n'
+
+    tmpdir.join('theme/assets/foobar.png').remove()
+    tmpdir.join('pages/foobar.html').write('plain')
+    config = build(tmpdir, mode=Mode.production)['config']
+    assert not AssetManifest.get_path(config).exists()
+
+
+def test_build_page_called_manifest(tmpdir):
+    mktree(tmpdir, {
+        'pages/manifest.json': '{"name": "site"}',
+        'theme/assets/foobar.png': '*',
+    })
+    build(tmpdir, mode=Mode.production)
+    assert gettree(tmpdir.join('dist')) == {
+        'manifest.json': '{"name": "site"}',
+        'foobar.3389dae.png': '*',
+    }
+
+    tmpdir.join('theme/assets/foobar.png').remove()
+    build(tmpdir, mode=Mode.production)
+    assert gettree(tmpdir.join('dist')) == {'manifest.json': '{"name": "site"}'}
+
+
+@pytest.mark.parametrize('content', ['"foo"', '{"copy_assets": "foo"}', '{"copy_assets": {"a": ["b"]}}', '[1, 2]'])
+def test_build_foreign_asset_manifest(tmpdir, caplog, content):
+    mktree(tmpdir, {
+        'pages/foobar.html': 'hello',
+        'dist/manifest.json': '"not ours"',
+        'harrier.yml': f'cache_dir: {tmpdir.join("cache")}',
+    })
+    config = build(tmpdir, steps={BuildSteps.pages}, mode=Mode.production)['config']
+    manifest_path = AssetManifest.get_path(config)
+    manifest_path.write_text(content)
+    build(tmpdir, steps={BuildSteps.pages}, mode=Mode.production)
+    assert 'error loading asset manifest' in caplog.text
+    assert gettree(tmpdir.join('dist')) == {
+        'manifest.json': '"not ours"',
+        'foobar': {'index.html': 'hello\n'},
+    }
+
+
 def test_build_no_templates(tmpdir):
     mktree(tmpdir, {
         'pages': {
@@ -78,11 +139,9 @@ def test_simple_render(tmpdir):
             'favicon.ico': '*',
         },
         'theme/templates/main.jinja': 'main, content:\n\n{{ content }}',
-        'tmp/content/foobar.md': foo_page,
     })
     config = Config(
         source_dir=str(tmpdir),
-        tmp_dir=str(tmpdir.join('tmp')),
         foo='bar',
     )
 
@@ -92,7 +151,7 @@ def test_simple_render(tmpdir):
                 'uri': '/foobar.html',
                 'infile': config.pages_dir / 'foobar.md',
                 'template': 'main.jinja',
-                'content_template': Path('content') / 'foobar.md',
+                'content': foo_page,
             },
             'favicon.ico': {
                 'uri': '/favicon.ico',
@@ -135,7 +194,6 @@ def test_build_default_placeholders(tmpdir):
     })
     config = Config(
         source_dir=str(tmpdir),
-        tmp_dir=str(tmpdir.join('tmp')),
         foo='bar',
         defaults={
             '/posts/*': {
@@ -156,12 +214,10 @@ def test_build_default_placeholders(tmpdir):
     )
 
     pages = build_pages(config)
-    content_templates(pages.values(), config)
     source_dir = Path(tmpdir)
     assert {
         '/posts/2032-06-01-testing.html': {
             'infile': source_dir / 'pages/posts/2032-06-01-testing.html',
-            'content_template': 'content/posts/2032-06-01-testing.html',
             'title': 'Testing',
             'slug': 'testing',
             'created': datetime(2032, 6, 1, 0, 0),
@@ -192,7 +248,6 @@ def test_placeholders_error(tmpdir):
     })
     config = Config(
         source_dir=str(tmpdir),
-        tmp_dir=str(tmpdir.join('tmp')),
         foo='bar',
         defaults={
             '/posts/*': {
@@ -217,7 +272,6 @@ def test_build_simple_som(tmpdir):
     })
     config = Config(
         source_dir=str(tmpdir),
-        tmp_dir=str(tmpdir.join('tmp')),
         foo='bar',
         defaults={
             '/posts/*': {
@@ -227,13 +281,11 @@ def test_build_simple_som(tmpdir):
     )
 
     pages = build_pages(config)
-    content_templates(pages.values(), config)
     source_dir = Path(tmpdir)
     # debug(som)
     assert {
         '/foobar.md': {
             'infile': source_dir / 'pages/foobar.md',
-            'content_template': 'content/foobar.md',
             'title': 'Foobar',
             'slug': 'foobar',
             'created': CloseToNow(),
@@ -248,7 +300,6 @@ def test_build_simple_som(tmpdir):
         },
         '/posts/2032-06-01-testing.html': {
             'infile': source_dir / 'pages/posts/2032-06-01-testing.html',
-            'content_template': 'content/posts/2032-06-01-testing.html',
             'title': 'Testing',
             'slug': 'testing',
             'created': datetime(2032, 6, 1, 0, 0),
@@ -346,3 +397,266 @@ def test_file_data_illegal_char():
             uri='/bar more',
             template=None,
         )
+
+
+def test_validate_page_data():
+    data = dict(infile=Path('foo/bar.md'), title='Bar', slug='bar', created=123, uri='/bar', foo=[1])
+    assert validate_page_data(data) is data
+    assert data == dict(
+        infile=Path('foo/bar.md'),
+        title='Bar',
+        slug='bar',
+        created=datetime(1970, 1, 1, 0, 2, 3, tzinfo=timezone.utc),
+        uri='/bar',
+        foo=[1],
+        template=None,
+    )
+
+    # the wrong types are coerced by FileData
+    data = dict(infile='foo/bar.md', title=123, slug='bar', created='2032-01-01T00:00', uri='/bar', template=None)
+    assert validate_page_data(data) == dict(
+        infile=Path('foo/bar.md'), title='123', slug='bar', created=datetime(2032, 1, 1), uri='/bar', template=None,
+    )
+
+
+def test_validate_page_data_error():
+    data = dict(infile=Path('foo/bar.md'), title='Bar', slug='bar', created=123, uri='/bar more')
+    with pytest.raises(ValidationError) as exc_info:
+        validate_page_data(data)
+    with pytest.raises(ValidationError) as exc_info2:
+        FileData(**data)
+    assert str(exc_info.value) == str(exc_info2.value)
+    assert 'uri contains invalid characters: " "' in str(exc_info.value)
+
+
+def test_build_som_workers(tmpdir):
+    mktree(tmpdir, {
+        'pages': {
+            **{f'{i}.md': f'---\nx: {i}\n---\n# {i}' for i in range(10)},
+            'sub': {
+                'image.png': '*',
+                'index.html': 'whatever',
+            },
+        },
+    })
+    config = Config(source_dir=str(tmpdir), workers=3)
+    pages = build_pages(config)
+    assert list(pages) == [f'/{i}.md' for i in range(10)] + ['/sub/image.png', '/sub/index.html']
+    assert pages['/3.md']['x'] == 3
+    assert pages['/3.md']['content'] == '# 3'
+    assert pages == build_pages(Config(source_dir=str(tmpdir)))
+
+
+def test_placeholders_error_workers(tmpdir):
+    mktree(tmpdir, {
+        'pages': {
+            'posts': {
+                '2032-06-01-testing.html': '# testing',
+                '2032-06-02-other.html': '# other',
+            },
+        },
+    })
+    config = Config(
+        source_dir=str(tmpdir),
+        workers=2,
+        defaults={
+            '/posts/*': {
+                'testing': '{{ title }}-{{ foobar }}',
+            }
+        }
+    )
+
+    with pytest.raises(PlaceHolderError) as exc_info:
+        build_pages(config)
+    assert exc_info.value.args[0] == "Placeholder key error \"'foobar'\""
+
+
+def test_build_steps_early_render(tmpdir, mocker):
+    mktree(tmpdir, {
+        'pages': {
+            'plain.html': 'plain',
+            'css.html': '{{ url("theme/main.css") }}',
+        },
+        'theme/sass/main.scss': 'body {width: 10px + 10px;}',
+    })
+    config = Config(source_dir=str(tmpdir))
+    plain_rendered = []
+
+    def mock_grablib(config_, assets):
+        # wait for the page which doesn't reference assets to be rendered before "building" sass
+        for _ in range(100):
+            if tmpdir.join('dist/plain/index.html').check():
+                break
+            sleep(0.01)
+        plain_rendered.append(tmpdir.join('dist/plain/index.html').check())
+        assert not tmpdir.join('dist/css').check()
+        tmpdir.join('dist/theme/main.css').write('body{width:20px}\n', ensure=True)
+        return {'theme/main.css': ('theme/main.css', '0')}
+
+    mocker.patch('harrier.main.run_grablib', side_effect=mock_grablib)
+    site = SiteBuild(config, {BuildSteps.pages, BuildSteps.sass}, None)
+    assert [s.name for s in site.get_steps()] == ['copy_assets', 'sass', 'pages', 'som', 'render_early', 'render']
+    with ThreadPoolExecutor() as executor:
+        site.run(executor)
+    assert plain_rendered == [True]
+    assert site.early_pages == {'/plain.html'}
+    assert gettree(tmpdir.join('dist')) == {
+        'plain': {'index.html': 'plain\n'},
+        'css': {'index.html': '/theme/main.css\n'},
+        'theme': {'main.css': 'body{width:20px}\n'},
+    }
+
+
+def test_lazy_content(tmpdir):
+    mktree(tmpdir, {
+        'pages': {
+            'foo.md': '---\ntitle: Foo\n---\n# {{ page.title }} ✓',
+            'bar.html': 'no front matter {{ 1 + 1 }}',
+            'spam.txt': 'passed through',
+        },
+        'theme/templates/main.jinja': '{{ content }}',
+        'harrier.yml': (
+            'default_template: main.jinja\n'
+            'lazy_content: true\n'
+        ),
+    })
+    som = build(tmpdir, mode=Mode.production)
+    assert not any('content' in page for page in som['pages'].values())
+    assert som['pages']['/foo.md']['content_offset'] == 19
+    assert gettree(tmpdir.join('dist')) == {
+        'foo': {'index.html': '<h1 id="1-foo">Foo ✓</h1>\n'},
+        'bar': {'index.html': 'no front matter 2\n'},
+        'spam.txt': 'passed through',
+    }
+
+
+@pytest.mark.parametrize('lazy_content', [False, True])
+def test_crlf_content(tmpdir, lazy_content):
+    mktree(tmpdir, {
+        'theme/templates/main.jinja': '{{ content }}',
+        'harrier.yml': (
+            'default_template: main.jinja\n'
+            f'lazy_content: {str(lazy_content).lower()}\n'
+        ),
+    })
+    tmpdir.mkdir('pages')
+    tmpdir.join('pages/foo.html').write_binary(b'---\r\ntitle: Foo\r\n---\r\n{{ page.title }}\r\nline 2\r\n')
+    tmpdir.join('pages/bar.html').write_binary(b'bar\r\nline 2\r\n')
+    som = build(tmpdir, mode=Mode.production)
+    assert ('content_offset' in som['pages']['/foo.html']) == lazy_content
+    assert gettree(tmpdir.join('dist')) == {
+        'foo': {'index.html': 'Foo\nline 2\n'},
+        'bar': {'index.html': 'bar\nline 2\n'},
+    }
+
+
+def test_walk_pages(tmpdir, mocker):
+    mktree(tmpdir, {
+        'pages': {
+            'b.md': '1',
+            'a': {'z.md': '2', 'y': {'x.md': '3'}},
+            'c': {'a.md': '4'},
+            'node_modules': {'foo.md': '5', 'bar': {'spam.md': '6'}},
+            'vendor': {'keep.md': '7', 'drop.txt': '8'},
+        },
+        'harrier.yml': (
+            'ignore:\n'
+            '- /node_modules/*\n'
+            '- /vendor/*.txt\n'
+        ),
+    })
+    config = get_config(str(tmpdir))
+    pages_dir = Path(tmpdir.join('pages'))
+    # the order pages were found in before walk_pages
+    expected = sorted(
+        (p for p in pages_dir.glob('**/*') if p.is_file()),
+        key=lambda p_: (len(p_.parents), str(p_)),
+    )
+    expected = [p for p in expected if not any(m(norm_path_ref(p, pages_dir)) for m in config.ignore)]
+    scandir = mocker.spy(os, 'scandir')
+    files = walk_pages(config)
+    assert [p for p, _ in files] == expected
+    assert [str(p.relative_to(pages_dir)) for p in expected] == [
+        'b.md', 'a/z.md', 'c/a.md', 'vendor/keep.md', 'a/y/x.md'
+    ]
+    assert files[0][1].st_size == 1
+    scanned = {str(Path(c[0][0]).relative_to(pages_dir)) for c in scandir.call_args_list}
+    assert scanned == {'.', 'a', 'a/y', 'c', 'vendor'}
+
+
+def test_walk_pages_symlinks(tmpdir):
+    mktree(tmpdir, {
+        'pages': {'a/b.md': '1', 'other.md': '2'},
+    })
+    pages_dir = Path(tmpdir.join('pages'))
+    # links back up the tree would loop forever if followed
+    (pages_dir / 'a' / 'loop').symlink_to(pages_dir, target_is_directory=True)
+    (pages_dir / 'link.md').symlink_to(pages_dir / 'other.md')
+    files = walk_pages(Config(source_dir=str(tmpdir)))
+    assert [str(p.relative_to(pages_dir)) for p, _ in files] == ['link.md', 'other.md', 'a/b.md']
+
+
+def test_path_match_dir():
+    assert PathMatch('/node_modules/*').match_dir('/node_modules')
+    assert PathMatch('**/ignore*').match_dir('/foo/ignore_this')
+    assert not PathMatch('/node_modules/*.js').match_dir('/node_modules')
+    assert not PathMatch('/foo/').match_dir('/foo')
+    assert not PathMatch('/foo/*').match_dir('/bar')
+
+
+def test_path_match_set():
+    globs = ['/posts/*', '/posts/2018/*.md', '*.md', '/about.md', '/posts/?.md', '/about.md', '/x[ab].md']
+    matches = PathMatchSet(PathMatch(g) for g in globs)
+    for path in ['/posts/2018/foo.md', '/about.md', '/posts/a.md', '/xa.md', '/other.txt', '/', '']:
+        assert matches.match(path) == [i for i, g in enumerate(globs) if PathMatch(g)(path)], path
+    assert matches('/about.md')
+    assert not matches('/about.txt')
+    assert matches.match_dir('/posts')
+    assert not matches.match_dir('/about')
+    assert not PathMatchSet([])('/foo')
+
+
+def test_build_negative_workers(tmpdir):
+    mktree(tmpdir, {'pages/foo.md': '# foo'})
+    with pytest.raises(HarrierProblem) as exc_info:
+        build(tmpdir, workers=-2)
+    assert exc_info.value.args[0] == 'workers may not be negative'
+    assert not tmpdir.join('dist').check()
+
+
+def test_page_defaults():
+    posts = {'author': 'anna', 'tags': ['post'], 'summary': '{{ title }} by {{ author }}'}
+    defaults = {
+        PathMatch('/posts/*'): posts,
+        PathMatch('*.md'): {'heading': '{{ summary }}!'},
+    }
+    page_defaults = PageDefaults(defaults)
+    assert [(placeholders, containers) for _, placeholders, containers in page_defaults.entries] == [
+        ({'summary'}, {'tags'}),
+        ({'heading'}, set()),
+    ]
+    data = {'title': 'Foo', 'slug': 'foo'}
+    page_defaults.apply(data, '/posts/foo.md')
+    assert data == {
+        'title': 'Foo',
+        'slug': 'foo',
+        'author': 'anna',
+        'tags': ['post'],
+        'summary': 'Foo by anna',
+        'heading': 'Foo by anna!',
+    }
+    data['tags'].append('changed')
+    assert posts['tags'] == ['post']
+
+
+def test_page_defaults_changed_in_place(tmpdir):
+    mktree(tmpdir, {
+        'pages/foo.md': '# foo',
+        'harrier.yml': 'defaults:\n  /foo.md:\n    author: anna\n',
+    })
+    config = get_config(str(tmpdir))
+    assert build_pages(config)['/foo.md']['author'] == 'anna'
+    next(iter(config.defaults.values()))['author'] = 'ben'
+    config.defaults[PathMatch('*.md')] = {'section': 'main'}
+    page = build_pages(config)['/foo.md']
+    assert (page['author'], page['section']) == ('ben', 'main')
@@ -1,3 +1,6 @@
+import subprocess
+import sys
+
 from click.testing import CliRunner
 from pytest_toolbox import gettree, mktree
 from pytest_toolbox.comparison import RegexStr
@@ -160,3 +163,50 @@ def test_steps_sass_prod(tmpdir, mocker):
             'main.a1ac3a7.css': 'body{width:20px}\n',
         },
     }
+
+
+def test_build_workers(tmpdir, mocker):
+    mktree(tmpdir, {
+        'pages/foobar.md': 'hello',
+        'harrier.yml': 'webpack: {run: false}',
+    })
+    mock_render = mocker.patch('harrier.main.render_pages')
+
+    result = CliRunner().invoke(cli, ['build', str(tmpdir), '--workers', '3'])
+    assert result.exit_code == 0
+    assert mock_render.call_args[1]['workers'] == 3
+
+    result = CliRunner().invoke(cli, ['build', str(tmpdir), '--workers', '-2'])
+    assert result.exit_code == 2
+    assert mock_render.call_count == 1
+
+
+def test_compile_theme(tmpdir):
+    mktree(tmpdir, {
+        'pages/foobar.md': 'hello',
+        'theme/templates/main.jinja': '{{ content }}',
+        'harrier.yml': f'cache_dir: {tmpdir.join("cache")}',
+    })
+    result = CliRunner().invoke(cli, ['compile-theme', str(tmpdir)])
+    assert result.exit_code == 0
+    assert '1   templates compiled' in result.output
+    assert tmpdir.join('cache/compiled-theme/fingerprint').check()
+
+
+def test_import_budget():
+    """
+    Heavy dependencies should only be imported by the steps which need them.
+    """
+    code = (
+        'import sys, time\n'
+        'start = time.perf_counter()\n'
+        'import harrier.cli\n'
+        'print(time.perf_counter() - start)\n'
+        'print(" ".join(sorted({m.split(".")[0] for m in sys.modules})))\n'
+    )
+    output = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True).stdout.decode()
+    import_time, modules = output.strip().split('\n')
+    assert {'PIL', 'aiohttp', 'aiohttp_devtools', 'watchgod', 'grablib', 'sass', 'pygments', 'devtools'}.isdisjoint(
+        modules.split(' ')
+    )
+    assert float(import_time) < 2
@@ -152,6 +152,7 @@ def test_mock_executor(tmpdir, mocker):
             'assets': False,
             'sass': False,
             'templates': False,
+            'template_changes': set(),
             'data': False,
             'extensions': False,
             'update_config': False,
@@ -161,6 +162,7 @@ def test_mock_executor(tmpdir, mocker):
             'assets': False,
             'sass': False,
             'templates': False,
+            'template_changes': set(),
             'data': False,
             'extensions': False,
             'update_config': True,
@@ -170,6 +172,7 @@ def test_mock_executor(tmpdir, mocker):
             'assets': False,
             'sass': False,
             'templates': False,
+            'template_changes': set(),
             'data': False,
             'extensions': False,
             'update_config': False,
@@ -179,6 +182,7 @@ def test_mock_executor(tmpdir, mocker):
             'assets': True,
             'sass': False,
             'templates': False,
+            'template_changes': set(),
             'data': False,
             'extensions': False,
             'update_config': False,
@@ -188,6 +192,7 @@ def test_mock_executor(tmpdir, mocker):
             'assets': False,
             'sass': True,
             'templates': False,
+            'template_changes': set(),
             'data': False,
             'extensions': False,
             'update_config': False,
@@ -196,7 +201,8 @@ def test_mock_executor(tmpdir, mocker):
             'pages': set(),
             'assets': False,
             'sass': False,
-            'templates': True,
+            'templates': False,
+            'template_changes': {Path(tmpdir.join('theme/templates/main.jinja'))},
             'data': False,
             'extensions': False,
             'update_config': False,
@@ -206,6 +212,7 @@ def test_mock_executor(tmpdir, mocker):
             'assets': False,
             'sass': False,
             'templates': False,
+            'template_changes': set(),
             'data': False,
             'extensions': True,
             'update_config': False,
@@ -215,6 +222,7 @@ def test_mock_executor(tmpdir, mocker):
             'assets': False,
             'sass': False,
             'templates': False,
+            'template_changes': set(),
             'data': True,
             'extensions': False,
             'update_config': False,
@@ -401,3 +409,37 @@ def test_ignored_directory(tmpdir, mocker, loop):
             'index.html': '1\n',
         },
     }
+
+
+def test_dev_template_partial(tmpdir, mocker, loop):
+    async def awatch_alt(*args, **kwargs):
+        tmpdir.join('theme/templates/footer.jinja').write('new footer')
+        # not watched, so b.html should not be re-rendered
+        tmpdir.join('theme/templates/b.jinja').write('b changed:\n{{ content }}')
+        yield {(Change.modified, str(tmpdir.join('theme/templates/footer.jinja')))}
+
+    asyncio.set_event_loop(loop)
+    mktree(tmpdir, {
+        'pages': {
+            'a.html': '---\ntemplate: a.jinja\n---\nA',
+            'b.html': '---\ntemplate: b.jinja\n---\nB',
+        },
+        'theme/templates': {
+            'a.jinja': 'a:\n{{ content }}\n{% include "footer.jinja" %}',
+            'b.jinja': 'b:\n{{ content }}',
+            'footer.jinja': 'old footer',
+        },
+    })
+    mocker.patch('harrier.dev.awatch', side_effect=awatch_alt)
+    mocker.patch('harrier.dev.Server', return_value=MockServer())
+
+    assert dev(str(tmpdir), 8000) == 0
+
+    assert gettree(tmpdir.join('dist')) == {
+        'a': {
+            'index.html': 'a:\nA\nnew footer\n',
+        },
+        'b': {
+            'index.html': 'b:\nB\n',
+        },
+    }
@@ -1,7 +1,9 @@
+from pathlib import Path
+
 import pytest
 
 from harrier.common import HarrierProblem
-from harrier.frontmatter import parse_front_matter, parse_yaml, split_content
+from harrier.frontmatter import parse_front_matter, parse_yaml, read_front_matter, split_content
 
 
 def test_simple_front_matter():
@@ -235,3 +237,18 @@ def test_more_front_matter(s, result):
     obj, content = parse_front_matter(s)
     obj['content'] = split_content(content)
     assert obj == result
+
+
+@pytest.mark.parametrize('s', [
+    '---\nhappy: True\n---\nthe content\n',
+    '---\nhappy: True\n---  \n\n---\nmore',
+    '---\n---\nthe content',
+    '---\nhappy: True\nthe content',
+    'the content\n---\nfoo: bar\n---\n',
+    '',
+])
+def test_read_front_matter(tmpdir, s):
+    p = tmpdir.join('foo.md')
+    p.write(s)
+    obj, offset = read_front_matter(Path(p))
+    assert (obj, s.encode()[offset:].decode()) == parse_front_matter(s)
@@ -0,0 +1,144 @@
+from pytest_toolbox import gettree, mktree
+
+import harrier.build
+from harrier.config import Mode
+from harrier.main import build
+
+
+def test_incremental_build(tmpdir, mocker):
+    mktree(tmpdir, {
+        'pages': {
+            'foo.md': '# foo',
+            'bar.md': '# bar',
+        },
+        'theme/templates/main.jinja': 'main:\n{{ content }}',
+        'harrier.yml': (
+            f'cache_dir: {tmpdir.join("cache")}\n'
+            'default_template: main.jinja\n'
+        ),
+    })
+    build(tmpdir, mode=Mode.production, incremental=True)
+    assert gettree(tmpdir.join('dist')) == {
+        'foo': {'index.html': 'main:\n<h1 id="1-foo">foo</h1>\n'},
+        'bar': {'index.html': 'main:\n<h1 id="1-bar">bar</h1>\n'},
+    }
+    assert tmpdir.join('cache/build-manifest.pickle').check()
+    bar_mtime = tmpdir.join('dist/bar/index.html').mtime()
+
+    get_page_data = mocker.spy(harrier.build, 'get_page_data')
+    tmpdir.join('pages/foo.md').write('# foo changed')
+    build(tmpdir, mode=Mode.production, incremental=True)
+    assert gettree(tmpdir.join('dist')) == {
+        'foo': {'index.html': 'main:\n<h1 id="1-foo-changed">foo changed</h1>\n'},
+        'bar': {'index.html': 'main:\n<h1 id="1-bar">bar</h1>\n'},
+    }
+    assert get_page_data.call_count == 1
+    assert tmpdir.join('dist/bar/index.html').mtime() == bar_mtime
+
+
+def test_incremental_remove_page(tmpdir):
+    mktree(tmpdir, {
+        'pages': {
+            'foo.md': '# foo',
+            'bar.md': '# bar',
+        },
+        'harrier.yml': f'cache_dir: {tmpdir.join("cache")}\n',
+    })
+    build(tmpdir, mode=Mode.production, incremental=True)
+    assert gettree(tmpdir.join('dist')) == {
+        'foo': {'index.html': '<h1 id="1-foo">foo</h1>\n'},
+        'bar': {'index.html': '<h1 id="1-bar">bar</h1>\n'},
+    }
+    tmpdir.join('pages/bar.md').remove()
+    build(tmpdir, mode=Mode.production, incremental=True)
+    assert gettree(tmpdir.join('dist')) == {
+        'foo': {'index.html': '<h1 id="1-foo">foo</h1>\n'},
+        'bar': {},
+    }
+
+
+def test_incremental_template_change(tmpdir):
+    mktree(tmpdir, {
+        'pages': {
+            'foo.md': '# foo',
+            'bar.md': '# bar',
+        },
+        'theme/templates/main.jinja': 'main:\n{{ content }}',
+        'harrier.yml': (
+            f'cache_dir: {tmpdir.join("cache")}\n'
+            'default_template: main.jinja\n'
+        ),
+    })
+    build(tmpdir, mode=Mode.production, incremental=True)
+    tmpdir.join('theme/templates/main.jinja').write('changed:\n{{ content }}')
+    build(tmpdir, mode=Mode.production, incremental=True)
+    assert gettree(tmpdir.join('dist')) == {
+        'foo': {'index.html': 'changed:\n<h1 id="1-foo">foo</h1>\n'},
+        'bar': {'index.html': 'changed:\n<h1 id="1-bar">bar</h1>\n'},
+    }
+
+
+def test_incremental_config_change(tmpdir):
+    mktree(tmpdir, {
+        'pages': {
+            'foo.md': '# {{ config.foo }}',
+        },
+        'harrier.yml': (
+            f'cache_dir: {tmpdir.join("cache")}\n'
+            'foo: 1\n'
+        ),
+    })
+    build(tmpdir, mode=Mode.production, incremental=True)
+    assert gettree(tmpdir.join('dist')) == {'foo': {'index.html': '<h1 id="1-1">1</h1>\n'}}
+    tmpdir.join('harrier.yml').write(
+        f'cache_dir: {tmpdir.join("cache")}\n'
+        'foo: 2\n'
+    )
+    build(tmpdir, mode=Mode.production, incremental=True)
+    assert gettree(tmpdir.join('dist')) == {'foo': {'index.html': '<h1 id="1-2">2</h1>\n'}}
+
+
+def test_incremental_partial_template(tmpdir):
+    mktree(tmpdir, {
+        'pages': {
+            'a.html': '---\ntemplate: a.jinja\n---\nA',
+            'b.html': '---\ntemplate: b.jinja\n---\nB',
+        },
+        'theme/templates': {
+            'a.jinja': 'a:\n{{ content }}\n{% include "footer.jinja" %}',
+            'b.jinja': 'b:\n{{ content }}',
+            'footer.jinja': 'old footer',
+        },
+        'harrier.yml': f'cache_dir: {tmpdir.join("cache")}\n',
+    })
+    build(tmpdir, mode=Mode.production, incremental=True)
+    b_mtime = tmpdir.join('dist/b/index.html').mtime()
+    tmpdir.join('theme/templates/footer.jinja').write('new footer')
+    build(tmpdir, mode=Mode.production, incremental=True)
+    assert gettree(tmpdir.join('dist')) == {
+        'a': {'index.html': 'a:\nA\nnew footer\n'},
+        'b': {'index.html': 'b:\nB\n'},
+    }
+    assert tmpdir.join('dist/b/index.html').mtime() == b_mtime
+
+
+def test_incremental_lazy_content(tmpdir):
+    mktree(tmpdir, {
+        'pages': {
+            'foo.md': '---\ntitle: Foo\n---\n# foo',
+            'bar.md': '# bar',
+        },
+        'harrier.yml': (
+            f'cache_dir: {tmpdir.join("cache")}\n'
+            'lazy_content: true\n'
+        ),
+    })
+    build(tmpdir, mode=Mode.production, incremental=True)
+    bar_mtime = tmpdir.join('dist/bar/index.html').mtime()
+    tmpdir.join('pages/foo.md').write('---\ntitle: Foo\n---\n# foo changed')
+    build(tmpdir, mode=Mode.production, incremental=True)
+    assert gettree(tmpdir.join('dist')) == {
+        'foo': {'index.html': '<h1 id="1-foo-changed">foo changed</h1>\n'},
+        'bar': {'index.html': '<h1 id="1-bar">bar</h1>\n'},
+    }
+    assert tmpdir.join('dist/bar/index.html').mtime() == bar_mtime
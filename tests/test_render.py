@@ -1,15 +1,25 @@
+import logging
+import re
+import subprocess
+import sys
+from collections import OrderedDict
 from datetime import datetime
 from pathlib import Path
 
+import pygments.lexers
 import pytest
+from jinja2 import Environment, FileSystemLoader
 from PIL import Image
 from pytest_toolbox import gettree, mktree
 from pytest_toolbox.comparison import RegexStr
 
+from harrier import render
 from harrier.build import FileData
-from harrier.config import Mode
-from harrier.main import build
-from harrier.render import json_filter, paginate_filter
+from harrier.common import HarrierProblem
+from harrier.config import Config, Mode
+from harrier.main import build, compile_theme
+from harrier.render import (INLINE_CSS_CACHE, HighlightCache, ImageSizeCache, MarkdownCache, Shape, inline_css,
+                            json_filter, log_slowest, paginate_filter, render_pages)
 
 
 def test_build_multi_part(tmpdir):
@@ -573,3 +583,403 @@ def test_no_trailing_slash(tmpdir):
         },
         'index.html': '<a href="/other">link to other</a>\n',
     }
+
+
+def test_render_workers(tmpdir):
+    mktree(tmpdir, {
+        'pages': {
+            **{f'p{i}.md': f'# page {i}\n\n{{{{ pages|length }}}}' for i in range(10)},
+            'image.png': '*',
+        },
+        'theme/templates/main.jinja': '{{ page.title }}:\n{{ content }}',
+        'harrier.yml': 'default_template: main.jinja',
+    })
+    build(tmpdir, mode=Mode.production, workers=3)
+    assert gettree(tmpdir.join('dist')) == {
+        **{f'p{i}': {'index.html': f'P{i}:\n<h1 id="1-page-{i}">page {i}</h1>\n\n<p>11</p>\n'} for i in range(10)},
+        'image.png': '*',
+    }
+
+
+def test_render_workers_error(tmpdir):
+    mktree(tmpdir, {
+        'pages': {
+            'good.html': 'good',
+            'bad.html': '{{ foo.bar }}',
+        },
+    })
+    with pytest.raises(HarrierProblem) as exc_info:
+        build(tmpdir, mode=Mode.production, workers=2)
+    assert exc_info.value.args[0] == "UndefinedError: 'foo' is undefined"
+
+
+def test_log_slowest(caplog):
+    caplog.set_level(logging.INFO)
+    timings = [
+        ('/a.md', 'main.jinja', 0.1, 0.2, 0.3, {'main.jinja': 0.2, 'head.jinja': 0.1}),
+        ('/b.md', 'main.jinja', 0.1, 0.1, 0.1, {'main.jinja': 0.05, 'head.jinja': 0.05}),
+        ('/c.html', 'other.jinja', 0.05, 0, 0.05, {'other.jinja': 0.05}),
+        ('/d.html', None, 0.5, 0, 0, {}),
+    ]
+    log_slowest(timings, 2)
+    assert caplog.messages[-1] == (
+        'slowest 2 pages:\n'
+        '  total    content  markdown layout   page\n'
+        '  0.600s   0.100s   0.200s   0.300s   /a.md\n'
+        '  0.500s   0.500s   0.000s   0.000s   /d.html\n'
+        'slowest 2 templates (excluding templates they extend, include or import):\n'
+        '  total    share   pages   template\n'
+        '  0.250s   16.7%       2   main.jinja\n'
+        '  0.150s   10.0%       2   head.jinja'
+    )
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_build_report(tmpdir, caplog, workers):
+    caplog.set_level(logging.INFO)
+    mktree(tmpdir, {
+        'pages': {
+            'foo.md': '# foo',
+            'bar.html': 'bar',
+            'image.png': '*',
+        },
+        'theme/templates/main.jinja': '{{ content }}',
+        'harrier.yml': 'default_template: main.jinja',
+    })
+    build(tmpdir, mode=Mode.production, workers=workers, report=5)
+    assert 'slowest 2 pages:' in caplog.text
+    assert RegexStr(r'.*\s+/foo\.md\n.*', flags=re.S) == caplog.text
+    assert RegexStr(r'.*\s+2\s+main\.jinja\n.*', flags=re.S) == caplog.text
+
+
+def test_template_timer(tmpdir):
+    mktree(tmpdir, {
+        'pages/foo.md': '# foo',
+        'theme/templates': {
+            'main.jinja': '{% extends "base.jinja" %}{% block body %}{{ slow(0.03) }}{{ content }}{% endblock %}',
+            'base.jinja': '{% import "macros.jinja" as m %}{% include "head.jinja" %}{% block body %}{% endblock %}',
+            'head.jinja': '{{ slow(0.02) }}',
+            'macros.jinja': '{{ slow(0.01) }}{% macro x() %}{% endmacro %}',
+        },
+        'extensions.py': (
+            'from time import sleep\n'
+            'from harrier.extensions import template\n'
+            '\n'
+            '@template.function\n'
+            'def slow(seconds):\n'
+            '    sleep(seconds)\n'
+            '    return ""\n'
+        ),
+        'harrier.yml': 'default_template: main.jinja',
+    })
+    som = build(tmpdir, mode=Mode.production)
+    timings = []
+    render_pages(som['config'], som, timings=timings)
+    (_, _, _, _, layout, template_times), = timings
+    assert set(template_times) == {'main.jinja', 'base.jinja', 'head.jinja', 'macros.jinja'}
+    # blocks are charged to the template defining them
+    assert 0.03 <= template_times['main.jinja'] < 0.05
+    assert template_times['head.jinja'] >= 0.02
+    assert template_times['macros.jinja'] >= 0.01
+    # time in included and imported templates isn't charged to base.jinja
+    assert template_times['base.jinja'] < 0.01
+    assert sum(template_times.values()) <= layout
+
+
+def test_content_template_names(tmpdir):
+    mktree(tmpdir, {
+        'pages': {
+            'main.html': 'page content',
+            'foo.md': '{% include "/bar.html" %}',
+            'bar.html': '---\noutput: false\n---\nbar content',
+        },
+        'theme/templates/main.html': 'layout:\n{{ content }}',
+        'harrier.yml': 'default_template: main.html',
+    })
+    build(tmpdir, mode=Mode.production)
+    assert gettree(tmpdir.join('dist')) == {
+        'main': {'index.html': 'layout:\npage content\n'},
+        'foo': {'index.html': 'layout:\n<p>bar content</p>\n'},
+    }
+
+
+def test_template_cache(tmpdir, mocker):
+    mktree(tmpdir, {
+        'pages': {
+            'foo.md': '# {{ 1 + 1 }}',
+        },
+        'theme/templates/main.jinja': 'main:\n{{ content }}',
+        'harrier.yml': (
+            f'cache_dir: {tmpdir.join("cache")}\n'
+            'default_template: main.jinja\n'
+        ),
+    })
+    build(tmpdir, mode=Mode.production)
+    assert len(tmpdir.join('cache/templates').listdir()) == 2
+    compile = mocker.spy(Environment, 'compile')
+    build(tmpdir, mode=Mode.production)
+    assert compile.call_count == 0
+    assert gettree(tmpdir.join('dist')) == {'foo': {'index.html': 'main:\n<h1 id="1-2">2</h1>\n'}}
+
+    tmpdir.join('theme/templates/main.jinja').write('changed:\n{{ content }}')
+    build(tmpdir, mode=Mode.production)
+    assert compile.call_count == 1
+    assert gettree(tmpdir.join('dist')) == {'foo': {'index.html': 'changed:\n<h1 id="1-2">2</h1>\n'}}
+
+
+def test_markdown_cache(tmpdir, mocker):
+    tmpdir.mkdir('pages')
+    mocker.patch('harrier.render.MD_CACHE', OrderedDict())
+    mocker.patch('harrier.render.MD_CACHE_SIZE', 2)
+    config = Config(source_dir=str(tmpdir), cache_dir=str(tmpdir.join('cache')), markdown_cache=True)
+    md = mocker.Mock(side_effect=lambda s: f'<p>{s}</p>')
+    md_cache = MarkdownCache(md, config)
+    assert md_cache('a') == '<p>a</p>'
+    assert md_cache('a') == '<p>a</p>'
+    assert md.call_count == 1
+    assert (md_cache.hits, md_cache.misses) == (1, 1)
+    assert len(list(tmpdir.join('cache/markdown').visit(lambda p: p.isfile()))) == 1
+
+    md_cache('b')
+    md_cache('c')
+    # "a" has been evicted from memory but is read from disk
+    assert list(render.MD_CACHE.values()) == ['<p>b</p>', '<p>c</p>']
+    assert md_cache('a') == '<p>a</p>'
+    assert md.call_count == 3
+
+    config.markdown_cache = False
+    md_cache = MarkdownCache(md, config)
+    assert md_cache('d') == '<p>d</p>'
+    assert md_cache('d') == '<p>d</p>'
+    assert md.call_count == 4
+    assert len(list(tmpdir.join('cache/markdown').visit(lambda p: p.isfile()))) == 3
+
+    # upgrading misaka or pygments invalidates cached output
+    config.markdown_cache = True
+    assert render.md_versions().startswith('misaka ')
+    mocker.patch('harrier.render.md_versions', return_value='misaka 3 pygments 3')
+    md_cache = MarkdownCache(md, config)
+    assert md_cache('a') == '<p>a</p>'
+    assert md.call_count == 5
+
+
+def test_prune_markdown_cache(tmpdir, mocker):
+    tmpdir.mkdir('pages')
+    mocker.patch('harrier.render.MD_CACHE', OrderedDict())
+    mocker.patch('harrier.render.MD_DISK_CACHE_SIZE', 2)
+    config = Config(source_dir=str(tmpdir), cache_dir=str(tmpdir.join('cache')), markdown_cache=True)
+    md_cache = MarkdownCache(mocker.Mock(side_effect=lambda s: f'<p>{s}</p>'), config)
+    for s in 'abc':
+        md_cache(s)
+    files = list(tmpdir.join('cache/markdown').visit(lambda p: p.isfile()))
+    for i, p in enumerate(files):
+        p.setmtime(1000 + i)
+
+    # the oldest file other than "a" should be removed since "a" is read from disk and becomes the most recently used
+    oldest = min((p for p in files if p.read() != '<p>a</p>'), key=lambda p: p.mtime())
+    render.MD_CACHE.clear()
+    md_cache('a')
+    render.prune_markdown_cache(config)
+    remaining = list(tmpdir.join('cache/markdown').visit(lambda p: p.isfile()))
+    assert sorted(p.read() for p in remaining) == sorted(p.read() for p in files if p != oldest)
+    assert '<p>a</p>' in [p.read() for p in remaining]
+    render.prune_markdown_cache(config)
+    assert len(list(tmpdir.join('cache/markdown').visit(lambda p: p.isfile()))) == 2
+
+
+def test_pygments_not_imported(tmpdir):
+    mktree(tmpdir, {
+        'pages': {'foo.md': '# foo\n\n`inline code`', 'bar.html': 'bar'},
+    })
+    # run in a new process since pygments is already imported by these tests
+    code = (
+        'import sys\n'
+        'from harrier.main import build\n'
+        f'build({str(tmpdir)!r})\n'
+        'print("pygments" in sys.modules)\n'
+    )
+    assert subprocess.check_output([sys.executable, '-c', code]).decode().strip().split('\n')[-1] == 'False'
+
+
+def test_highlight_cache(mocker):
+    mocker.patch('harrier.render.HIGHLIGHT_CACHE_SIZE', 2)
+    get_lexer = mocker.spy(pygments.lexers, 'get_lexer_by_name')
+    highlight = HighlightCache()
+    py = highlight('x = 1', 'python')
+    assert py.startswith('<div class="hi"><pre>')
+    assert highlight('x = 1', 'python') == py
+    assert highlight('y = 2', 'python') != py
+    assert highlight('<x>', 'notalanguage') == '<pre><code>&lt;x&gt;</code></pre>\n'
+    assert highlight('<x>', 'notalanguage') == '<pre><code>&lt;x&gt;</code></pre>\n'
+    assert (highlight.hits, highlight.misses) == (2, 3)
+    assert get_lexer.call_count == 2
+    assert len(highlight.output) == 2
+
+
+def test_inline_css_cache(tmpdir, mocker):
+    mktree(tmpdir, {
+        'pages/index.md': '# hello',
+        'dist/theme': {
+            'main.css': 'body {color: red;}\n/*# sourceMappingURL=main.css.map */\n',
+            'main.css.map': '{}',
+        },
+    })
+    config = Config(source_dir=str(tmpdir))
+    ctx = {'config': config, 'path_lookup': {'theme/main.css': ('/theme/main.css', False, '1')}}
+    read_text = mocker.spy(Path, 'read_text')
+    INLINE_CSS_CACHE.clear()
+    css = 'body {color: red;}\n/*# sourceMappingURL=/theme/main.css.map */'
+    assert inline_css(ctx, 'theme/main.css') == css
+    assert inline_css(ctx, 'theme/main.css') == css
+    assert read_text.call_count == 1
+
+    css_path = tmpdir.join('dist/theme/main.css')
+    css_path.write('body {color: blue;}')
+    css_path.setmtime(css_path.mtime() + 10)
+    assert inline_css(ctx, 'theme/main.css') == 'body {color: blue;}'
+    assert read_text.call_count == 2
+
+
+def test_image_size_cache(tmpdir, mocker):
+    mocker.patch('harrier.render.IMAGE_SIZE_CACHE_SIZE', 2)
+    open_image = mocker.spy(Image, 'open')
+    for i, size in enumerate([(10, 20), (30, 40), (50, 60)]):
+        Image.new('RGB', size, (255, 255, 255)).save(str(tmpdir.join(f'{i}.png')), 'PNG')
+    cache_path = Path(tmpdir.join('cache/image-sizes.json'))
+    sizes = ImageSizeCache.load(cache_path)
+    assert sizes.get(Path(tmpdir.join('0.png'))) == Shape(10, 20)
+    assert sizes.get(Path(tmpdir.join('0.png'))) == Shape(10, 20)
+    assert sizes.get(Path(tmpdir.join('1.png'))) == Shape(30, 40)
+    assert open_image.call_count == 2
+    sizes.save()
+    assert not sizes.new
+
+    sizes = ImageSizeCache.load(cache_path)
+    assert sizes.get(Path(tmpdir.join('1.png'))) == Shape(30, 40)
+    assert sizes.get(Path(tmpdir.join('2.png'))) == Shape(50, 60)
+    assert open_image.call_count == 3
+    assert [key[0] for key in sizes.sizes] == [str(tmpdir.join('1.png')), str(tmpdir.join('2.png'))]
+
+    sizes.checked = {}
+    Image.new('RGB', (70, 80), (255, 255, 255)).save(str(tmpdir.join('1.png')), 'PNG')
+    assert sizes.get(Path(tmpdir.join('1.png'))) == Shape(70, 80)
+    assert open_image.call_count == 4
+
+    # sizes returned by render workers are the most recently used even if already known
+    key_2 = next(iter(sizes.sizes))
+    sizes.add(key_2, sizes.sizes[key_2])
+    assert list(sizes.sizes)[-1] == key_2
+
+
+def test_render_chunk_image_sizes(tmpdir, mocker):
+    mktree(tmpdir, {
+        'pages': {'a.html': "{{ width('a.png') }}", 'b.html': "{{ width('b.png') }}"},
+        'theme/assets': {},
+        'harrier.yml': f'cache_dir: {tmpdir.join("cache")}',
+    })
+    for name, size in (('a', (10, 20)), ('b', (30, 40))):
+        Image.new('RGB', size, (255, 255, 255)).save(str(tmpdir.join(f'theme/assets/{name}.png')), 'PNG')
+    som = build(tmpdir, mode=Mode.production)
+    mocker.patch('harrier.render.IMAGE_SIZE_CACHE', ImageSizeCache(Path(tmpdir.join('sizes.json'))))
+    mocker.patch('harrier.render.RENDER_STATE', (som['config'], som, None, False, None))
+    # a worker process renders several chunks, each chunk only returns the sizes it found
+    *_, sizes_a = render._render_chunk(['/a.html'])
+    *_, sizes_b = render._render_chunk(['/b.html'])
+    assert [v for _, v in sizes_a] == [Shape(10, 20)]
+    assert [v for _, v in sizes_b] == [Shape(30, 40)]
+
+
+@pytest.mark.parametrize('content', ['{"a": 1}', '[1, 2]', '[["a", 1, 2, 3]]', 'null', '[[1, 2, 3, 4, 5, 6]]'])
+def test_image_size_cache_invalid(tmpdir, caplog, content):
+    cache_path = Path(tmpdir.join('image-sizes.json'))
+    cache_path.write_text(content)
+    sizes = ImageSizeCache.load(cache_path)
+    assert not sizes.sizes
+    assert 'error loading image size cache' in caplog.text
+
+
+def test_highlight_cache_log(tmpdir, caplog, mocker):
+    caplog.set_level(logging.DEBUG, 'harrier.render')
+    mocker.patch('harrier.render.MD_CACHE', OrderedDict())
+    mocker.patch('harrier.render.HIGHLIGHT_CACHE', HighlightCache())
+    mktree(tmpdir, {
+        'pages': {'foo.md': '```python\nx = 1\n```', 'bar.md': '```python\nx = 1\n```\n\nbar'},
+    })
+    build(tmpdir, mode=Mode.production)
+    assert any('highlight cache: 1 hits, 1 misses' in m for m in caplog.messages)
+    caplog.clear()
+    tmpdir.join('pages/bar.md').write('```python\nx = 2\n```')
+    build(tmpdir, mode=Mode.production)
+    # counts are only for the latest render, not cumulative
+    assert any('highlight cache: 0 hits, 1 misses' in m for m in caplog.messages)
+
+
+def test_compile_theme(tmpdir, mocker):
+    mktree(tmpdir, {
+        'pages/foo.md': '# foo',
+        'theme/templates': {
+            'main.jinja': '{% extends "base.jinja" %}{% block main %}{{ content|shout }}{% endblock %}',
+            'base.jinja': 'base:\n{% block main %}{% endblock %}',
+        },
+        'extensions.py': (
+            'from harrier.extensions import template\n'
+            '\n'
+            '@template.filter\n'
+            'def shout(s):\n'
+            '    return s.upper()\n'
+        ),
+        'harrier.yml': (
+            f'cache_dir: {tmpdir.join("cache")}\n'
+            'default_template: main.jinja\n'
+        ),
+    })
+    compile_theme(tmpdir)
+    assert tmpdir.join('cache/compiled-theme/fingerprint').check()
+    fs_get_source = mocker.spy(FileSystemLoader, 'get_source')
+    build(tmpdir, mode=Mode.production)
+    assert fs_get_source.call_count == 0
+    assert gettree(tmpdir.join('dist')) == {'foo': {'index.html': 'base:\n<H1 ID="1-FOO">FOO</H1>\n'}}
+
+    tmpdir.join('theme/templates/base.jinja').write('changed:\n{% block main %}{% endblock %}')
+    build(tmpdir, mode=Mode.production)
+    assert fs_get_source.call_count == 2
+    assert gettree(tmpdir.join('dist')) == {'foo': {'index.html': 'changed:\n<H1 ID="1-FOO">FOO</H1>\n'}}
+
+
+def test_theme_fingerprint_once_per_build(tmpdir, mocker):
+    mktree(tmpdir, {
+        'pages': {'assets.html': '{{ url("foo.txt") }}', **{f'page-{i}.md': f'# {i}' for i in range(4)}},
+        'theme': {
+            'templates/main.jinja': '{{ content }}',
+            'assets/foo.txt': 'foo',
+        },
+        'harrier.yml': (
+            f'cache_dir: {tmpdir.join("cache")}\n'
+            'default_template: main.jinja\n'
+        ),
+    })
+    compile_theme(tmpdir)
+    real_fingerprint = render.theme_fingerprint
+    calls = tmpdir.join('fingerprint-calls')
+
+    def theme_fingerprint(config):
+        # written to a file to count calls made in worker processes
+        with calls.open('a') as f:
+            f.write('x')
+        return real_fingerprint(config)
+
+    mocker.patch('harrier.render.theme_fingerprint', side_effect=theme_fingerprint)
+    build(tmpdir, mode=Mode.production, workers=2)
+    assert tmpdir.join('dist/assets/index.html').read() == '/foo.acbd18d.txt\n'
+    assert calls.read() == 'x'
+
+
+def test_compile_theme_error(tmpdir):
+    mktree(tmpdir, {
+        'pages/foo.md': '# foo',
+        'theme/templates/main.jinja': '{% if %}',
+        'harrier.yml': f'cache_dir: {tmpdir.join("cache")}\n',
+    })
+    with pytest.raises(HarrierProblem):
+        compile_theme(tmpdir)
+    assert not tmpdir.join('cache/compiled-theme').check()
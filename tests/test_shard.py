@@ -0,0 +1,115 @@
+import json
+
+import pytest
+from click.testing import CliRunner
+from pytest_toolbox import gettree, mktree
+
+from harrier.cli import cli
+from harrier.common import HarrierProblem
+from harrier.config import Mode
+from harrier.main import build, merge
+from harrier.shard import SHARD_FILES, in_shard, parse_shard
+
+from .test_writer import MOCK_WEBPACK
+
+
+@pytest.mark.parametrize('s,result', [
+    ('1/1', (1, 1)),
+    ('3/8', (3, 8)),
+])
+def test_parse_shard(s, result):
+    assert parse_shard(s) == result
+
+
+@pytest.mark.parametrize('s', ['0/2', '3/2', '1', 'a/b'])
+def test_parse_shard_invalid(s):
+    with pytest.raises(ValueError):
+        parse_shard(s)
+
+
+def test_in_shard():
+    path_refs = [f'/page-{i}.md' for i in range(100)]
+    shards = [{p for p in path_refs if in_shard(p, (i, 3))} for i in (1, 2, 3)]
+    assert set.union(*shards) == set(path_refs)
+    assert sum(len(s) for s in shards) == 100
+    assert all(len(s) > 10 for s in shards)
+
+
+def test_shard_merge(tmpdir):
+    mktree(tmpdir, {
+        'pages': {f'page-{i}.md': f'# {i}' for i in range(10)},
+        'theme': {
+            'templates/main.jinja': '{{ url("foo.txt") }}\n{{ content }}',
+            'assets/foo.txt': 'foo',
+        },
+        'harrier.yml': 'default_template: main.jinja',
+    })
+    build(tmpdir, mode=Mode.production, shard=(1, 2))
+    build(tmpdir, mode=Mode.production, shard=(2, 2))
+    shard1 = json.loads(tmpdir.join(f'dist-shard-1-of-2/{SHARD_FILES}').read())
+    shard2 = json.loads(tmpdir.join(f'dist-shard-2-of-2/{SHARD_FILES}').read())
+    assert 'foo.acbd18d.txt' in shard1
+    assert 'foo.acbd18d.txt' not in shard2
+    assert set(shard1).isdisjoint(shard2)
+    assert len(shard1) + len(shard2) == 11
+
+    assert merge(tmpdir) == (11, 0, 0)
+    tree = gettree(tmpdir.join('dist'))
+    assert tree['foo.acbd18d.txt'] == 'foo'
+    assert tree['page-7'] == {'index.html': '/foo.acbd18d.txt\n<h1 id="1-7">7</h1>\n'}
+    assert len(tree) == 11
+
+
+def test_shard_webpack_outside_dist(tmpdir):
+    mktree(tmpdir, {
+        'pages': {f'page-{i}.md': f'# {i}' for i in range(4)},
+        'theme/js/index.js': '*',
+        'mock_webpack': MOCK_WEBPACK,
+        'harrier.yml': (
+            f'webpack:\n'
+            f'  cli: {tmpdir.join("mock_webpack")}\n'
+            f'  output_path: {tmpdir.join("js_out")}\n'
+            f'  prod_output_filename: main.js\n'
+        ),
+    })
+    tmpdir.join('mock_webpack').chmod(0o777)
+    build(tmpdir, mode=Mode.production, shard=(1, 2))
+    build(tmpdir, mode=Mode.production, shard=(2, 2))
+    assert merge(tmpdir) == (4, 0, 0)
+    assert sorted(gettree(tmpdir.join('dist'))) == ['page-0', 'page-1', 'page-2', 'page-3']
+    assert gettree(tmpdir.join('js_out')) == {'main.js': 'js'}
+
+
+def test_merge_missing_shard(tmpdir):
+    mktree(tmpdir, {'pages/foo.md': '# foo'})
+    build(tmpdir, mode=Mode.production, shard=(2, 3))
+    with pytest.raises(HarrierProblem) as exc_info:
+        merge(tmpdir)
+    assert str(exc_info.value) == 'shards missing: 1, 3'
+
+
+def test_merge_conflict(tmpdir):
+    mktree(tmpdir, {
+        'pages/foo.md': '# foo',
+        'dist-shard-1-of-2': {SHARD_FILES: '["foo/index.html"]', 'foo/index.html': 'x'},
+        'dist-shard-2-of-2': {SHARD_FILES: '["foo/index.html"]', 'foo/index.html': 'y'},
+    })
+    with pytest.raises(HarrierProblem) as exc_info:
+        merge(tmpdir)
+    assert str(exc_info.value) == '"foo/index.html" written by both shard 1/2 and shard 2/2'
+
+
+def test_cli_shard(tmpdir):
+    mktree(tmpdir, {'pages/foo.md': '# foo'})
+    result = CliRunner().invoke(cli, ['build', str(tmpdir), '--shard', '1/1'])
+    assert result.exit_code == 0
+    assert tmpdir.join('dist-shard-1-of-1/foo/index.html').check()
+
+    result = CliRunner().invoke(cli, ['merge', str(tmpdir)])
+    assert result.exit_code == 0
+    assert 'dist sync: 1 added, 0 changed, 0 removed' in result.output
+    assert gettree(tmpdir.join('dist')) == {'foo': {'index.html': '<h1 id="1-foo">foo</h1>\n'}}
+
+    result = CliRunner().invoke(cli, ['build', str(tmpdir), '--shard', '2/1'])
+    assert result.exit_code == 2
+    assert 'shard index must be between 1 and 1' in result.output
@@ -0,0 +1,112 @@
+from pathlib import Path
+
+from pytest_toolbox import mktree
+
+from harrier import templates
+from harrier.config import Config
+from harrier.templates import ANY_TEMPLATE, TemplateGraph
+
+
+def test_template_graph(tmpdir):
+    mktree(tmpdir, {
+        'pages/foobar.md': '# hello',
+        'theme/templates': {
+            'base.jinja': '{% include "partials/footer.jinja" %}',
+            'main.jinja': '{% extends "base.jinja" %}',
+            'other.jinja': '{% from "macros.jinja" import m %}{{ m() }}',
+            'macros.jinja': '{% macro m() %}x{% endmacro %}',
+            'partials/footer.jinja': 'footer',
+            'dynamic.jinja': '{% include page.foo %}',
+        },
+    })
+    graph = TemplateGraph(Config(source_dir=str(tmpdir)))
+    assert graph.refs == {
+        'base.jinja': {'partials/footer.jinja'},
+        'dynamic.jinja': {ANY_TEMPLATE},
+        'macros.jinja': set(),
+        'main.jinja': {'base.jinja'},
+        'other.jinja': {'macros.jinja'},
+        'partials/footer.jinja': set(),
+    }
+    assert graph.closure('main.jinja') == {'main.jinja', 'base.jinja', 'partials/footer.jinja'}
+    assert graph.closure('other.jinja') == {'other.jinja', 'macros.jinja'}
+    assert graph.closure('dynamic.jinja') == {ANY_TEMPLATE, *graph.refs}
+
+    pages = {
+        '/a.md': {'infile': Path('a.md'), 'template': 'main.jinja', 'content': 'a'},
+        '/b.md': {'infile': Path('b.md'), 'template': 'other.jinja', 'content': 'b'},
+        '/c.md': {'infile': Path('c.md'), 'template': None, 'content': '{% include "partials/footer.jinja" %}'},
+        '/d.png': {'infile': Path('d.png')},
+    }
+    assert graph.affected_pages(pages, {'partials/footer.jinja'}) == {'/a.md', '/c.md'}
+    assert graph.affected_pages(pages, {'macros.jinja'}) == {'/b.md'}
+    assert graph.affected_pages(pages, {'dynamic.jinja'}) == set()
+
+
+def test_template_graph_syntax_error(tmpdir):
+    mktree(tmpdir, {
+        'pages/foobar.md': '# hello',
+        'theme/templates': {
+            'main.jinja': '{% if %}',
+            'other.jinja': 'other',
+        },
+    })
+    graph = TemplateGraph(Config(source_dir=str(tmpdir)))
+    assert graph.closure('main.jinja') == {ANY_TEMPLATE, 'main.jinja', 'other.jinja'}
+
+
+def test_uses_assets(tmpdir):
+    mktree(tmpdir, {
+        'pages/foobar.md': '# hello',
+        'theme/templates': {
+            'base.jinja': '{% include "head.jinja" %}{{ content }}',
+            'head.jinja': '<style>{{ inline_css("theme/main.css") }}</style>',
+            'plain.jinja': '{{ content }}',
+        },
+    })
+    graph = TemplateGraph(Config(source_dir=str(tmpdir)))
+    assert graph.asset_templates == {'head.jinja'}
+    assert graph.uses_assets({'infile': Path('a.md'), 'template': 'base.jinja', 'content': 'a'})
+    assert not graph.uses_assets({'infile': Path('b.md'), 'template': 'plain.jinja', 'content': 'b'})
+    assert graph.uses_assets({'infile': Path('c.md'), 'template': 'plain.jinja', 'content': '{{ url("x.png") }}'})
+    assert not graph.uses_assets({'infile': Path('d.png')})
+
+
+def test_uses_assets_extensions(tmpdir):
+    mktree(tmpdir, {
+        'pages/foobar.md': '# hello',
+        'theme/templates': {
+            'filter.jinja': '{{ content|with_logo }}',
+            'test.jinja': '{% if content is logo %}{{ content }}{% endif %}',
+            'plain.jinja': '{{ content|upper }}',
+        },
+        'extensions.py': (
+            'from jinja2 import contextfilter\n'
+            'from harrier.extensions import template\n'
+            '\n'
+            '@template.filter\n'
+            '@contextfilter\n'
+            'def with_logo(ctx, s):\n'
+            '    return ctx["url"]("logo.png") + s\n'
+            '\n'
+            '@template.test\n'
+            'def logo(s):\n'
+            '    return "logo" in s\n'
+        ),
+    })
+    graph = TemplateGraph(Config(source_dir=str(tmpdir)))
+    assert graph.asset_templates == {'filter.jinja', 'test.jinja'}
+    assert graph.uses_assets({'infile': Path('a.md'), 'template': 'plain.jinja', 'content': '{{ "a"|with_logo }}'})
+    assert not graph.uses_assets({'infile': Path('b.md'), 'template': 'plain.jinja', 'content': 'b'})
+
+
+def test_uses_assets_lazy_content(tmpdir, mocker):
+    mktree(tmpdir, {
+        'pages/foobar.md': '---\ntitle: x\n---\n{% include "head.jinja" %}',
+        'theme/templates/head.jinja': '{{ url("x.png") }}',
+    })
+    graph = TemplateGraph(Config(source_dir=str(tmpdir)))
+    page_content = mocker.spy(templates, 'page_content')
+    page = {'infile': Path(tmpdir.join('pages/foobar.md')), 'template': None, 'content_offset': 17}
+    assert graph.uses_assets(page)
+    assert page_content.call_count == 1
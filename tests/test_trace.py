@@ -0,0 +1,72 @@
+import json
+
+from pytest_toolbox import mktree
+
+import harrier.trace
+from harrier.config import Mode
+from harrier.main import build
+from harrier.trace import finish_trace, span, start_trace
+
+
+def test_build_trace(tmpdir):
+    mktree(tmpdir, {
+        'pages': {
+            'foo.md': '# foo',
+            'bar.html': 'bar',
+            'image.png': '*',
+        },
+        'theme/templates/main.jinja': '{{ content }}',
+        'data/foo.yml': 'a: 1',
+        'harrier.yml': 'default_template: main.jinja',
+    })
+    build(tmpdir, mode=Mode.production, trace=tmpdir.join('trace.json'))
+    assert harrier.trace.TRACE_DIR is None
+    trace = json.loads(tmpdir.join('trace.json').read())
+    events = trace['traceEvents']
+    names = {e['name'] for e in events}
+    assert {
+        'build', 'step pages', 'build_pages', 'get_page_data', 'load_data', 'render_pages',
+        'content template', 'markdown', 'layout template', 'write', 'copy', 'process_name',
+    } <= names
+    build_event = next(e for e in events if e['name'] == 'build')
+    assert build_event['ph'] == 'X'
+    assert build_event['dur'] > 0
+    load_data_event = next(e for e in events if e['name'] == 'load_data')
+    # data is loaded in a subprocess
+    assert load_data_event['pid'] != build_event['pid']
+    assert {e['args']['page'] for e in events if e['name'] == 'markdown'} == {str(tmpdir.join('pages/foo.md'))}
+
+
+def test_build_trace_workers(tmpdir):
+    mktree(tmpdir, {
+        'pages': {f'{i}.html': str(i) for i in range(10)},
+    })
+    build(tmpdir, mode=Mode.production, workers=2, trace=tmpdir.join('trace.json'))
+    events = json.loads(tmpdir.join('trace.json').read())['traceEvents']
+    render_pids = {e['pid'] for e in events if e['name'] == 'render chunk'}
+    assert render_pids
+    build_pid = next(e['pid'] for e in events if e['name'] == 'build')
+    assert build_pid not in render_pids
+    assert len([e for e in events if e['name'] == 'write']) == 10
+
+
+def test_span_no_trace():
+    assert harrier.trace.TRACE_DIR is None
+    with span('foobar'):
+        pass
+    finish_trace('does-not-exist.json')
+
+
+def test_nested_spans(tmpdir):
+    start_trace()
+    with span('outer', foo='bar'):
+        with span('inner', 'page'):
+            pass
+    finish_trace(tmpdir.join('trace.json'))
+    events = json.loads(tmpdir.join('trace.json').read())['traceEvents']
+    assert [(e['name'], e['ph']) for e in events] == [('process_name', 'M'), ('inner', 'X'), ('outer', 'X')]
+    inner, outer = events[1:]
+    assert outer['args'] == {'foo': 'bar'}
+    assert inner['cat'] == 'page'
+    assert outer['ts'] <= inner['ts']
+    assert inner['ts'] + inner['dur'] <= outer['ts'] + outer['dur']
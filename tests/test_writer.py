@@ -0,0 +1,134 @@
+import logging
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+from pytest_toolbox import gettree, mktree
+
+from harrier.common import HarrierProblem
+from harrier.config import Mode
+from harrier.main import BuildSteps, build
+from harrier.writer import OutputWriter, sync_dirs
+
+MOCK_WEBPACK = f"""\
+#!{sys.executable}
+import json, sys
+from pathlib import Path
+
+out_dir = Path(sys.argv[sys.argv.index('--output-path') + 1])
+out_dir.mkdir(parents=True, exist_ok=True)
+(out_dir / 'main.js').write_text('js')
+print(json.dumps(dict(assets=[dict(name='main.js')])))
+"""
+
+
+def test_write_copy(tmpdir):
+    mktree(tmpdir, {'src.txt': 'copied'})
+    with OutputWriter(threads=2, max_pending=2) as writer:
+        for i in range(10):
+            writer.write(Path(tmpdir.join(f'{i}.txt')), f'file {i}'.encode())
+        writer.copy(Path(tmpdir.join('src.txt')), Path(tmpdir.join('dst.txt')))
+    tree = gettree(tmpdir)
+    assert tree['dst.txt'] == 'copied'
+    assert tree['9.txt'] == 'file 9'
+    assert len(tree) == 12
+
+
+def test_back_pressure(tmpdir, mocker):
+    release = threading.Event()
+    mocker.patch.object(OutputWriter, '_write', side_effect=lambda *args: release.wait(5))
+    writer = OutputWriter(threads=1, max_pending=2)
+    writer.write(Path(tmpdir.join('a')), b'a')
+    writer.write(Path(tmpdir.join('b')), b'b')
+    blocked = threading.Thread(target=writer.write, args=(Path(tmpdir.join('c')), b'c'))
+    blocked.start()
+    blocked.join(0.1)
+    assert blocked.is_alive()
+    release.set()
+    blocked.join(5)
+    assert not blocked.is_alive()
+    writer.__exit__(None, None, None)
+
+
+def test_write_error(tmpdir, caplog):
+    mktree(tmpdir, {
+        'pages/foo.md': '# foo',
+    })
+    outfile = tmpdir.join('dist/foo/index.html')
+    # a directory where the page should be written, dist isn't emptied without the "clean" step
+    outfile.ensure(dir=True)
+    with pytest.raises(HarrierProblem) as exc_info:
+        build(tmpdir, steps={BuildSteps.pages}, mode=Mode.production)
+    assert str(outfile) in str(exc_info.value)
+    assert f'{outfile}: error writing file: IsADirectoryError' in caplog.text
+
+
+def test_sync_dirs(tmpdir):
+    mktree(tmpdir, {
+        'src': {
+            'same.txt': 'same',
+            'changed.txt': 'new',
+            'added': {'a.txt': 'added'},
+        },
+        'dst': {
+            'same.txt': 'same',
+            'changed.txt': 'old',
+            'removed.txt': 'removed',
+            'gone': {'b.txt': 'b'},
+        },
+    })
+    same = tmpdir.join('dst/same.txt')
+    same.setmtime(1000)
+    inode = same.stat().ino
+    assert sync_dirs(Path(tmpdir.join('src')), Path(tmpdir.join('dst'))) == (1, 1, 2)
+    assert gettree(tmpdir.join('dst')) == {
+        'same.txt': 'same',
+        'changed.txt': 'new',
+        'added': {'a.txt': 'added'},
+    }
+    assert same.mtime() == 1000
+    assert same.stat().ino == inode
+
+
+def test_build_sync(tmpdir, caplog):
+    caplog.set_level(logging.INFO)
+    mktree(tmpdir, {
+        'pages': {
+            'foo.md': '# foo',
+            'bar.md': '# bar',
+        },
+        'harrier.yml': f'cache_dir: {tmpdir.join("cache")}',
+    })
+    build(tmpdir, mode=Mode.production, sync=True)
+    assert 'dist sync: 2 added, 0 changed, 0 removed' in caplog.text
+    tmpdir.join('dist/foo/index.html').setmtime(1000)
+
+    tmpdir.join('pages/bar.md').remove()
+    tmpdir.join('pages/new.md').write('# new')
+    build(tmpdir, mode=Mode.production, sync=True)
+    assert 'dist sync: 1 added, 0 changed, 1 removed' in caplog.text
+    assert gettree(tmpdir.join('dist')) == {
+        'foo': {'index.html': '<h1 id="1-foo">foo</h1>\n'},
+        'new': {'index.html': '<h1 id="1-new">new</h1>\n'},
+    }
+    assert tmpdir.join('dist/foo/index.html').mtime() == 1000
+
+
+def test_build_sync_webpack_outside_dist(tmpdir):
+    mktree(tmpdir, {
+        'pages/foo.md': '# foo',
+        'theme/js/index.js': '*',
+        'mock_webpack': MOCK_WEBPACK,
+        'harrier.yml': (
+            f'cache_dir: {tmpdir.join("cache")}\n'
+            f'webpack:\n'
+            f'  cli: {tmpdir.join("mock_webpack")}\n'
+            f'  output_path: {tmpdir.join("js_out")}\n'
+            f'  prod_output_filename: main.js\n'
+        ),
+    })
+    tmpdir.join('mock_webpack').chmod(0o777)
+    build(tmpdir, mode=Mode.production, sync=True)
+    assert gettree(tmpdir.join('dist')) == {'foo': {'index.html': '<h1 id="1-foo">foo</h1>\n'}}
+    assert gettree(tmpdir.join('js_out')) == {'main.js': 'js'}